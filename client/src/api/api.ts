@@ -31,10 +31,17 @@ async function performWithUndoRedo(
 }
 
 // Fetch transactions
+// ledger version of the rows we have, from the ETag of /api/transactions
+let ledgerVersion: number | null = null;
+
 async function fetchTransactions(
   setUndoRedo: SetUndoRedo
 ): Promise<TransactionRow[]> {
-  const rows = await fetchAPI<TransactionRow[]>("/api/transactions");
+  // skips fetchAPI because we need the ETag header
+  const response = await fetch("/api/transactions");
+  const rows = await handleResponse<TransactionRow[]>(response);
+  const etag = response.headers.get("etag");
+  ledgerVersion = etag ? Number(etag.replace(/^W\//, "").replace(/"/g, "")) : null;
   console.log("got rows", rows);
   await getUndoRedo(setUndoRedo);
   return rows;
@@ -63,6 +70,21 @@ async function updateTransaction(
   );
 }
 
+// many CRUD operations at once: one request, one transaction, one undo step
+// returns the resulting rows as a delta
+async function batchUpdateTransactions(
+  operations: { operation: Operation; row: TransactionRow }[],
+  setUndoRedo: SetUndoRedo
+): Promise<HistoryData> {
+  const res = await fetchAPI<HistoryData>("/api/transactions/batch", {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ operations }),
+  });
+  setUndoRedo(res.undo, res.redo);
+  return res;
+}
+
 // CSV operation1: download current table as CSV
 async function downloadCSV() {
   try {
@@ -100,13 +122,22 @@ async function downloadCSV() {
 }
 
 // CSV operation2: upload CSV to replace entire table
+// rows that look like an earlier row under another id are reported in `duplicates`
+// (and left out if skipDuplicates)
+export interface CsvImportResult {
+  duplicates: { id: string; duplicateOf: string }[];
+  skipped: string[];
+  table: TransactionRow[];
+}
 async function uploadCSV(
   formData: FormData,
-  setUndoRedo: SetUndoRedo
-): Promise<TransactionRow[]> {
+  setUndoRedo: SetUndoRedo,
+  skipDuplicates = false
+): Promise<CsvImportResult> {
+  const duplicates = skipDuplicates ? "skip" : "keep";
   return performWithUndoRedo(
     () =>
-      fetchAPI<TransactionRow[]>("/api/upload-csv", {
+      fetchAPI<CsvImportResult>(`/api/upload-csv?duplicates=${duplicates}`, {
         method: "POST",
         body: formData,
       }),
@@ -116,8 +147,15 @@ async function uploadCSV(
 
 // Undo and Redo
 // These functions have setUndoRedo baked into the caller buttons
-interface HistoryData {
-  table: TransactionRow[];
+// Only the rows touched by the step are returned; the whole table only comes
+// from the change feed, when a client is too far behind
+export interface HistoryDelta {
+  inserted: TransactionRow[];
+  updated: TransactionRow[];
+  deleted: string[];
+  table: TransactionRow[] | null;
+}
+export interface HistoryData extends HistoryDelta {
   redo: string;
   undo: string;
 }
@@ -128,6 +166,29 @@ async function redo(): Promise<HistoryData> {
   return fetchAPI<HistoryData>("/api/redo", { method: "POST" });
 }
 
+// Changes made elsewhere (e.g. another tab) since our ledger version
+// the server holds the request open until there is a change (long-poll)
+export interface LedgerChanges extends HistoryData {
+  version: number;
+}
+async function watchChanges(
+  onChanges: (changes: LedgerChanges) => void
+): Promise<void> {
+  while (ledgerVersion !== null) {
+    try {
+      const changes = await fetchAPI<LedgerChanges>(
+        `/api/changes?since=${ledgerVersion}`
+      );
+      if (changes.version === ledgerVersion) continue; // timed out, no changes
+      ledgerVersion = changes.version;
+      onChanges(changes);
+    } catch (error) {
+      console.error("Error watching changes:", error);
+      await new Promise((resolve) => setTimeout(resolve, 5000));
+    }
+  }
+}
+
 // Get UndoRedo
 // This fills in the undo and redo buttons with their next action
 interface UndoRedoResponse {
@@ -145,9 +206,11 @@ async function getUndoRedo(
 export const API = {
   fetchTransactions,
   updateTransaction,
+  batchUpdateTransactions,
   downloadCSV,
   uploadCSV,
   undo,
   redo,
   getUndoRedo,
+  watchChanges,
 };
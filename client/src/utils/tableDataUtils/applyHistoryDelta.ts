@@ -0,0 +1,29 @@
+import type { TransactionRow } from "@/types/TransactionRow";
+import type { HistoryDelta } from "@/api/api";
+
+// apply an undo/redo delta from the server to the current rows
+// - deleted ids are dropped
+// - updated rows replace the row with the same id
+// - inserted rows are appended (or replace a row with the same id)
+// rows should already be preprocessed with preprocessServerRows
+export const applyHistoryDelta = (
+  rows: TransactionRow[],
+  delta: HistoryDelta
+): TransactionRow[] => {
+  const deleted = new Set(delta.deleted);
+  const changed = new Map<string, TransactionRow>();
+  [...delta.updated, ...delta.inserted].forEach((row) =>
+    changed.set(row.id, row)
+  );
+
+  const newRows = rows
+    .filter((row) => !deleted.has(row.id))
+    .map((row) => {
+      const newRow = changed.get(row.id);
+      if (!newRow) return row;
+      changed.delete(row.id);
+      return newRow;
+    });
+  // whatever is left was not in the table yet
+  return [...newRows, ...changed.values()];
+};
@@ -0,0 +1,176 @@
+import datetime
+import itertools
+import json
+import math
+import random
+from typing import List, Optional
+
+from serverType.RowType import RowType
+
+# Synthetic ledgers for benchmarks: raw database rows (see TransactionDB.TABLE_SCHEMA)
+# shaped like real ones, so every code path gets exercised:
+# - every RowType, with the sub-rows the client creates under each parent
+#   (borrows with rebuys, repays with principle and interest, ...)
+# - ids in the utils/txId.newTxId format, ascending with the dates
+# - a few currencies and networks carry most of the rows (zipf weights),
+#   a long tail of others the rest
+# - tags and notes on part of the rows, for the search index
+# Every row computes (PnlEngine, TransactionTable) without a ComputeError.
+
+CURRENCIES = ["USDC", "ETH", "BTC", "SOL", "USDT", "AERO", "VIRTUAL", "PEPE", "DOGE", "ARB",
+              "OP", "LINK", "UNI", "AAVE", "WIF", "BONK", "JUP", "POL", "AVAX", "BNB"]
+NETWORKS = ["Ethereum", "Base", "Solana", "Arbitrum", "Optimism", "Polygon", "BSC", "Avalanche"]
+GAS = {"Solana": "SOL", "Polygon": "POL", "BSC": "BNB", "Avalanche": "AVAX"}
+STABLES = {"USDC", "USDT"}
+TAGS = ["dca", "airdrop", "cex", "dex", "farm", "tax", "review", "lp", "perp", "gift"]
+WORDS = ["swap", "bridge", "claim", "rebalance", "exit", "entry", "fees", "epoch", "vault",
+         "unlock", "stake", "reward", "sold", "bought", "partial", "manual", "wallet", "hot", "cold"]
+
+# relative frequency of each kind of top-level entry; loans, multi-leg (INIT) and
+# ERROR entries come with sub-rows, bridges as an out/in pair
+KINDS = {
+    "trade": 60, "bridge": 6, "reward": 8, "loss": 3,
+    "borrow": 6, "repay": 6, "init": 3, "error": 1,
+}
+KIND_NAMES = list(KINDS)
+KIND_WEIGHTS = list(itertools.accumulate(KINDS.values()))
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+# zipf exponent of the currency and network distributions
+SKEW = 1.1
+
+
+def zipf_weights(k: int, s: float = SKEW) -> List[float]:
+    """Cumulative weights (for random.choices) of ranks 1..k under a zipf law."""
+    return list(itertools.accumulate(1 / (rank + 1) ** s for rank in range(k)))
+
+
+class LedgerGenerator:
+    """Builds one ledger; generate_ledger() is the entry point."""
+
+    def __init__(self, seed: int, start: datetime.date, days: int):
+        self.rng = random.Random(seed)
+        self.start = start
+        self.days = days
+        self.currency_weights = zipf_weights(len(CURRENCIES))
+        self.network_weights = zipf_weights(len(NETWORKS))
+        self.tag_weights = zipf_weights(len(TAGS))
+        # log-uniform reference price per currency, from $0.00001 to $50k
+        self.price = {cur: 1.0 if cur in STABLES else math.exp(self.rng.uniform(-11.5, 10.8))
+                      for cur in CURRENCIES}
+        self.last_ms = 0
+
+    def currency(self, other: Optional[str] = None) -> str:
+        while True:
+            cur = self.rng.choices(CURRENCIES, cum_weights=self.currency_weights)[0]
+            if cur != other:
+                return cur
+
+    def network(self, other: Optional[str] = None) -> str:
+        while True:
+            network = self.rng.choices(NETWORKS, cum_weights=self.network_weights)[0]
+            if network != other:
+                return network
+
+    def amount(self, cur: str, usd: float) -> float:
+        """Amount of `cur` worth about `usd`."""
+        return float(f"{usd / self.price[cur] * self.rng.uniform(0.9, 1.1):.6g}")
+
+    def usd(self) -> float:
+        # lognormal: mostly tens to thousands of dollars, a few large ones
+        return round(math.exp(self.rng.gauss(5.5, 1.6)), 2)
+
+    def tx_id(self, date: str) -> str:
+        # newTxId: t-<creation time in ms>-<6 random digits>; rows are "created"
+        # during their day (utc), in order
+        day_ms = (datetime.date.fromisoformat(date).toordinal() - EPOCH) * 86_400_000
+        self.last_ms = max(self.last_ms + 1, day_ms + self.rng.randrange(86_400_000))
+        return f"t-{self.last_ms}-{self.rng.randint(100000, 999999)}"
+
+    def extras(self) -> tuple:
+        """(tags, note) columns."""
+        tags = []
+        if self.rng.random() < 0.3:
+            tags = sorted(set(self.rng.choices(TAGS, cum_weights=self.tag_weights, k=self.rng.randint(1, 3))))
+        note = ""
+        if self.rng.random() < 0.4:
+            note = " ".join(self.rng.choices(WORDS, k=self.rng.randint(2, 6)))
+        return json.dumps(tags), note
+
+    def row(self, date: str, row_type: RowType, network: str, parent_id: Optional[str] = None,
+            inc: Optional[tuple] = None, out: Optional[tuple] = None,
+            usd_value: Optional[float] = None, fee: float = 0.0) -> tuple:
+        """A raw row; inc/out are (amount, currency)."""
+        in_amount, in_cur = inc or (None, None)
+        out_amount, out_cur = out or (None, None)
+        tags, note = self.extras()
+        return (self.tx_id(date), parent_id is not None, parent_id, date, row_type.name,
+                in_amount, in_cur, out_amount, out_cur,
+                fee, GAS.get(network, "ETH"), usd_value, network, tags, note)
+
+    def trade(self, date: str, row_type: RowType = RowType.TRADE, parent_id: Optional[str] = None,
+              network: Optional[str] = None, sell: Optional[str] = None) -> tuple:
+        network = network or self.network()
+        sell = sell or self.currency()
+        buy = self.currency(sell)
+        usd = self.usd()
+        fee = round(self.rng.uniform(0.01, 5) / self.price[GAS.get(network, "ETH")], 8)
+        return self.row(date, row_type, network, parent_id, (self.amount(buy, usd), buy),
+                        (self.amount(sell, usd), sell), usd, fee)
+
+    def entry(self, date: str) -> List[tuple]:
+        """One top-level row with its sub-rows (or a bridge pair)."""
+        kind = self.rng.choices(KIND_NAMES, cum_weights=KIND_WEIGHTS)[0]
+        if kind == "trade":
+            return [self.trade(date)]
+        cur = self.currency()
+        network = self.network()
+        usd = self.usd()
+        if kind == "bridge":
+            amount = self.amount(cur, usd)
+            arrived = float(f"{amount * self.rng.uniform(0.995, 1):.6g}")
+            return [self.row(date, RowType.BRIDGEOUT, network, out=(amount, cur), usd_value=usd),
+                    self.row(date, RowType.BRIDGEIN, self.network(network), inc=(arrived, cur), usd_value=usd)]
+        if kind == "reward":
+            return [self.row(date, RowType.REWARD, network, inc=(self.amount(cur, usd), cur))]
+        if kind == "loss":
+            return [self.row(date, RowType.LOSS, network, out=(self.amount(cur, usd), cur), usd_value=usd)]
+        if kind == "borrow":
+            # borrow, then buy something with it
+            parent = self.row(date, RowType.BORROW, network, inc=(self.amount(cur, usd), cur))
+            return [parent] + [self.trade(date, RowType.subREBUY, parent[0], network, cur)
+                               for _ in range(self.rng.randint(1, 2))]
+        if kind == "repay":
+            amount = self.amount(cur, usd)
+            parent = self.row(date, RowType.REPAY, network, out=(amount, cur))
+            interest = float(f"{amount * self.rng.uniform(0.001, 0.08):.6g}")
+            return [parent,
+                    self.row(date, RowType.subPRINCIPLE, network, parent[0], out=(amount, cur)),
+                    self.row(date, RowType.subINTEREST, network, parent[0], out=(interest, cur),
+                             usd_value=round(usd * interest / amount, 2))]
+        if kind == "init":
+            # a multi-leg trade: the legs are extra amounts of one currency
+            # (in and out currency equal), gained or lost
+            parent = self.row(date, RowType.INIT, network)
+            gained = self.amount(cur, usd)
+            return [parent,
+                    self.row(date, RowType.subEXTRAIN, network, parent[0], inc=(gained, cur), out=(0.0, cur)),
+                    self.row(date, RowType.subEXTRAOUT, network, parent[0], inc=(0.0, cur),
+                             out=(float(f"{gained * self.rng.uniform(0.1, 0.9):.6g}"), cur))]
+        parent = self.row(date, RowType.ERROR, network, inc=(self.amount(cur, usd), cur))
+        return [parent, self.row(date, RowType.subERROR, network, parent[0], out=(self.amount(cur, usd), cur))]
+
+    def generate(self, n: int) -> List[tuple]:
+        rows: List[tuple] = []
+        while len(rows) < n:
+            # dates spread evenly over the ledger's days, so they ascend with the ids
+            date = (self.start + datetime.timedelta(days=len(rows) * self.days // n)).isoformat()
+            entry = self.entry(date)
+            if len(rows) + len(entry) > n:
+                entry = [self.trade(date)]
+            rows.extend(entry)
+        return rows
+
+
+def generate_ledger(n: int, seed: int = 1, start: str = "2021-01-01", days: int = 4 * 365) -> List[tuple]:
+    """`n` raw rows of a synthetic ledger, the same for the same arguments."""
+    return LedgerGenerator(seed, datetime.date.fromisoformat(start), days).generate(n)
@@ -0,0 +1,429 @@
+"""
+Benchmarks on generated ledgers (bench/ledger.py), in a temporary directory:
+    python benchmark.py [--sizes 1000,10000,100000] [--only db.] [--out results.json]
+                        [--thresholds bench/thresholds.json] [--baseline old.json [--tolerance 1.5]]
+Times the TransactionDB methods, csv import/export, undo/redo, the endpoints
+through the ASGI app in process (no server or network), and the app's startup in a
+new process. Writes the results as json, and exits with 1 when a case is over its
+threshold, or slower than in the baseline.
+
+Thresholds (bench/thresholds.json) are time budgets per case, "ms" plus "us_per_row"
+times the ledger size (either defaults to 0). Cases that shouldn't grow with the ledger
+only get "ms", so a lookup turning into a scan fails at the larger sizes. Budgets are
+twice the medians measured at 1000, 10000 and 100000 rows (at least 1 ms): a case
+fails once it gets about twice as slow, so re-measure them after speeding one up.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, List, Optional
+
+import httpx
+
+from bench.ledger import generate_ledger
+from components.TransactionDB import TransactionDB
+from components.ManageCSV import ManageCSV
+from components.History import History
+from components.PnlEngine import PnlEngine
+from components.TransactionTable import TransactionTable
+from serverType.api_types import TransactionQuery
+
+SERVER = os.path.dirname(os.path.abspath(__file__))
+# fresh rows for inserts; dated after the ledger, so their ids never collide with it
+EXTRA_START = "2030-01-01"
+# each case runs until it took this long in total (at least once)...
+MIN_TIME = 0.5
+# ...or this many times
+MAX_RUNS = 20
+# baseline comparisons ignore cases faster than this, they are mostly noise
+BASELINE_MIN_S = 0.001
+
+
+@contextlib.contextmanager
+def quiet():
+    """The app logs what it does (imports, exports...); keeps that out of the report."""
+    logging.disable(logging.INFO)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+def measure(fn: Callable, setup: Optional[Callable] = None) -> List[float]:
+    """Seconds of each run of fn(), or fn(setup()) with the setup untimed."""
+    times = []
+    while not times or (len(times) < MAX_RUNS and sum(times) < MIN_TIME):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+class Bench:
+    """Runs and records the cases of one ledger size."""
+
+    def __init__(self, rows: int, only: Optional[str], results: List[dict]):
+        self.rows = rows
+        self.only = only
+        self.results = results
+
+    def selected(self, name: str) -> bool:
+        return not self.only or self.only in name
+
+    def case(self, name: str, fn: Callable, setup: Optional[Callable] = None) -> None:
+        """Time `fn` (see measure) if selected by --only."""
+        if not self.selected(name):
+            return
+        with quiet():
+            times = measure(fn, setup)
+        result = {
+            "case": name,
+            "rows": self.rows,
+            "runs": len(times),
+            "median_s": statistics.median(times),
+            "min_s": min(times),
+        }
+        result["us_per_row"] = result["median_s"] / self.rows * 1e6
+        self.results.append(result)
+        print(f"{name:44} {self.rows:>8} rows {result['median_s'] * 1000:10.2f} ms "
+              f"{result['us_per_row']:8.2f} us/row  ({len(times)} runs)", file=sys.stderr)
+
+
+def extra_rows(n: int, seed: int) -> List[tuple]:
+    return generate_ledger(n, seed=seed, start=EXTRA_START, days=30)
+
+
+def top_level(rows: List[tuple], with_children: bool) -> List[str]:
+    """Ids of the top-level rows that have (or don't have) sub-rows."""
+    parents = {row[2] for row in rows if row[2] is not None}
+    return [row[0] for row in rows if row[2] is None and (row[0] in parents) == with_children]
+
+
+def bench_db(bench: Bench, rows: List[tuple], csv_path: str) -> None:
+    db = TransactionDB("data/bench.db")
+    csv_plugin = ManageCSV(db)
+    history = History(db)
+    n = len(rows)
+    parents = top_level(rows, True)
+    leaves = top_level(rows, False)
+    some_ids = [row[0] for row in rows[::max(1, n // 100)]][:100]
+
+    bench.case("db.insert_rows", lambda _: db.insert_rows(rows), setup=db.recreate_table)
+    with quiet():
+        # the cases below need the rows, even when insert_rows itself isn't timed
+        if not bench.selected("db.insert_rows"):
+            db.insert_rows(rows)
+        csv_plugin.save_to_csv(csv_path)
+
+    def cold():
+        db.cache.invalidate(None)
+    bench.case("db.get_all_transactions", lambda _: db.get_all_transactions(), setup=cold)
+    bench.case("db.get_all_transactions (cached)", db.get_all_transactions)
+    bench.case("db.get_all_transactions_json", lambda _: db.get_all_transactions_json(), setup=cold)
+    bench.case("db.get_columns", lambda: db.get_columns(["id", "date", "inAmount", "inCurrency"]))
+    bench.case("db.get_transactions_page", lambda: db.get_transactions_page(1000))
+    middle = rows[n // 2]
+    bench.case("db.get_transactions_page (middle)",
+               lambda: db.get_transactions_page(1000, (middle[3], middle[0])))
+    query = TransactionQuery(inCurrency=["ETH"], dateFrom=middle[3])
+    bench.case("db.query_transactions", lambda: db.query_transactions(query, 1000))
+    bench.case("db.search (note)", lambda: db.search("bridge claim", [], 1000))
+    bench.case("db.search (tags)", lambda: db.search(None, ["dca", "tax"], 1000))
+    bench.case("db.get_transaction", lambda _: db.get_transaction(middle[0]), setup=cold)
+    bench.case("db.get_rows", lambda _: db.get_rows(some_ids), setup=cold)
+    bench.case("db.get_self_and_children_rows", lambda: db.get_self_and_children_rows(parents[len(parents) // 2]))
+    bench.case("db.get_stats", db.get_stats)
+    bench.case("db.rebuild_stats", db.rebuild_stats)
+
+    extra = iter(extra_rows(2000, seed=2))
+    bench.case("db.insert_transaction", lambda: db.insert_transaction(db.row_to_transaction(next(extra))))
+    updated = db.get_transaction(leaves[len(leaves) // 2])
+    bench.case("db.update_transaction",
+               lambda: db.update_transaction(updated.model_copy(update={"note": f"edited {time.time()}"})))
+    batch = [row[:14] + (f"edited {i}",) for i, row in enumerate(rows[:1000])]
+    bench.case("db.update_rows (1000)", lambda: db.update_rows(batch))
+    bench.case("db.get_changes", lambda: db.get_changes(db.get_version() - 1))
+
+    trees = iter(range(1000))
+
+    def fresh_tree():
+        tree = [row for row in extra_rows(40, seed=100 + next(trees))]
+        db.insert_rows(tree)
+        return tree
+    bench.case("db.delete_ids (40)", lambda tree: db.delete_ids([row[0] for row in tree]), setup=fresh_tree)
+    bench.case("db.delete_subtree",
+               lambda tree: db.delete_subtree(top_level(tree, True)[0]), setup=fresh_tree)
+    child = next(row for row in rows if row[2] is not None)
+    targets = iter(parents * MAX_RUNS)
+    bench.case("db.move_subtree", lambda: db.move_subtree(child[0], next(targets)))
+    db.move_subtree(child[0], child[2])
+
+    # csv
+    bench.case("csv.save_to_csv", lambda: csv_plugin.save_to_csv("data/bench_export.csv"))
+    bench.case("csv.populate_from_csv (new)", lambda _: csv_plugin.populate_from_csv(csv_path),
+               setup=db.recreate_table)
+    bench.case("csv.populate_from_csv (unchanged)", lambda: csv_plugin.populate_from_csv(csv_path))
+
+    # history: each step is set up right before its undo or redo
+    def edit():
+        with db.conn.write():
+            tx = updated.model_copy(update={"note": f"edited {time.time()}"})
+            history.new_update(tx)
+            db.update_transaction(tx)
+
+    def edit_undone():
+        edit()
+        history.undo()
+    bench.case("history.undo (update)", lambda _: history.undo(), setup=edit)
+    bench.case("history.redo (update)", lambda _: history.redo(), setup=edit_undone)
+
+    def delete():
+        tree = fresh_tree()
+        history.new_delete(db.get_transaction(top_level(tree, True)[0]))
+
+    def delete_undone():
+        delete()
+        history.undo()
+    bench.case("history.undo (delete)", lambda _: history.undo(), setup=delete)
+    bench.case("history.redo (delete)", lambda _: history.redo(), setup=delete_undone)
+
+    def rewrite():
+        # what TransactionAPI.import_csv does, from an empty table
+        db.recreate_table()
+        with db.conn.write():
+            history.new_csv_rewrite(csv_plugin.populate_from_csv(csv_path))
+
+    def rewrite_undone():
+        rewrite()
+        history.undo()
+    bench.case("history.undo (csv import)", lambda _: history.undo(), setup=rewrite)
+    bench.case("history.redo (csv import)", lambda _: history.redo(), setup=rewrite_undone)
+
+    # totals, recomputed from scratch
+    engine = PnlEngine(db)
+    bench.case("pnl.get_totals", lambda _: engine.get_totals(), setup=lambda: engine.mark_dirty(None))
+    bench.case("table.from_db", lambda: TransactionTable.from_db(db))
+    table = TransactionTable.from_db(db)
+    bench.case("table.totals", table.totals)
+    db.conn.close()
+
+
+class AppClient:
+    """Calls the ASGI app in process, on one event loop, checking every response."""
+
+    def __init__(self, app):
+        self.loop = asyncio.new_event_loop()
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+
+    def __call__(self, method: str, url: str, **kwargs):
+        response = self.loop.run_until_complete(self.client.request(method, url, **kwargs))
+        if response.status_code != 200:
+            raise RuntimeError(f"{method} {url}: {response.status_code} {response.text[:500]}")
+        return response.json() if response.headers.get("content-type") == "application/json" else response
+
+    def close(self) -> None:
+        self.loop.run_until_complete(self.client.aclose())
+        self.loop.close()
+
+
+def bench_app(bench: Bench, app_client: AppClient, api, rows: List[tuple], csv_path: str) -> None:
+    call = app_client
+    with open(csv_path, "rb") as f:
+        csv_bytes = f.read()
+    header = csv_bytes[:csv_bytes.index(b"\n") + 1]
+
+    def upload(body: bytes, duplicates: str = "keep"):
+        return call("POST", f"/api/upload-csv?duplicates={duplicates}", files={"file": ("bench.csv", body)})
+    # every run replaces an empty table
+    bench.case("POST /api/upload-csv", lambda _: upload(csv_bytes), setup=lambda: upload(header))
+    bench.case("POST /api/upload-csv?duplicates=skip", lambda _: upload(csv_bytes, "skip"),
+               setup=lambda: upload(header))
+    if not bench.selected("POST /api/upload-csv"):
+        with quiet():
+            upload(csv_bytes)
+    # a second server process on the uploaded ledger
+    bench.case("app startup (import to ready)", start_app)
+
+    def cold():
+        api.db.cache.invalidate(None)
+    middle = rows[len(rows) // 2]
+    bench.case("GET /api/transactions", lambda _: call("GET", "/api/transactions"), setup=cold)
+    bench.case("GET /api/transactions?limit=1000", lambda: call("GET", "/api/transactions?limit=1000"))
+    query = f"/api/transactions/query?inCurrency=ETH&dateFrom={middle[3]}&limit=1000"
+    bench.case("GET /api/transactions/query", lambda: call("GET", query))
+    bench.case("GET /api/transactions/query?explain", lambda: call("GET", query + "&explain=true"))
+    bench.case("GET /api/transactions/{id}", lambda: call("GET", f"/api/transactions/{middle[0]}"))
+    bench.case("GET /api/search?q", lambda: call("GET", "/api/search?q=bridge%20claim"))
+    bench.case("GET /api/search?tag", lambda: call("GET", "/api/search?tag=dca&tag=tax"))
+    bench.case("GET /api/compute", lambda _: call("GET", "/api/compute"), setup=lambda: api.pnl.mark_dirty(None))
+    bench.case("GET /api/compute (cached)", lambda: call("GET", "/api/compute"))
+
+    def drop_table():
+        api.table = None
+    bench.case("GET /api/compute/totals", lambda _: call("GET", "/api/compute/totals"), setup=drop_table)
+    bench.case("GET /api/stats", lambda: call("GET", "/api/stats"))
+    bench.case("GET /api/status", lambda: call("GET", "/api/status"))
+    bench.case("GET /api/undo-redo", lambda: call("GET", "/api/undo-redo"))
+    bench.case("GET /api/download-csv", lambda: call("GET", "/api/download-csv"))
+
+    leaves = top_level(rows, False)
+    tx = call("GET", f"/api/transactions/{leaves[len(leaves) // 2]}")
+
+    def edited() -> dict:
+        return {**tx, "note": f"edited {time.time()}"}
+    bench.case("POST /api/transactions (update)",
+               lambda: call("POST", "/api/transactions", json={"operation": "update", "row": edited()}))
+    # the rows of the last write (the update above)
+    bench.case("GET /api/changes",
+               lambda: call("GET", f"/api/changes?since={api.db.get_version() - 1}&timeout=0"))
+    extra = iter(extra_rows(2000, seed=3))
+
+    def new_row() -> dict:
+        return api.db.row_to_transaction(next(extra)).model_dump(mode="json")
+    bench.case("POST /api/transactions (finalize)",
+               lambda: call("POST", "/api/transactions", json={"operation": "finalize", "row": new_row()}))
+    bench.case("POST /api/transactions (delete)",
+               lambda row: call("POST", "/api/transactions", json={"operation": "delete", "row": row}),
+               setup=lambda: call("POST", "/api/transactions", json={"operation": "finalize", "row": new_row()}))
+    batch = [{"operation": "update", "row": call("GET", f"/api/transactions/{tx_id}")}
+             for tx_id in leaves[:100]]
+    bench.case("POST /api/transactions/batch (100)",
+               lambda: call("POST", "/api/transactions/batch", json={"operations": batch}))
+    child = next(row for row in rows if row[2] is not None)
+    targets = iter(top_level(rows, True) * MAX_RUNS)
+    bench.case("POST /api/transactions/{id}/move",
+               lambda: call("POST", f"/api/transactions/{child[0]}/move", json={"parentId": next(targets)}))
+
+    def update():
+        call("POST", "/api/transactions", json={"operation": "update", "row": edited()})
+
+    def update_undone():
+        update()
+        call("POST", "/api/undo")
+    bench.case("POST /api/undo", lambda _: call("POST", "/api/undo"), setup=update)
+    bench.case("POST /api/redo", lambda _: call("POST", "/api/redo"), setup=update_undone)
+
+
+# imports the app and starts it (see main.lifespan), then exits without shutting down
+STARTUP = """
+import asyncio, os, main
+async def start():
+    async with main.app.router.lifespan_context(main.app):
+        os._exit(0)
+asyncio.run(start())
+"""
+
+
+def start_app() -> None:
+    """Start the app in a new python process on the database in the working directory."""
+    subprocess.run([sys.executable, "-c", STARTUP], env={**os.environ, "PYTHONPATH": SERVER},
+                   stderr=subprocess.DEVNULL, check=True)
+
+
+def load_app():
+    """Import the app with its database in the working directory (see main.py)."""
+    with quiet():
+        import main
+    return main.app, main.api
+
+
+def check(results: List[dict], thresholds: dict, baseline: Optional[dict], tolerance: float) -> List[str]:
+    """Failures: cases over their threshold, or slower than the baseline by more than `tolerance`."""
+    failures = []
+    before = {}
+    if baseline:
+        before = {(r["case"], r["rows"]): r["median_s"] for r in baseline["results"]}
+    for result in results:
+        name, rows, seconds = result["case"], result["rows"], result["median_s"]
+        if name in thresholds:
+            limit = thresholds[name].get("ms", 0) + thresholds[name].get("us_per_row", 0) * rows / 1000
+            if seconds * 1000 > limit:
+                failures.append(f"{name} at {rows} rows: {seconds * 1000:.2f} ms, threshold {limit:.2f} ms")
+        old = before.get((name, rows))
+        if old is not None and max(old, seconds) >= BASELINE_MIN_S and seconds > old * tolerance:
+            failures.append(f"{name} at {rows} rows: {seconds * 1000:.2f} ms, "
+                            f"{seconds / old:.1f}x the baseline's {old * 1000:.2f} ms")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks on generated ledgers")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma separated ledger sizes, in rows (up to 1000000)")
+    parser.add_argument("--only", help="run only the cases whose name contains this")
+    parser.add_argument("--out", help="write the results here as json (default: stdout)")
+    parser.add_argument("--thresholds", default=os.path.join(SERVER, "bench", "thresholds.json"))
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="slowest allowed ratio to the baseline")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    with open(args.thresholds) as f:
+        thresholds = json.load(f)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    out = args.out and os.path.abspath(args.out)
+    # the app keeps its database under data/ of the working directory
+    os.chdir(tempfile.mkdtemp(prefix="benchmark-"))
+    os.mkdir("data")
+    app, api = load_app()
+    app_client = AppClient(app)
+    results: List[dict] = []
+    try:
+        for size in sizes:
+            start = time.perf_counter()
+            rows = generate_ledger(size)
+            print(f"generated {size} rows in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+            bench = Bench(size, args.only, results)
+            csv_path = f"data/ledger_{size}.csv"
+            bench_db(bench, rows, csv_path)
+            bench_app(bench, app_client, api, rows, csv_path)
+            os.remove("data/bench.db")
+    finally:
+        app_client.close()
+
+    failures = check(results, thresholds, baseline, args.tolerance)
+    missing = sorted({r["case"] for r in results} - set(thresholds))
+    report = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "sizes": sizes,
+        "results": results,
+        "failures": failures,
+        "no_threshold": missing,
+    }
+    if args.out:
+        with open(out, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    for name in missing:
+        print(f"no threshold: {name}", file=sys.stderr)
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    if failures:
+        print(f"{len(failures)} case(s) regressed", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,34 @@
 # cfg: config
 data_path = 'data/'
+
+# sqlite connection tuning (see components/ConnectionManager.py)
+db_pool_size = 4  # number of pooled read connections
+db_cache_kb = 32768  # page cache per connection, in KiB
+db_mmap_bytes = 256 * 1024 * 1024
+db_busy_timeout_ms = 5000
+db_cached_statements = 256
+# threads running database reads for async route handlers, one per pooled reader
+# (writes run on the write coordinator's own thread)
+db_executor_workers = db_pool_size
+
+# undo/redo journal: oldest entries beyond this are compacted away
+history_limit = 500
+
+# pnl engine: checkpoint each currency's running totals about every N of its rows
+compute_checkpoint_every = 200
+
+# GET /api/changes: longest time a long-poll waits for a new ledger version, in seconds
+changes_poll_timeout = 25
+
+# write coordinator: writes queued within this many ms of each other commit together
+write_group_window_ms = 2
+write_group_max = 64  # most writes in one group commit
+
+# GET /api/metrics/profile: longest profile, in seconds, and default sampling interval in ms
+profile_max_seconds = 60
+profile_interval_ms = 5
+
+# logging (see components/Log.py): level of the server's loggers, json lines instead of logfmt
+log_level = "INFO"
+log_json = False
+log_debug_per_second = 10  # per-row debug events logged per second, per loop
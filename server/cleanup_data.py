@@ -2,6 +2,10 @@ import os
 import time
 from datetime import datetime, timedelta
 
+from components.Log import get_logger
+
+log = get_logger("cleanup")
+
 skip_files = ["transactions_export.csv", "transactions.db"]
 search_extensions = [".csv", ".db"]
 
@@ -26,9 +30,9 @@ def find_old_files(directory, days=2, remove=False):
 
             # Check if the file is older than the cutoff time
             if file_mtime < cutoff:
-                # Print the name of the file
-                print(f"Old file: {filename} {file_mtime}")
+                # Log the name of the file
+                log.info("old file", filename=filename, mtime=file_mtime)
                 if remove:
                     # Delete the file
                     os.remove(file_path)
-                    print(f"Deleted {filename}")
+                    log.info("deleted old file", filename=filename)
@@ -0,0 +1,78 @@
+"""
+Memory and speed of the columnar TransactionTable against the list of TransactionRow
+objects, on a generated ledger (bench/ledger.py, in a temporary database):
+    python compare_table.py [rows]
+"""
+
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench.ledger import generate_ledger
+from components.TransactionDB import TransactionDB
+from components.PnlEngine import PnlEngine
+from components.TransactionTable import TransactionTable
+
+
+def measure(fn):
+    """(result, seconds, bytes held by the result). Timed and traced in separate
+    runs, since tracing allocations slows python code down several times."""
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    result = fn()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, seconds, size
+
+
+def load_objects(db: TransactionDB) -> list:
+    # bypass the row cache, which would hand out the rows of the previous call
+    db.cache.invalidate(None)
+    return db.get_all_transactions()
+
+
+def max_difference(a: dict, b: dict) -> float:
+    """Largest relative difference between two totals dicts."""
+    worst = 0.0
+    for cur, totals in a.items():
+        for key, x in totals.items():
+            y = b[cur][key]
+            if x != y:
+                worst = max(worst, math.inf if x is None or y is None
+                            else abs(x - y) / max(abs(x), 1))
+    return worst
+
+
+n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+db = TransactionDB(os.path.join(tempfile.mkdtemp(), "compare.db"))
+db.insert_rows(generate_ledger(n))
+print(f"{n} rows")
+
+# warm the page cache, so both loads below read from memory
+db.get_columns(["id"])
+objects, objects_s, objects_bytes = measure(lambda: load_objects(db))
+table, table_s, table_bytes = measure(lambda: TransactionTable.from_db(db))
+print(f"load     objects {objects_s:7.2f}s {objects_bytes / n:6.0f} B/row | "
+      f"table {table_s:7.2f}s {table_bytes / n:6.0f} B/row")
+del objects
+db.cache.invalidate(None)
+
+engine = PnlEngine(db)
+start = time.perf_counter()
+want = engine.get_totals()
+engine_s = time.perf_counter() - start
+start = time.perf_counter()
+got = table.totals()
+totals_s = time.perf_counter() - start
+print(f"totals   engine  {engine_s:7.2f}s | table {totals_s:7.2f}s, "
+      f"max relative difference {max_difference(want, got):.1e}")
+
+start = time.perf_counter()
+table.holdings()
+print(f"holdings table   {time.perf_counter() - start:7.2f}s")
+db.conn.close()
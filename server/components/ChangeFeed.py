@@ -0,0 +1,43 @@
+import asyncio
+import threading
+from typing import Optional, Set, Tuple
+
+from components.TransactionDB import TransactionDB
+
+
+class ChangeFeed:
+    """Lets requests wait for the ledger version to move past a given version.
+    Woken from TransactionDB.change_listeners, which may run on any thread.
+    The version is kept in memory so waiting never touches the database
+    from the event loop."""
+
+    def __init__(self, db: TransactionDB):
+        self.db = db
+        self.lock = threading.Lock()
+        self.version = db.get_version()
+        self.waiters: Set[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+        db.change_listeners.append(self._on_change)
+
+    def _on_change(self, ids: Optional[Set[str]]) -> None:
+        version = self.db.get_version()
+        with self.lock:
+            self.version = max(self.version, version)
+            waiters = list(self.waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    async def wait(self, since: int, timeout: float) -> None:
+        """Return once the ledger version is past `since`, or after `timeout` seconds."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self.lock:
+            self.waiters.add(waiter)
+        try:
+            # checked after registering, so a commit in between still wakes us
+            if self.version > since:
+                return
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                self.waiters.discard(waiter)
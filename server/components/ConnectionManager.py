@@ -0,0 +1,293 @@
+import sqlite3
+import threading
+import time
+import queue
+from contextlib import contextmanager
+from typing import Callable, Iterator, List
+
+import cfg
+from components.Log import get_logger
+from components.RequestMetrics import request_stats
+
+log = get_logger("db")
+
+# Pragmas applied to every connection we open.
+# WAL lets readers keep going while the writer holds the lock, and
+# synchronous=NORMAL only fsyncs at checkpoints instead of every commit.
+CONNECTION_PRAGMAS = [
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA cache_size=-{cfg.db_cache_kb}",
+    f"PRAGMA mmap_size={cfg.db_mmap_bytes}",
+    f"PRAGMA busy_timeout={cfg.db_busy_timeout_ms}",
+]
+
+
+class CountingCursor(sqlite3.Cursor):
+    """Counts the statements it runs, the rows they change and the rows fetched
+    with fetchone/fetchmany/fetchall against the current request (see RequestMetrics).
+    Counted per call, not per row, so reading a big table costs nothing extra;
+    rows read by iterating the cursor aren't counted, read with fetch* instead.
+    Statements are counted here rather than with set_trace_callback, which
+    also reports every statement a trigger runs."""
+
+    def execute(self, sql, parameters=()):
+        super().execute(sql, parameters)
+        self._count_statement()
+        return self
+
+    def executemany(self, sql, parameters):
+        super().executemany(sql, parameters)
+        self._count_statement()
+        return self
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            self._count_rows(1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._count_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        self._count_rows(len(rows))
+        return rows
+
+    def _count_statement(self) -> None:
+        stats = request_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            if self.rowcount > 0:
+                stats.rows += self.rowcount
+
+    @staticmethod
+    def _count_rows(count: int) -> None:
+        stats = request_stats.get()
+        if stats is not None:
+            stats.rows += count
+
+
+class CountingConnection(sqlite3.Connection):
+    """Connection whose cursors are CountingCursors, including the ones
+    execute() and executemany() create."""
+
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+
+class ConnectionManager:
+    """Owns the persistent sqlite connections for one database file.
+
+    - read(): borrows a connection from a fixed pool of read-only connections
+    - write(): the single writer connection, wrapped in a transaction.
+      Nested write() calls on the same thread become savepoints, so a helper
+      that writes can be called on its own or as part of a bigger transaction.
+    """
+
+    def __init__(self, db_path: str, pool_size: int = cfg.db_pool_size):
+        self.db_path = db_path
+        self.pool_size = pool_size
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._write_owner = None
+        # callbacks to run once the outermost write commits, one list per nesting level
+        self._after_commit: List[List[Callable[[], None]]] = []
+        self._closed = False
+        # lock contention: how often and how long callers waited for a pooled reader
+        # or for the writer, and how many statements failed with SQLITE_BUSY
+        self._stats_lock = threading.Lock()
+        self._waits = {"reader": [0, 0.0, 0.0], "writer": [0, 0.0, 0.0]}  # count, total, max
+        self._busy_errors = 0
+
+        self._writer = self._connect()
+        self._writer.execute("PRAGMA journal_mode=WAL")
+
+        self._readers: List[sqlite3.Connection] = []
+        self._pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(pool_size):
+            conn = self._connect()
+            conn.execute("PRAGMA query_only=1")
+            self._readers.append(conn)
+            self._pool.put(conn)
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: we issue BEGIN/COMMIT ourselves in write()
+        # cached_statements: keep prepared statements around between calls
+        # CountingConnection: per-request statement and row counts
+        conn = sqlite3.connect(
+            self.db_path,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=cfg.db_cached_statements,
+            factory=CountingConnection,
+        )
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _waited(self, kind: str, seconds: float) -> None:
+        with self._stats_lock:
+            wait = self._waits[kind]
+            wait[0] += 1
+            wait[1] += seconds
+            wait[2] = max(wait[2], seconds)
+
+    def _check_busy(self, e: BaseException) -> None:
+        # busy_timeout already retried for a while before this surfaced.
+        # Marked once counted, as it may pass through several nested blocks
+        if isinstance(e, sqlite3.OperationalError) and "locked" in str(e) \
+                and not getattr(e, "busy_counted", False):
+            e.busy_counted = True
+            with self._stats_lock:
+                self._busy_errors += 1
+
+    def metrics(self) -> dict:
+        with self._stats_lock:
+            result = {"busyErrors": self._busy_errors}
+            for kind, (count, total, longest) in self._waits.items():
+                result[f"{kind}Waits"] = count
+                result[f"{kind}WaitMsTotal"] = 1000 * total
+                result[f"{kind}WaitMsMax"] = 1000 * longest
+            return result
+
+    def in_write(self) -> bool:
+        """True if the current thread has an open write transaction."""
+        return self._write_owner == threading.get_ident()
+
+    def after_commit(self, callback: Callable[[], None]) -> None:
+        """Run `callback` once the current write transaction commits.
+        Dropped if the transaction (or the savepoint it was added in) rolls back.
+        Outside a write, it runs right away."""
+        if self.in_write():
+            self._after_commit[-1].append(callback)
+        else:
+            callback()
+
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a pooled read connection.
+        Inside a write() on this thread, the writer is returned instead so
+        reads can see the uncommitted rows of the transaction."""
+        if self.in_write():
+            yield self._writer
+            return
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            start = time.perf_counter()
+            conn = self._pool.get()
+            self._waited("reader", time.perf_counter() - start)
+        try:
+            yield conn
+        except BaseException as e:
+            self._check_busy(e)
+            raise
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def snapshot(self) -> Iterator[sqlite3.Connection]:
+        """Like read(), but every query in the block sees the same committed state."""
+        with self.read() as conn:
+            if conn is self._writer:
+                yield conn
+                return
+            conn.execute("BEGIN")
+            try:
+                yield conn
+            finally:
+                conn.execute("COMMIT")
+
+    @contextmanager
+    def private_snapshot(self) -> Iterator[sqlite3.Connection]:
+        """Like snapshot(), on a read-only connection of its own outside the pool:
+        for long reads paced by someone else (e.g. a streamed download), which
+        would otherwise keep a pooled reader from every other request."""
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA query_only=1")
+            conn.execute("BEGIN")
+            yield conn
+        except BaseException as e:
+            self._check_busy(e)
+            raise
+        finally:
+            # closing ends the read transaction
+            conn.close()
+
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        """Run the block in a write transaction on the writer connection.
+        Commits on success, rolls back on any exception."""
+        if not self._write_lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self._write_lock.acquire()
+            self._waited("writer", time.perf_counter() - start)
+        try:
+            depth = self._write_depth
+            conn = self._writer
+            if depth == 0:
+                conn.execute("BEGIN IMMEDIATE")
+                self._write_owner = threading.get_ident()
+            else:
+                conn.execute(f"SAVEPOINT sp_{depth}")
+            self._write_depth += 1
+            self._after_commit.append([])
+            try:
+                yield conn
+            except BaseException:
+                self._write_depth -= 1
+                self._after_commit.pop()
+                if depth == 0:
+                    conn.execute("ROLLBACK")
+                    self._write_owner = None
+                else:
+                    conn.execute(f"ROLLBACK TO sp_{depth}")
+                    conn.execute(f"RELEASE sp_{depth}")
+                raise
+            self._write_depth -= 1
+            callbacks = self._after_commit.pop()
+            if depth == 0:
+                try:
+                    conn.execute("COMMIT")
+                finally:
+                    self._write_owner = None
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                # committed: a failing callback must neither skip the others
+                # nor turn the write into an error
+                for callback in callbacks:
+                    try:
+                        callback()
+                    except Exception:
+                        log.exception("after-commit callback failed", callback=repr(callback))
+            else:
+                conn.execute(f"RELEASE sp_{depth}")
+                self._after_commit[-1].extend(callbacks)
+        except BaseException as e:
+            self._check_busy(e)
+            raise
+        finally:
+            self._write_lock.release()
+
+    def close(self) -> None:
+        """Close every connection. Waits for any write in progress."""
+        with self._write_lock:
+            if self._closed:
+                return
+            self._closed = True
+            # refresh the planner's statistics where they went stale, as sqlite recommends
+            self._writer.execute("PRAGMA optimize")
+            for conn in self._readers:
+                conn.close()
+            self._writer.close()
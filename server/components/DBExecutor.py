@@ -0,0 +1,70 @@
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+import cfg
+from components.RequestMetrics import db_job
+
+
+class DBExecutor:
+    """Runs blocking database work on a fixed pool of threads, so async route
+    handlers can await it instead of blocking the event loop.
+
+    Its jobs only read: writes go through WriteCoordinator's own thread. At most
+    cfg.db_pool_size readers can use sqlite at once (see ConnectionManager), so
+    more threads than that would only wait on connections.
+    """
+
+    def __init__(self, max_workers: int = cfg.db_executor_workers):
+        self.max_workers = max_workers
+        self.pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="db")
+        self.lock = threading.Lock()
+        self.queued = 0  # submitted, waiting for a thread
+        self.running = 0
+        self.completed = 0
+        self.wait_total = 0.0  # seconds spent queued, over completed jobs
+        self.wait_max = 0.0
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run fn(*args, **kwargs) on the pool and return (or raise) its result."""
+        submitted = time.perf_counter()
+        # keep contextvars (e.g. request ids) visible inside the job
+        context = contextvars.copy_context()
+
+        def job():
+            waited = time.perf_counter() - submitted
+            with self.lock:
+                self.queued -= 1
+                self.running += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            try:
+                with db_job(context, submitted):
+                    return context.run(fn, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        with self.lock:
+            self.queued += 1
+        return await asyncio.get_running_loop().run_in_executor(self.pool, job)
+
+    def metrics(self) -> dict:
+        with self.lock:
+            started = self.completed + self.running
+            return {
+                "workers": self.max_workers,
+                "queueDepth": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "waitMsAvg": 1000 * self.wait_total / started if started else 0.0,
+                "waitMsMax": 1000 * self.wait_max,
+            }
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=True)
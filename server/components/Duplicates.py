@@ -0,0 +1,60 @@
+from typing import Dict, Iterable, List, Optional
+
+# Likely duplicates: the same transaction under another id, e.g. from overlapping
+# exchange exports uploaded together. Rows are compared by a fingerprint of what
+# the transaction did, hashed into a dict, so a whole import is checked in one pass.
+# Only top-level rows are fingerprinted; sub-rows go with their parent.
+
+# positions in a raw database row (see TransactionDB.TABLE_SCHEMA)
+ID, PARENT_ID, DATE, ROW_TYPE = 0, 2, 3, 4
+IN_AMOUNT, IN_CURRENCY, OUT_AMOUNT, OUT_CURRENCY = 5, 6, 7, 8
+NETWORK = 12
+
+# decimals amounts are compared at: absorbs float formatting noise between exports
+AMOUNT_DECIMALS = 8
+
+
+def _amount(value) -> Optional[float]:
+    # + 0.0 turns -0.0 into 0.0
+    return None if value is None else round(float(value), AMOUNT_DECIMALS) + 0.0
+
+
+def _text(value, case=str.upper) -> str:
+    return case(value.strip()) if value else ""
+
+
+def fingerprint(row: tuple) -> tuple:
+    """What a raw database row did: date, row type, both sides and the network,
+    normalized so the same transaction exported twice compares equal."""
+    return (
+        _text(row[DATE], str.strip),
+        row[ROW_TYPE],
+        _amount(row[IN_AMOUNT]),
+        _text(row[IN_CURRENCY]),
+        _amount(row[OUT_AMOUNT]),
+        _text(row[OUT_CURRENCY]),
+        _text(row[NETWORK], str.lower),
+    )
+
+
+class DuplicateDetector:
+    """Hash index of fingerprints to the id of the first row that had them."""
+
+    def __init__(self, rows: Iterable[tuple] = ()):
+        """Start from `rows` (e.g. the existing table); they are indexed, not checked."""
+        self.first: Dict[tuple, str] = {}
+        for row in rows:
+            if row[PARENT_ID] is None:
+                self.first.setdefault(fingerprint(row), row[ID])
+        self.matches: List[dict] = []
+
+    def check(self, row: tuple) -> Optional[str]:
+        """Id of an earlier row with the same fingerprint (recorded in self.matches),
+        or None, in which case this row is the one later copies will match."""
+        if row[PARENT_ID] is not None:
+            return None
+        original = self.first.setdefault(fingerprint(row), row[ID])
+        if original == row[ID]:
+            return None
+        self.matches.append({"id": row[ID], "duplicateOf": original})
+        return original
@@ -1,12 +1,16 @@
 from enum import Enum
 from typing import Optional, Any, List, Tuple
 from pydantic import BaseModel, Field
-import sqlite3
 import datetime
+import json
 
+import cfg
 from serverType.TransactionRow import TransactionRow
+from serverType.api_types import HistoryDelta
 from components.TransactionDB import TransactionDB
-from components.ManageCSV import ManageCSV
+from components.Log import get_logger
+
+log = get_logger("history")
 
 
 class OperationType(Enum):
@@ -14,156 +18,375 @@ class OperationType(Enum):
     UPDATE_TRANSACTION = "update_transaction"
     DELETE_TRANSACTION = "delete_transaction"
     REWRITE_TABLE = "rewrite_table"
+    # a row (and its sub-rows) moved under another parent, or to the top level
+    MOVE_TRANSACTION = "move_transaction"
+    # several add/update/delete operations undone/redone as one
+    BATCH = "batch"
+
+
+# undo_data list counted in the description of these operations
+COUNTED = {
+    OperationType.DELETE_TRANSACTION: "rows",
+    OperationType.MOVE_TRANSACTION: "rows",
+    OperationType.BATCH: "steps",
+}
+
+
+def describe(type: OperationType, count: int) -> str:
+    """Description of an operation; `count` is the length of its COUNTED list."""
+    if type == OperationType.ADD_TRANSACTION:
+        return f"finalize 1 transaction"
+    elif type == OperationType.UPDATE_TRANSACTION:
+        return f"update 1 transaction"
+    elif type == OperationType.DELETE_TRANSACTION:
+        return f"delete {count} transactions"
+    elif type == OperationType.REWRITE_TABLE:
+        return f"load from csv"
+    elif type == OperationType.MOVE_TRANSACTION:
+        return f"move {count} transactions"
+    elif type == OperationType.BATCH:
+        return f"apply {count} changes"
+    return "Unknown operation"
 
 
 class Operation(BaseModel):
     type: OperationType
     timestamp: datetime.datetime = Field(default_factory=datetime.datetime.now)
+    # position in the journal, set once appended
+    seq: int = 0
     # For undo
+    # rows are stored as raw database rows (see TransactionDB.TABLE_SCHEMA)
     undo_data: dict[str, Any]
     # For redo
     redo_data: dict[str, Any]
 
     def description(self) -> str:
-        if self.type == OperationType.ADD_TRANSACTION:
-            return f"finalize 1 transaction"
-        elif self.type == OperationType.UPDATE_TRANSACTION:
-            return f"update 1 transaction"
-        elif self.type == OperationType.DELETE_TRANSACTION:
-            return f"delete {len(self.undo_data['txs'])} transactions"
-        elif self.type == OperationType.REWRITE_TABLE:
-            return f"load from csv"
-        return "Unknown operation"
+        counted = COUNTED.get(self.type)
+        return describe(self.type, len(self.undo_data[counted]) if counted else 0)
+
+    def steps(self, data: str) -> List["Operation"]:
+        """Sub-operations of a BATCH, in the order they were applied.
+        `data` picks the payload to fill in ("undo_data" or "redo_data")."""
+        return [Operation(type=OperationType(step["type"]), **{"undo_data": {}, "redo_data": {}, data: step["data"]})
+                for step in getattr(self, data)["steps"]]
+
+
+def merge_deltas(deltas: List[HistoryDelta]) -> HistoryDelta:
+    """Combine deltas applied one after the other into the delta of the whole sequence."""
+    # id -> row, or None if deleted; in order of first appearance
+    final: dict = {}
+    inserted = set()
+    for delta in deltas:
+        for tx_id in delta.deleted:
+            final[tx_id] = None
+        for tx in delta.updated:
+            final[tx.id] = tx
+        for tx in delta.inserted:
+            if tx.id not in final:
+                inserted.add(tx.id)
+            final[tx.id] = tx
+    return HistoryDelta(
+        inserted=[tx for tx_id, tx in final.items()
+                  if tx is not None and tx_id in inserted],
+        updated=[tx for tx_id, tx in final.items()
+                 if tx is not None and tx_id not in inserted],
+        deleted=[tx_id for tx_id, tx in final.items() if tx is None],
+    )
+
+
+def revert_diff(diff: dict) -> dict:
+    """The part of a ManageCSV.populate_from_csv diff that undoing the import needs."""
+    return {key: diff[key] for key in ("added", "changed", "removed")}
 
 
 class History:
-    def __init__(self, db: TransactionDB):
+    """Undo/redo history, kept in an append-only journal table in the database.
+    Only the operations being undone/redone are loaded into memory, and the
+    journal keeps at most `max_operations` entries."""
+
+    def __init__(self, db: TransactionDB, max_operations: int = cfg.history_limit):
         self.db = db
-        self.operations: List[Operation] = []
-        self.current_index: int = -1  # Points to last executed operation
+        self.max_operations = max_operations
+        self.init_journal()
+
+    def init_journal(self):
+        with self.db.conn.write() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS history (
+                    seq INTEGER PRIMARY KEY,
+                    type TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    undo_data TEXT NOT NULL,
+                    redo_data TEXT NOT NULL
+                )
+            """)
+
+    @property
+    def current_seq(self) -> int:
+        """seq of the last executed operation, 0 if there is none."""
+        return self.db.get_meta("history_seq", 0)
+
+    def _set_current_seq(self, seq: int):
+        self.db.set_meta("history_seq", seq)
+
+    def _load(self, where: str, params: tuple) -> Optional[Operation]:
+        with self.db.conn.read() as conn:
+            row = conn.execute(
+                f"SELECT seq, type, timestamp, undo_data, redo_data FROM history {where}", params).fetchone()
+        if not row:
+            return None
+        return Operation(
+            seq=row[0],
+            type=OperationType(row[1]),
+            timestamp=datetime.datetime.fromisoformat(row[2]),
+            undo_data=json.loads(row[3]),
+            redo_data=json.loads(row[4]),
+        )
+
+    def _describe(self, where: str, params: tuple) -> str:
+        """description() of an operation, "" if there is none. Reads only its type and
+        the length of its COUNTED list, not the payloads (a csv import's hold its diff)."""
+        counted = " ".join(f"WHEN '{type.value}' THEN json_array_length(undo_data, '$.{key}')"
+                           for type, key in COUNTED.items())
+        with self.db.conn.read() as conn:
+            row = conn.execute(
+                f"SELECT type, CASE type {counted} END FROM history {where}", params).fetchone()
+        if not row:
+            return ""
+        return describe(OperationType(row[0]), row[1] or 0)
+
+    def _current_operation(self) -> Optional[Operation]:
+        return self._load("WHERE seq=?", (self.current_seq,))
+
+    def _next_operation(self) -> Optional[Operation]:
+        return self._load("WHERE seq>? ORDER BY seq LIMIT 1", (self.current_seq,))
+
+    def _previous_seq(self, seq: int) -> int:
+        with self.db.conn.read() as conn:
+            row = conn.execute(
+                "SELECT MAX(seq) FROM history WHERE seq<?", (seq,)).fetchone()
+        return row[0] or 0
 
     def append_operation(self, operation: Operation):
-        # Remove any operations after current_index if we're in the middle of the history
-        if self.current_index < len(self.operations) - 1:
-            self.operations = self.operations[:self.current_index + 1]
+        with self.db.conn.write() as conn:
+            # Remove any operations after the current one if we're in the middle of the history
+            current = self.current_seq
+            conn.execute("DELETE FROM history WHERE seq>?", (current,))
+
+            operation.seq = current + 1
+            conn.execute("INSERT INTO history VALUES (?,?,?,?,?)", (
+                operation.seq, operation.type.value, operation.timestamp.isoformat(),
+                json.dumps(operation.undo_data), json.dumps(operation.redo_data),
+            ))
+            self._set_current_seq(operation.seq)
 
-        self.operations.append(operation)
-        self.current_index += 1
+            # compaction: drop the oldest entries beyond the limit
+            conn.execute("DELETE FROM history WHERE seq<=?",
+                         (operation.seq - self.max_operations,))
 
     def new_add(self, tx: TransactionRow):
+        self.append_operation(self.make_add(tx))
+
+    def new_update(self, updated_tx: TransactionRow):
+        self.append_operation(self.make_update(updated_tx))
+
+    def new_delete(self, tx: TransactionRow):
+        self.append_operation(self.apply_delete(tx))
+
+    def new_move(self, tx_id: str, parent_id: Optional[str]) -> List[tuple]:
+        """Move a row and its sub-rows (see TransactionDB.move_subtree) as one undoable step.
+        Returns the moved rows as they are now."""
+        with self.db.conn.write():
+            old_rows = self.db.move_subtree(tx_id, parent_id)
+            if not old_rows:
+                raise Exception(f"History Error: Transaction {tx_id} not found")
+            self.append_operation(Operation(
+                type=OperationType.MOVE_TRANSACTION,
+                undo_data={"rows": old_rows},
+                redo_data={"tx_id": tx_id, "parent_id": parent_id},
+            ))
+            return self.db.get_rows(row[0] for row in old_rows)
+
+    def new_batch(self, operations: List[Operation]):
+        # operations from make_add/make_update/apply_delete, each made right before it was applied
         operation = Operation(
+            type=OperationType.BATCH,
+            undo_data={"steps": [{"type": op.type.value, "data": op.undo_data}
+                                 for op in operations]},
+            redo_data={"steps": [{"type": op.type.value, "data": op.redo_data}
+                                 for op in operations]},
+        )
+        self.append_operation(operation)
+
+    def make_add(self, tx: TransactionRow) -> Operation:
+        return Operation(
             type=OperationType.ADD_TRANSACTION,
             undo_data={"tx_id": tx.id},
-            redo_data={"tx": tx}
+            redo_data={"row": self.db.transaction_to_row(tx)}
         )
-        self.append_operation(operation)
 
-    def new_update(self, updated_tx: TransactionRow):
+    def make_update(self, updated_tx: TransactionRow) -> Operation:
         # get the old transaction by id
-        old_tx = self.db.get_transaction(updated_tx.id)
-        if not old_tx:
+        old_row = self.db.get_row(updated_tx.id)
+        if not old_row:
             raise Exception(
                 f"History Error: Transaction {updated_tx.id} not found")
-        operation = Operation(
+        return Operation(
             type=OperationType.UPDATE_TRANSACTION,
-            undo_data={"tx": old_tx},
-            redo_data={"tx": updated_tx}
+            undo_data={"row": old_row},
+            redo_data={"row": self.db.transaction_to_row(updated_tx)}
         )
-        self.append_operation(operation)
 
-    def new_delete(self, tx: TransactionRow):
-        # get tx and its children
-        old_txs = self.db.get_self_and_children(tx.id)
-        if not old_txs:
+    def apply_delete(self, tx: TransactionRow) -> Operation:
+        """Delete tx and its sub-rows, returning the operation that records it.
+        Unlike make_*, this applies the change: the rows are read back from the delete itself."""
+        old_rows = self.db.delete_subtree(tx.id)
+        if not old_rows:
             raise Exception(
                 f"History Error: Transaction {tx.id}/children not found")
-        operation = Operation(
+        return Operation(
             type=OperationType.DELETE_TRANSACTION,
-            undo_data={"txs": old_txs},
+            undo_data={"rows": old_rows},
             redo_data={"tx_id": tx.id}
         )
-        self.append_operation(operation)
 
-    def new_csv_rewrite(self, backup_db_path: str, new_csv_fname: str):
+    def new_csv_rewrite(self, diff: dict):
+        # diff from ManageCSV.populate_from_csv, reverted in place on undo;
+        # redo applies the rows the import wrote, so it needs nothing but the journal
+        # (the uploaded file is gone by then)
         operation = Operation(
             type=OperationType.REWRITE_TABLE,
-            undo_data={"db_fname": backup_db_path},
-            redo_data={"csv_fname": new_csv_fname}
+            undo_data={"diff": revert_diff(diff)},
+            redo_data={"diff": self.forward_diff(diff)}
         )
         self.append_operation(operation)
 
+    def forward_diff(self, diff: dict) -> dict:
+        """What redoing a csv import applies, read right after the import:
+        the rows it added and changed as they are now, and the ids it removed."""
+        return {
+            "added": self.db.get_rows(diff["added"]),
+            "changed": self.db.get_rows(row[0] for row in diff["changed"]),
+            "removed": [row[0] for row in diff["removed"]],
+        }
+
     def can_undo(self) -> bool:
-        return self.current_index >= 0
+        return self._current_operation() is not None
 
     def can_redo(self) -> bool:
-        return self.current_index < len(self.operations) - 1
+        return self._next_operation() is not None
 
     def get_actions(self) -> Tuple[str, str]:
-        print('getting actions', self.current_index, self.operations)
-        undo_action = self.operations[self.current_index].description(
-        ) if self.can_undo() else ""
-        redo_action = self.operations[self.current_index +
-                                      1].description() if self.can_redo() else ""
-        return undo_action, redo_action
-
-    def undo(self) -> bool:
-        if not self.can_undo():
-            raise Exception("No operations to undo")
-
-        operation = self.operations[self.current_index]
-        success = self._execute_undo(operation)
-        if success:
-            self.current_index -= 1
-        return success
-
-    def redo(self) -> bool:
-        if not self.can_redo():
-            return False
-
-        next_operation = self.operations[self.current_index + 1]
-        success = self._execute_redo(next_operation)
-        if success:
-            self.current_index += 1
-        return success
-
-    def _execute_undo(self, operation: Operation) -> bool:
+        """Descriptions of the operations undo and redo would run ("" for none)."""
+        seq = self.current_seq
+        log.debug("getting actions", seq=seq)
+        return (self._describe("WHERE seq=?", (seq,)),
+                self._describe("WHERE seq>? ORDER BY seq LIMIT 1", (seq,)))
+
+    def undo(self) -> HistoryDelta:
+        # undo and moving the history position commit together
+        with self.db.conn.write():
+            operation = self._current_operation()
+            if not operation:
+                raise Exception("No operations to undo")
+
+            delta = self._execute_undo(operation)
+            self._set_current_seq(self._previous_seq(operation.seq))
+            return delta
+
+    def redo(self) -> HistoryDelta:
+        # redo and moving the history position commit together
+        with self.db.conn.write():
+            next_operation = self._next_operation()
+            if not next_operation:
+                raise Exception("No operations to redo")
+
+            delta = self._execute_redo(next_operation)
+            self._set_current_seq(next_operation.seq)
+            return delta
+
+    def _delete_with_children(self, tx_id: str) -> List[str]:
+        """Delete a transaction and its children; returns the deleted ids."""
+        return [row[0] for row in self.db.delete_subtree(tx_id)]
+
+    def _to_transactions(self, rows: List[list]) -> List[TransactionRow]:
+        return [self.db.row_to_transaction(row) for row in rows]
+
+    def _execute_undo(self, operation: Operation) -> HistoryDelta:
         try:
             if operation.type == OperationType.ADD_TRANSACTION:
-                self.db.delete_transaction_by_id(operation.undo_data["tx_id"])
+                deleted = self._delete_with_children(
+                    operation.undo_data["tx_id"])
+                return HistoryDelta(deleted=deleted)
             elif operation.type == OperationType.UPDATE_TRANSACTION:
-                self.db.update_transaction(operation.undo_data["tx"])
+                row = operation.undo_data["row"]
+                self.db.update_rows([row])
+                return HistoryDelta(updated=self._to_transactions([row]))
             elif operation.type == OperationType.DELETE_TRANSACTION:
-                self.db.insert_batch(operation.undo_data["txs"])
+                rows = operation.undo_data["rows"]
+                self.db.insert_rows(rows)
+                return HistoryDelta(inserted=self._to_transactions(rows))
+            elif operation.type == OperationType.MOVE_TRANSACTION:
+                rows = operation.undo_data["rows"]
+                self.db.update_rows(rows)
+                return HistoryDelta(updated=self._to_transactions(rows))
             elif operation.type == OperationType.REWRITE_TABLE:
-                # Load the original db state from db_fname
-                self.db.restore_from_dbfile(operation.undo_data["db_fname"])
+                # Revert the csv diff in place, in one transaction
+                diff = operation.undo_data["diff"]
+                with self.db.conn.write():
+                    self.db.delete_ids(diff["added"])
+                    self.db.update_rows(diff["changed"])
+                    self.db.insert_rows(diff["removed"])
+                return HistoryDelta(
+                    inserted=self._to_transactions(diff["removed"]),
+                    updated=self._to_transactions(diff["changed"]),
+                    deleted=diff["added"])
+            elif operation.type == OperationType.BATCH:
+                # undo the steps last to first
+                with self.db.conn.write():
+                    return merge_deltas([self._execute_undo(step)
+                                         for step in reversed(operation.steps("undo_data"))])
 
-            return True
+            raise Exception(f"Unknown operation {operation.type}")
 
         except Exception as e:
-            print(f"Error during undo: {str(e)}")
+            log.warning("undo failed", type=operation.type.name, seq=operation.seq, error=str(e))
             raise e
 
-    def _execute_redo(self, operation: Operation) -> bool:
-        try:
-            with sqlite3.connect(self.db.db_path) as conn:
-                if operation.type == OperationType.ADD_TRANSACTION:
-                    self.db.insert_transaction(operation.redo_data["tx"])
-                elif operation.type == OperationType.UPDATE_TRANSACTION:
-                    self.db.update_transaction(operation.redo_data["tx"])
-                elif operation.type == OperationType.DELETE_TRANSACTION:
-                    # if tx_id has children, all will be deleted here
-                    self.db.delete_transaction_by_id(
-                        operation.redo_data["tx_id"])
-                elif operation.type == OperationType.REWRITE_TABLE:
-                    # Load the new db state from csv
-                    csv_plugin = ManageCSV(self.db)
-                    backup_db_path = csv_plugin.populate_from_csv(
-                        operation.redo_data["csv_fname"], clear_existing=True)
-                    operation.undo_data["db_fname"] = backup_db_path
-
-                return True
+    def _execute_redo(self, operation: Operation) -> HistoryDelta:
+        if operation.type == OperationType.ADD_TRANSACTION:
+            row = operation.redo_data["row"]
+            self.db.insert_rows([row])
+            return HistoryDelta(inserted=self._to_transactions([row]))
+        elif operation.type == OperationType.UPDATE_TRANSACTION:
+            row = operation.redo_data["row"]
+            self.db.update_rows([row])
+            return HistoryDelta(updated=self._to_transactions([row]))
+        elif operation.type == OperationType.DELETE_TRANSACTION:
+            # if tx_id has children, all will be deleted here
+            deleted = self._delete_with_children(
+                operation.redo_data["tx_id"])
+            return HistoryDelta(deleted=deleted)
+        elif operation.type == OperationType.MOVE_TRANSACTION:
+            with self.db.conn.write():
+                moved = self.db.move_subtree(
+                    operation.redo_data["tx_id"], operation.redo_data["parent_id"])
+                rows = self.db.get_rows(row[0] for row in moved)
+            return HistoryDelta(updated=self._to_transactions(rows))
+        elif operation.type == OperationType.REWRITE_TABLE:
+            # Replay the import in place, in one transaction
+            diff = operation.redo_data["diff"]
+            with self.db.conn.write():
+                self.db.delete_ids(diff["removed"])
+                self.db.update_rows(diff["changed"])
+                self.db.insert_rows(diff["added"])
+            return HistoryDelta(
+                inserted=self._to_transactions(diff["added"]),
+                updated=self._to_transactions(diff["changed"]),
+                deleted=diff["removed"])
+        elif operation.type == OperationType.BATCH:
+            with self.db.conn.write():
+                return merge_deltas([self._execute_redo(step)
+                                     for step in operation.steps("redo_data")])
 
-        except Exception as e:
-            print(f"Error during redo: {str(e)}")
-            return False
+        raise Exception(f"Unknown operation {operation.type}")
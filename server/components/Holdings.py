@@ -0,0 +1,207 @@
+import sqlite3
+from typing import Dict
+
+from utils import currencies
+
+# Materialized portfolio totals, kept up to date by triggers on the transactions
+# table so every write path (single edits, executemany batches, csv imports,
+# undo/redo) maintains them without extra code:
+# - holdings: per currency and network, the amount owned (netAmount) and borrowed
+# - last_prices: per currency, the price of the latest top-level row with a usd value
+# These mirror postcomputeStats.ts over the whole (unfiltered) ledger, so netOwned and
+# netBorrowed equal the final netAmount/amountBorrowed of PnlEngine for each currency.
+# Owned amounts per network are plain sums; they don't copy the client's
+# ownedByNetwork quirks, which only affect amountInNetwork.
+
+HOLDINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS holdings (
+    currency TEXT NOT NULL,
+    network TEXT NOT NULL,
+    owned REAL NOT NULL,
+    borrowed REAL NOT NULL,
+    rowCount INTEGER NOT NULL,
+    PRIMARY KEY (currency, network)
+);
+CREATE TABLE IF NOT EXISTS last_prices (
+    currency TEXT PRIMARY KEY,
+    date TEXT,
+    id TEXT NOT NULL,
+    price REAL NOT NULL
+);
+"""
+
+# what one side (in or out currency) of a row adds to holdings; `{r}` is the row alias.
+# Same rules as calculate_row_cur in PnlEngine: row types the client can't compute add 0
+IN_SIDE = """
+    SELECT {r}.inCurrency AS currency, COALESCE({r}.network, '') AS network,
+        CASE
+            WHEN {r}.inCurrency = {r}.outCurrency
+                THEN COALESCE({r}.inAmount, 0) - COALESCE({r}.outAmount, 0)
+            WHEN {r}.rowType IN ('BRIDGEIN', 'REWARD') THEN COALESCE({r}.inAmount, 0)
+            WHEN {r}.rowType IN ('TRADE', 'subREBUY') AND {r}.usdValue THEN COALESCE({r}.inAmount, 0)
+            ELSE 0
+        END AS owned,
+        CASE
+            WHEN {r}.inCurrency IS NOT {r}.outCurrency AND {r}.rowType = 'BORROW'
+                THEN COALESCE({r}.inAmount, 0)
+            ELSE 0
+        END AS borrowed
+    {source} WHERE {r}.inCurrency != '' AND {r}.rowType NOT IN ('ERROR', 'subERROR')"""
+OUT_SIDE = """
+    SELECT {r}.outCurrency AS currency, COALESCE({r}.network, '') AS network,
+        CASE
+            WHEN {r}.rowType IN ('BRIDGEOUT', 'LOSS', 'subINTEREST') THEN -COALESCE({r}.outAmount, 0)
+            WHEN {r}.rowType IN ('TRADE', 'subREBUY') AND {r}.usdValue THEN -COALESCE({r}.outAmount, 0)
+            ELSE 0
+        END AS owned,
+        CASE
+            WHEN {r}.rowType IN ('REPAY', 'subPRINCIPLE') THEN -COALESCE({r}.outAmount, 0)
+            ELSE 0
+        END AS borrowed
+    {source} WHERE {r}.outCurrency != '' AND {r}.outCurrency IS NOT {r}.inCurrency
+        AND {r}.rowType NOT IN ('ERROR', 'subERROR')"""
+
+# prices a top-level row sets; the out side wins if both sides are the same currency
+PRICE_SIDES = """
+    SELECT {r}.inCurrency AS currency, {r}.date AS date, {r}.id AS id,
+        {r}.usdValue / {r}.inAmount AS price, 0 AS side
+    {source} WHERE {r}.isSubRow = 0 AND {r}.inCurrency != '' AND {r}.inAmount AND {r}.usdValue
+    UNION ALL
+    SELECT {r}.outCurrency, {r}.date, {r}.id, {r}.usdValue / {r}.outAmount, 1
+    {source} WHERE {r}.isSubRow = 0 AND {r}.outCurrency != '' AND {r}.outAmount AND {r}.usdValue"""
+
+# latest price of one side for currency `{cur}`: walks idx_in_currency/idx_out_currency
+# (see TransactionDB.QUERY_INDEXES) backwards from the latest row of that currency.
+# The guard is in LIMIT (0 or 1, never NULL) because sqlite evaluates that once, before touching the table;
+# as a WHERE term it would be tested on every row of the walk.
+_LATEST_SIDE = """
+    SELECT * FROM (
+        SELECT t.date, t.id, t.usdValue / t.{side}Amount AS price, {n} AS side FROM transactions t
+        WHERE t.{side}Currency = {{cur}} AND t.isSubRow = 0 AND t.usdValue AND t.{side}Amount
+        ORDER BY t.date DESC, t.id DESC
+        LIMIT {{cur}} IS NOT NULL AND {{cur}} != ''
+            AND NOT EXISTS (SELECT 1 FROM last_prices WHERE currency = {{cur}}))"""
+
+# latest price for currency `{cur}` if it has none (e.g. its price row was just removed);
+# the out side wins if both sides of a row are the same currency, as in PRICE_SIDES
+LATEST_PRICE = """
+    INSERT INTO last_prices (currency, date, id, price)
+    SELECT {cur}, date, id, price FROM (""" + \
+    _LATEST_SIDE.format(side="in", n=0) + " UNION ALL" + _LATEST_SIDE.format(side="out", n=1) + """)
+    ORDER BY date DESC, id DESC, side DESC LIMIT 1;"""
+
+
+def _add_holdings(r: str, sign: int) -> str:
+    # WHERE true: needed by sqlite to parse an upsert after a SELECT
+    return f"""
+    INSERT INTO holdings (currency, network, owned, borrowed, rowCount)
+    SELECT currency, network, {sign} * owned, {sign} * borrowed, {sign} FROM (
+        {IN_SIDE.format(r=r, source="")}
+        UNION ALL
+        {OUT_SIDE.format(r=r, source="")}
+    ) WHERE true
+    ON CONFLICT (currency, network) DO UPDATE SET
+        owned = owned + excluded.owned,
+        borrowed = borrowed + excluded.borrowed,
+        rowCount = rowCount + excluded.rowCount;"""
+
+
+def _add_prices(r: str) -> str:
+    return f"""
+    INSERT INTO last_prices (currency, date, id, price)
+    SELECT currency, date, id, price FROM ({PRICE_SIDES.format(r=r, source="")})
+    WHERE true ORDER BY side
+    ON CONFLICT (currency) DO UPDATE SET
+        date = excluded.date, id = excluded.id, price = excluded.price
+    WHERE (excluded.date, excluded.id) >= (last_prices.date, last_prices.id);"""
+
+
+def _remove_holdings(r: str) -> str:
+    return _add_holdings(r, -1) + """
+    DELETE FROM holdings WHERE rowCount = 0;"""
+
+
+def _remove_prices(r: str) -> str:
+    # a removed latest price is looked up again
+    return """
+    DELETE FROM last_prices WHERE id = {r}.id;""".format(r=r) + \
+        LATEST_PRICE.format(cur=f"{r}.inCurrency") + \
+        LATEST_PRICE.format(cur=f"{r}.outCurrency")
+
+
+# name: (event, condition, body). Only top-level rows set prices, so the price
+# triggers skip sub-rows: deleting a parent with many sub-rows stays cheap
+TRIGGERS = {
+    "holdings_insert": ("AFTER INSERT", "", _add_holdings("NEW", 1)),
+    "holdings_delete": ("AFTER DELETE", "", _remove_holdings("OLD")),
+    "holdings_update": ("AFTER UPDATE", "", _remove_holdings("OLD") + _add_holdings("NEW", 1)),
+    "prices_insert": ("AFTER INSERT", "WHEN NEW.isSubRow = 0", _add_prices("NEW")),
+    "prices_delete": ("AFTER DELETE", "WHEN OLD.isSubRow = 0", _remove_prices("OLD")),
+    "prices_update": ("AFTER UPDATE", "WHEN OLD.isSubRow = 0 OR NEW.isSubRow = 0",
+                      _remove_prices("OLD") + _add_prices("NEW")),
+}
+
+
+def create_holdings(conn: sqlite3.Connection) -> None:
+    """Create the holdings tables and their triggers, filling them if they are new.
+    Must run inside a write, after the transactions table exists."""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='holdings'").fetchone()
+    # not executescript: it would commit the surrounding transaction
+    for stmt in HOLDINGS_SCHEMA.split(";"):
+        if stmt.strip():
+            conn.execute(stmt)
+    for name, (event, condition, body) in TRIGGERS.items():
+        # recreated every time, so databases pick up changes to the trigger bodies
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"""
+            CREATE TRIGGER {name} {event} ON transactions {condition}
+            BEGIN {body} END""")
+    if not exists:
+        rebuild_holdings(conn)
+
+
+def rebuild_holdings(conn: sqlite3.Connection) -> None:
+    """Recompute both tables from scratch (e.g. to clear accumulated float error)."""
+    source = "FROM transactions t"
+    conn.execute("DELETE FROM holdings")
+    conn.execute(f"""
+        INSERT INTO holdings (currency, network, owned, borrowed, rowCount)
+        SELECT currency, network, SUM(owned), SUM(borrowed), COUNT(*) FROM (
+            {IN_SIDE.format(r="t", source=source)}
+            UNION ALL
+            {OUT_SIDE.format(r="t", source=source)}
+        ) GROUP BY currency, network""")
+    conn.execute("DELETE FROM last_prices")
+    conn.execute(f"""
+        INSERT INTO last_prices (currency, date, id, price)
+        SELECT currency, date, id, price FROM (
+            SELECT *, ROW_NUMBER() OVER (
+                PARTITION BY currency ORDER BY date DESC, id DESC, side DESC) AS n
+            FROM ({PRICE_SIDES.format(r="t", source=source)})
+        ) WHERE n = 1""")
+
+
+def get_stats(conn: sqlite3.Connection) -> Dict[str, dict]:
+    """netOwned, netBorrowed and lastTradePrices as in postcomputeStats.ts,
+    plus the per-network breakdown. Reads one row per currency and network."""
+    net_owned: Dict[str, float] = {}
+    net_borrowed: Dict[str, float] = {}
+    by_network: Dict[str, Dict[str, dict]] = {}
+    for cur, network, owned, borrowed in conn.execute(
+            "SELECT currency, network, owned, borrowed FROM holdings").fetchall():
+        net_owned[cur] = net_owned.get(cur, 0) + owned
+        net_borrowed[cur] = net_borrowed.get(cur, 0) + borrowed
+        by_network.setdefault(cur, {})[network] = {
+            "owned": owned, "borrowed": borrowed}
+    last_trade_prices = {
+        cur: price for cur, price in conn.execute("SELECT currency, price FROM last_prices").fetchall()
+        # prices of stables are not shown
+        if cur not in currencies.stable
+    }
+    return {
+        "netOwned": net_owned,
+        "netBorrowed": net_borrowed,
+        "lastTradePrices": last_trade_prices,
+        "byNetwork": by_network,
+    }
@@ -0,0 +1,133 @@
+import atexit
+import datetime
+import json
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+import cfg
+from components.RequestMetrics import request_stats
+
+# Structured logging for the server. Events are a message plus key=value fields:
+#     log = get_logger("csv")
+#     log.info("imported csv", rows=count, added=len(added))
+# Records go through a queue to a listener thread that formats and writes them
+# (to stderr), so logging never blocks the event loop or a database thread on I/O.
+# Events logged while serving a request carry its route (see RequestMetrics).
+# Per-row events of hot loops go through Sampled, which rate-limits them.
+
+ROOT = "diablog"
+_listener: Optional[QueueListener] = None
+
+
+class StructuredLogger(logging.LoggerAdapter):
+    """Logger whose keyword arguments (besides exc_info and the like) are fields of the event.
+    Like any logger, it does nothing below its level, before looking at the fields."""
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs)
+                  if key not in ("exc_info", "stack_info", "stacklevel", "extra")}
+        kwargs["extra"] = {"fields": fields}
+        return msg, kwargs
+
+
+def get_logger(name: str) -> StructuredLogger:
+    return StructuredLogger(logging.getLogger(f"{ROOT}.{name}"), {})
+
+
+class Sampled:
+    """Debug events of a hot loop (one per row of an import, ...): at most
+    `per_second` of them are logged, the next one logged says how many were dropped.
+    Build one per loop; when debug is off `enabled` is False and the loop should
+    check it before building the event, so it costs one attribute read per row."""
+
+    def __init__(self, log: StructuredLogger, per_second: float = cfg.log_debug_per_second):
+        self.log = log
+        self.enabled = log.isEnabledFor(logging.DEBUG)
+        self.interval = 1 / per_second
+        self.next = 0.0
+        self.dropped = 0
+
+    def __call__(self, msg: str, **fields) -> None:
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now < self.next:
+            self.dropped += 1
+            return
+        self.next = now + self.interval
+        if self.dropped:
+            fields["dropped"] = self.dropped
+            self.dropped = 0
+        self.log.debug(msg, **fields)
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # resolve on the logging thread what can't wait for the listener:
+        # the arguments may change, the traceback and the request go away
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        stats = request_stats.get()
+        record.request = stats.label if stats is not None else None
+        return record
+
+
+def _logfmt(value) -> str:
+    text = value if isinstance(value, str) else json.dumps(value, default=str)
+    if not text or any(c in text for c in ' ="\n'):
+        return json.dumps(text)
+    return text
+
+
+class StructuredFormatter(logging.Formatter):
+    """One line per event: logfmt (time level logger message key=value...),
+    or a json object with `json_lines`."""
+
+    def __init__(self, json_lines: bool = False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {}
+        if getattr(record, "request", None):
+            fields["request"] = record.request
+        fields.update(getattr(record, "fields", {}))
+        timestamp = datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds")
+        if self.json_lines:
+            event = {"time": timestamp, "level": record.levelname, "logger": record.name,
+                     "msg": record.message, **fields}
+            if record.exc_text:
+                event["exception"] = record.exc_text
+            return json.dumps(event, default=str)
+        line = f"{timestamp} {record.levelname:<7} {record.name} {record.message}"
+        line += "".join(f" {key}={_logfmt(value)}" for key, value in fields.items())
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+def setup_logging(level: str = cfg.log_level, json_lines: bool = cfg.log_json) -> None:
+    """Send the server's loggers through the queue to stderr. Safe to call again,
+    e.g. to change the level."""
+    global _listener
+    root = logging.getLogger(ROOT)
+    root.setLevel(level)
+    if _listener is not None:
+        _listener.handlers[0].setFormatter(StructuredFormatter(json_lines))
+        return
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(StructuredFormatter(json_lines))
+    _listener = QueueListener(records, stream)
+    _listener.start()
+    # flush what is queued on exit
+    atexit.register(_listener.stop)
+    root.addHandler(_QueueHandler(records))
+    root.propagate = False
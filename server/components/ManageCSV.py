@@ -1,16 +1,17 @@
 import csv
-from typing import List
-from dataclasses import asdict, fields
-from datetime import datetime
+import io
+import json
+from itertools import islice
+from typing import Iterable, Iterator, List
 import sqlite3
-import os
-import traceback
 
-import cfg
-from data.demo_tx import demo_tx
 from serverType.TransactionRow import TransactionRow
 from serverType.RowType import RowType
-from components.TransactionDB import TransactionDB
+from components.TransactionDB import TransactionDB, TABLE_SCHEMA, COLUMNS
+from components.Duplicates import DuplicateDetector
+from components.Log import get_logger, Sampled
+
+log = get_logger("csv")
 
 
 class ManageCSV:
@@ -19,10 +20,9 @@ class ManageCSV:
 
     def get_csv_headers(self) -> List[str]:
         """Get field names from TransactionRow dataclass."""
-        with sqlite3.connect(self.db.db_path) as conn:
-            cursor = conn.execute("SELECT * FROM transactions")
+        with self.db.conn.read() as conn:
+            cursor = conn.execute("SELECT * FROM transactions LIMIT 0")
             headers = [desc[0] for desc in cursor.description]
-            print('got headers', headers)
             return headers
 
     def row_to_dict(self, headers: List[str], tx: TransactionRow) -> dict:
@@ -47,7 +47,7 @@ class ManageCSV:
         if row['outAmount']:
             row['outAmount'] = float(row['outAmount'])
         if row['feeAmount']:
-            if row['feeAmount'].lower() in 'auto':
+            if row['feeAmount'].lower() == 'auto':
                 row['feeAmount'] = 'auto'
             else:
                 row['feeAmount'] = float(row['feeAmount'])
@@ -62,76 +62,214 @@ class ManageCSV:
 
         if row['tags']:
             row['tags'] = [tag.strip() for tag in row['tags'].split(',')]
-            print('tags for row', row['tags'])
         else:
             row['tags'] = []
 
         # Create TransactionRow object
         return TransactionRow(**row)
 
-    def save_to_csv(self, filepath: str) -> None:
-        """Save current database state to CSV file."""
-        try:
-            # Get all transactions from database
-            transactions = self.db.get_all_transactions()
+    def check_csv_headers(self, headers: Iterable[str]) -> None:
+        """Raise if the CSV is missing a column that TransactionRow requires."""
+        missing = [
+            name for name, field in TransactionRow.model_fields.items()
+            if field.is_required() and name not in (headers or [])]
+        if missing:
+            raise ValueError(f"CSV is missing columns: {', '.join(missing)}")
+
+    def dict_to_db_row(self, row: dict) -> tuple:
+        """Convert CSV dict straight to a database row, without building a TransactionRow.
+        Same conversions as dict_to_row; headers must be checked with check_csv_headers.
+        Values missing from a short line are None, like empty ones."""
+        def optional(v):
+            return None if v is None or v == '' else v
+
+        def number(v):
+            return None if v is None or v == '' else float(v)
+
+        def text(v, name):
+            if v is None or v == '':
+                raise ValueError(f"{name} is required")
+            return v
+
+        fee = row['feeAmount']
+        if fee is None or fee == '':
+            fee = None
+        elif fee.lower() == 'auto':
+            fee = 'auto'
+        else:
+            fee = float(fee)
+
+        is_sub_row = row['isSubRow']
+        tags = row['tags']
+        return (
+            text(row['id'], 'id'),
+            str(is_sub_row).lower() == 'true' if is_sub_row else False,
+            optional(row.get('parentId')),
+            text(row['date'], 'date'),
+            RowType[text(row['rowType'], 'rowType')].name,
+            number(row['inAmount']),
+            optional(row['inCurrency']),
+            number(row['outAmount']),
+            optional(row['outCurrency']),
+            fee,
+            optional(row['feeCurrency']),
+            number(row['usdValue']),
+            text(row['network'], 'network'),
+            json.dumps([tag.strip() for tag in tags.split(',')]
+                       if tags else []),
+            optional(row['note']),
+        )
+
+    def iter_db_rows(self, reader: csv.DictReader) -> Iterator[tuple]:
+        """Convert CSV rows to database rows, reporting the line of any bad row."""
+        self.check_csv_headers(reader.fieldnames)
+        row_event = Sampled(log)
+        for row in reader:
+            try:
+                db_row = self.dict_to_db_row(row)
+                if row_event.enabled:
+                    row_event("csv row", line=reader.line_num, id=db_row[0], rowType=db_row[4])
+                yield db_row
+            except (ValueError, KeyError) as e:
+                raise ValueError(
+                    f"line {reader.line_num}: invalid value {e}") from e
 
-            headers = self.get_csv_headers()
+    def db_row_to_csv(self, row: tuple) -> list:
+        """Convert a raw database row to CSV values, same format as row_to_dict."""
+        values = list(row)
+        # isSubRow is stored as 0/1
+        values[1] = bool(values[1])
+        # tags are stored as a json list
+        values[13] = ', '.join(json.loads(values[13])) if values[13] else None
+        return ['' if v is None else v for v in values]
 
-            with open(filepath, 'w', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=headers)
-                writer.writeheader()
+    def iter_csv(self, chunk_size: int = 1000) -> Iterator[bytes]:
+        """Yield the database as CSV bytes, `chunk_size` rows at a time.
+        Rows are read straight from a cursor, so memory stays flat. The cursor is on a
+        connection of its own, as the consumer (e.g. a download) sets the pace;
+        errors are logged here, since they surface after the response has started."""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        try:
+            with self.db.conn.private_snapshot() as conn:
+                cursor = conn.execute("SELECT * FROM transactions")
+                writer.writerow([desc[0] for desc in cursor.description])
+                # send the header right away
+                yield buffer.getvalue().encode()
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    buffer.seek(0)
+                    buffer.truncate()
+                    writer.writerows(self.db_row_to_csv(row) for row in rows)
+                    yield buffer.getvalue().encode()
+        except Exception:
+            log.exception("csv export failed")
+            raise
 
-                for tx in transactions:
-                    writer.writerow(self.row_to_dict(headers, tx))
+    def save_to_csv(self, filepath: str) -> None:
+        """Save current database state to CSV file."""
+        try:
+            with open(filepath, 'wb') as csvfile:
+                for chunk in self.iter_csv():
+                    csvfile.write(chunk)
 
-            print(
-                f"Successfully exported {len(transactions)} transactions to {filepath}")
+            log.info("exported csv", path=filepath)
 
         except Exception as e:
             raise Exception(f"Failed to save CSV: {str(e)}")
 
-    def populate_from_csv(self, filepath: str, clear_existing: bool = True) -> str:
-        """Populate database from CSV file. Returns path to backup dbfile."""
+    def populate_from_csv(self, filepath: str, clear_existing: bool = True, chunk_size: int = 5000,
+                          duplicates: str = "keep") -> dict:
+        """Populate database from CSV file, in one transaction.
+        The file is parsed in chunks of `chunk_size` rows into a staging table, which is then
+        applied to transactions in place. Returns the row-level diff against the previous table:
+        {"added": [ids], "removed": [old db rows], "changed": [old db rows]}
+        plus the likely duplicates found on the way (see Duplicates.py), compared within the
+        file and, when appending, against the existing rows:
+        {"duplicates": [{"id", "duplicateOf"}], "skipped": [ids]}
+        With duplicates="skip" they are left out, along with their sub-rows; with "keep"
+        they are only reported."""
+        if duplicates not in ("keep", "skip"):
+            raise ValueError(f"duplicates must be keep or skip, not {duplicates}")
         try:
-            # Read all transactions from CSV
-            with open(filepath, 'r', newline='') as csvfile:
-                reader = csv.DictReader(csvfile)
-                transactions = [self.dict_to_row(row) for row in reader]
-
-            # Create backup of current database
-            backup_db_path = f"{cfg.data_path}transactions_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-            with sqlite3.connect(self.db.db_path) as conn:
-                backup = sqlite3.connect(backup_db_path)
-                conn.backup(backup)
-                backup.close()
+            count = 0
+            # one write transaction: a failed import rolls back entirely
+            with self.db.conn.write() as conn, open(filepath, 'r', newline='') as csvfile:
+                conn.execute("DROP TABLE IF EXISTS temp.import_stage")
+                conn.execute(f"CREATE TEMP TABLE import_stage {TABLE_SCHEMA}")
+                detector = DuplicateDetector(() if clear_existing else conn.execute(
+                    "SELECT * FROM transactions WHERE parentId IS NULL"))
 
-            try:
-                with sqlite3.connect(self.db.db_path) as conn:
-                    if clear_existing:
-                        # Clear existing transactions
-                        print('dropping table')
-                        conn.execute("DROP TABLE IF EXISTS transactions")
-                        print('recreating table')
-                        self.db.init_db()
-
-                    # Insert new transactions
-                    for tx in transactions:
-                        print('insert id', tx.id)
-                        self.db.insert_transaction(tx)
-
-                print(
-                    f"Successfully imported {len(transactions)} transactions from {filepath}")
-
-            except Exception as e:
-                # Restore from backup if import fails
-                os.replace(backup_db_path, self.db.db_path)
-                raise Exception(
-                    f"Failed to import CSV, database restored from backup: {str(e)}")
-            return backup_db_path
+                # Stage new transactions, one executemany per chunk
+                rows = self.iter_db_rows(csv.DictReader(csvfile))
+                while chunk := list(islice(rows, chunk_size)):
+                    count += len(chunk)
+                    # each row is checked against every row before it
+                    kept = [row for row in chunk if detector.check(row) is None]
+                    self.db.insert_rows(
+                        kept if duplicates == "skip" else chunk, table="temp.import_stage")
+
+                skipped = [match["id"] for match in detector.matches] if duplicates == "skip" else []
+                if skipped:
+                    # sub-rows go with their parent, wherever they were in the file
+                    skipped += [row[0] for row in conn.execute("""
+                        DELETE FROM temp.import_stage
+                        WHERE parentId IN (SELECT value FROM json_each(?)) RETURNING id
+                    """, (json.dumps(skipped),)).fetchall()]
+
+                diff = self.apply_staged_rows(conn, clear_existing)
+                conn.execute("DROP TABLE temp.import_stage")
+            diff["duplicates"] = detector.matches
+            diff["skipped"] = skipped
+
+            log.info("imported csv", path=filepath, rows=count, added=len(diff["added"]),
+                     changed=len(diff["changed"]), removed=len(diff["removed"]),
+                     duplicates=len(diff["duplicates"]), skipped=len(skipped))
+            return diff
 
         except Exception as e:
-            print(traceback.format_exc())
-            raise Exception(f"Failed to import CSV: {str(e)}")
+            log.warning("csv import failed", path=filepath, exc_info=True)
+            raise Exception(f"Failed to import CSV, changes rolled back: {str(e)}")
+
+    def apply_staged_rows(self, conn: sqlite3.Connection, clear_existing: bool) -> dict:
+        """Make transactions match temp.import_stage (or append to it) and return the diff."""
+        removed, changed = [], []
+        if clear_existing:
+            removed = conn.execute("""
+                SELECT * FROM transactions t
+                WHERE NOT EXISTS (SELECT 1 FROM temp.import_stage s WHERE s.id = t.id)
+            """).fetchall()
+            differs = " OR ".join(f"t.{col} IS NOT s.{col}" for col in COLUMNS[1:])
+            changed = conn.execute(f"""
+                SELECT t.* FROM transactions t JOIN temp.import_stage s ON s.id = t.id
+                WHERE {differs}
+            """).fetchall()
+        added = [row[0] for row in conn.execute("""
+            SELECT id FROM temp.import_stage s
+            WHERE NOT EXISTS (SELECT 1 FROM transactions t WHERE t.id = s.id)
+        """).fetchall()]
+        if not clear_existing:
+            staged = conn.execute(
+                "SELECT COUNT(*) FROM temp.import_stage").fetchone()[0]
+            if len(added) < staged:
+                raise ValueError("CSV contains transactions that already exist")
+
+        self.db.delete_ids([row[0] for row in removed])
+        columns = ", ".join(COLUMNS[1:])
+        # one statement, see TransactionDB._staged
+        conn.execute(f"""
+            UPDATE transactions SET ({columns}) =
+                (SELECT {columns} FROM temp.import_stage s WHERE s.id = transactions.id)
+            WHERE id IN (SELECT value FROM json_each(?))
+        """, (json.dumps([row[0] for row in changed]),))
+        conn.execute("""
+            INSERT INTO transactions SELECT * FROM temp.import_stage s
+            WHERE NOT EXISTS (SELECT 1 FROM transactions t WHERE t.id = s.id)
+        """)
+        self.db.notify_changed(added + [row[0] for row in changed])
+        return {"added": added, "removed": removed, "changed": changed}
 
 
 # Usage example:
@@ -0,0 +1,545 @@
+import bisect
+import copy
+import math
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import cfg
+from serverType.RowType import RowType
+from components.TransactionDB import TransactionDB, json_encode
+from utils import currencies
+
+# Server-side port of the client's PNL compute:
+# - client/src/utils/tableDataUtils/compute/runCompute.ts (and the bridge/loan/reward handlers)
+# - client/src/types/CurComputeTypes.ts (CumCurCompute)
+# Results must match the client's "Full PNL" mode row for row, quirks included,
+# so keep both sides in sync when changing either.
+
+# positions in a raw database row (see TransactionDB.TABLE_SCHEMA)
+ID, PARENT_ID, DATE, ROW_TYPE = 0, 2, 3, 4
+IN_AMOUNT, IN_CURRENCY, OUT_AMOUNT, OUT_CURRENCY = 5, 6, 7, 8
+USD_VALUE, NETWORK = 11, 12
+
+# sortCurrency.ts
+PREFERRED = currencies.stable + ["BTC", "ETH", "SOL"]
+SKIPPED_ROW_TYPES = {RowType.ERROR.name, RowType.subERROR.name}
+
+
+class ComputeError(Exception):
+    pass
+
+
+def js_div(a: float, b: float) -> float:
+    """Division with javascript semantics (x/0 is +-Infinity or NaN)."""
+    if b == 0:
+        if a == 0 or math.isnan(a):
+            return math.nan
+        return math.copysign(math.inf, a) * math.copysign(1, b)
+    return a / b
+
+
+def finite(x: float) -> Optional[float]:
+    """NaN/Infinity are not valid json; the client would send them as null too.
+    Ints become floats, as pydantic would make them."""
+    return float(x) if math.isfinite(x) else None
+
+
+class CumCurCompute:
+    """Running totals for one currency, see CumCurCompute in CurComputeTypes.ts"""
+
+    def __init__(self, cur: str):
+        self.cur = cur
+        self.vSpent = 0  # value spent ($) ONLY used for avgPrice
+        self.aBought = 0  # amount bought; ONLY used for avgPrice
+        self.aSold = 0  # amount sold
+        self.vSold = 0  # value sold ($)
+        self.netBridged = 0  # amount bridged in - amount bridged out
+        self.ownedByNetwork: Dict[str, float] = {}
+        self.loansByNetwork: Dict[str, float] = {}
+        self.realizedPnl = 0
+        self.interestValue = 0  # positive, deducted against pnl
+        self.lostValue = 0  # positive, deducted against pnl
+        self.rollingSpent = 0
+        self.rollingBought = 0
+        self.isStable = cur in currencies.stable
+        self.lastPrice = self.avgPrice if self.isStable else 0
+
+    def copy(self) -> "CumCurCompute":
+        other = copy.copy(self)
+        other.ownedByNetwork = dict(self.ownedByNetwork)
+        other.loansByNetwork = dict(self.loansByNetwork)
+        return other
+
+    @property
+    def avgPrice(self) -> float:
+        if self.isStable:
+            return 1
+        return 0 if self.aBought == 0 else js_div(self.vSpent, self.aBought)
+
+    @property
+    def cumAmount(self) -> float:
+        return self.aBought - self.aSold + self.totalBorrowed + self.netBridged
+
+    @property
+    def netAmount(self) -> float:
+        # this is your total exposure to coin $ change
+        return self.aBought - self.aSold + self.netBridged
+
+    @property
+    def totalBorrowed(self) -> float:
+        return sum(self.loansByNetwork.values())
+
+    def cumPnl(self) -> float:
+        return self.realizedPnl - self.interestValue - self.lostValue
+
+    def addLastPrice(self, amount: float, value: float) -> None:
+        self.lastPrice = js_div(value, amount)
+
+    def addToNetwork(self, network: str, amount: float) -> None:
+        self.ownedByNetwork[network] = self.ownedByNetwork.get(
+            network, 0) + amount
+
+    def amountInNetwork(self, network: str) -> float:
+        return self.ownedByNetwork.get(network, 0) + self.loansByNetwork.get(network, 0)
+
+    def handleBridge(self, amount: float, network: str) -> None:
+        # amount > 0: bridge in; amount < 0: bridge out
+        self.netBridged += amount
+        self.addToNetwork(network, amount)
+
+    def handleBuy(self, amount: float, value: float, network: str) -> None:
+        self.addToNetwork(network, amount)
+        # skip stables
+        if self.isStable:
+            self.aBought += amount
+            return
+        self.addLastPrice(amount, value)
+        if amount < 0:
+            raise ComputeError("handleBuy: amount must be positive")
+        self.aBought += amount
+        self.vSpent += value
+        self.rollingBought += amount
+        self.rollingSpent += value
+
+    def handleSell(self, amount: float, value: float, network: str) -> float:
+        self.addToNetwork(network, -amount)
+        if amount < 0:
+            raise ComputeError("handleSell: amount must be positive")
+        # skip stables
+        if self.isStable:
+            self.aSold += amount
+            return 0
+        self.addLastPrice(amount, value)
+        self.aSold += amount
+        self.vSold += value
+        # realize PNL
+        buyPrice = js_div(self.rollingSpent, self.rollingBought)
+        sellPrice = js_div(value, amount)
+        pnl = (sellPrice - buyPrice) * amount
+        self.realizedPnl += pnl
+
+        # update rolling values
+        self.rollingBought -= amount
+        self.rollingSpent *= js_div(self.rollingBought,
+                                    self.rollingBought + amount)
+        return pnl
+
+    def handleExtra(self, amount: float, network: str) -> float:
+        """handle extra amount; return pnl of this"""
+        if amount > 0:
+            self.addToNetwork(network, amount)
+            # stable gains contribute to pnl
+            if self.isStable:
+                self.aBought += amount
+                self.realizedPnl += amount * self.avgPrice
+                return amount * self.avgPrice
+            self.handleBuy(amount, 0, network)
+            return 0
+        if amount < 0:
+            self.addToNetwork(network, -amount)
+            # all losses contribute to pnl
+            if self.isStable:
+                self.aSold -= amount
+                self.realizedPnl += amount * self.avgPrice  # should be negative
+                return amount * self.avgPrice
+            return self.handleSell(-amount, 0, network)
+        return 0
+
+    def handleBorrow(self, amount: float, network: str) -> None:
+        if amount < 0:
+            raise ComputeError("handleBorrow: amount must be positive")
+        self.loansByNetwork[network] = self.loansByNetwork.get(
+            network, 0) + amount
+
+    def handleRepay(self, amount: float, network: str) -> None:
+        if amount < 0:
+            raise ComputeError("handleRepay: amount must be positive")
+        # may go negative with mismatched data, same as the client
+        self.loansByNetwork[network] = self.loansByNetwork.get(
+            network, 0) - amount
+
+    def totals(self) -> dict:
+        return {
+            "avgPrice": finite(self.avgPrice),
+            "cumPnl": finite(self.cumPnl()),
+            "cumAmount": finite(self.cumAmount),
+            "netAmount": finite(self.netAmount),
+            "amountBorrowed": finite(self.totalBorrowed),
+            "lastPrice": finite(self.lastPrice),
+        }
+
+
+def row_result(cum: CumCurCompute, row: tuple, price: float = 0, pnl: float = 0) -> dict:
+    """RowCurCompute for one currency of a row, after the row was applied to `cum`."""
+    return {
+        "price": finite(price),
+        "avgPrice": finite(cum.avgPrice),
+        "pnl": finite(pnl),
+        "cumPnl": finite(cum.cumPnl()),
+        "cumAmount": finite(cum.cumAmount),
+        "netAmount": finite(cum.netAmount),
+        "amountInNetwork": finite(cum.amountInNetwork(row[NETWORK])),
+        "amountBorrowed": finite(cum.totalBorrowed),
+    }
+
+
+def calculate_row_cur(cur: str, row: tuple, cum: CumCurCompute) -> dict:
+    """calculateRowCurCompute: apply one row to the totals of `cur`."""
+    in_cur, out_cur, row_type = row[IN_CURRENCY], row[OUT_CURRENCY], row[ROW_TYPE]
+    network = row[NETWORK]
+    in_amount = row[IN_AMOUNT] or 0
+    out_amount = row[OUT_AMOUNT] or 0
+
+    def check(expected: str, actual: str):
+        if actual != cur:
+            raise ComputeError(
+                f"{expected} {actual} not {cur} in row {row[ID]}")
+
+    # note that direct gain/loss doesn't use usdValue! Do not reorder these initial checks
+    if in_cur == out_cur:
+        check("inCurrency", in_cur)
+        pnl = cum.handleExtra(in_amount - out_amount, network)
+        return row_result(cum, row, cum.avgPrice, pnl)
+    if row_type == RowType.BRIDGEIN.name:
+        check("inCurrency", in_cur)
+        cum.handleBridge(in_amount, network)
+        return row_result(cum, row, js_div(row[USD_VALUE] or 0, in_amount))
+    if row_type == RowType.BRIDGEOUT.name:
+        check("outCurrency", out_cur)
+        if out_amount < 0:
+            raise ComputeError("handleBridgeOut: amount must be positive")
+        cum.handleBridge(-out_amount, network)
+        return row_result(cum, row, js_div(row[USD_VALUE] or 0, out_amount))
+    if row_type == RowType.REWARD.name:
+        # a reward counts as a buy for $0
+        check("inCurrency", in_cur)
+        cum.handleBuy(in_amount, 0, network)
+        return row_result(cum, row)
+    if row_type in (RowType.LOSS.name, RowType.subINTEREST.name):
+        # a loss counts as a sell for $0, interest included
+        check("outCurrency", out_cur)
+        pnl = cum.handleSell(out_amount, 0, network)
+        return row_result(cum, row, js_div(row[USD_VALUE] or 0, out_amount), pnl)
+    if row_type == RowType.BORROW.name:
+        check("inCurrency", in_cur)
+        cum.handleBorrow(in_amount, network)
+        return row_result(cum, row)
+    if row_type in (RowType.REPAY.name, RowType.subPRINCIPLE.name):
+        if out_amount and out_cur == cur:
+            cum.handleRepay(out_amount, network)
+        return row_result(cum, row)
+
+    if row_type not in (RowType.TRADE.name, RowType.subREBUY.name):
+        raise ComputeError(f"rowType {row_type} not TRADE in row {row[ID]}")
+    if not row[USD_VALUE]:
+        return row_result(cum, row)  # effective skip
+
+    amount = 0
+    pnl = 0
+    if in_cur == cur:
+        amount = in_amount
+        cum.handleBuy(amount, row[USD_VALUE], network)
+    elif out_cur == cur:
+        amount = out_amount
+        pnl = cum.handleSell(amount, row[USD_VALUE], network)
+    if amount == 0:
+        return row_result(cum, row)  # effective skip
+    # value bought or sold, depending on this tx
+    price = abs(js_div(row[USD_VALUE], amount))
+    return row_result(cum, row, price, pnl)
+
+
+def sort_currency(a: str, b: str, a_amount, b_amount) -> float:
+    """sortCurrency.ts: which coin goes first in a transaction pair"""
+    a_index = PREFERRED.index(a) if a in PREFERRED else -1
+    b_index = PREFERRED.index(b) if b in PREFERRED else -1
+    amounts = isinstance(a_amount, (int, float)) and isinstance(
+        b_amount, (int, float))
+
+    if a_index == -1 and b_index == -1:
+        if amounts:
+            return a_amount - b_amount
+        return (a > b) - (a < b)
+    if a_index == -1:
+        return 1
+    if b_index == -1:
+        return -1
+    if a_index < b_index:
+        return -1
+    if a_index > b_index:
+        return 1
+    if amounts:
+        return a_amount - b_amount
+    return 0
+
+
+def row_currencies(row: tuple) -> List[str]:
+    """getCurrencies: the 0-2 currencies computed for a row, in display order."""
+    if row[ROW_TYPE] in SKIPPED_ROW_TYPES:
+        return []
+    in_cur, out_cur = row[IN_CURRENCY], row[OUT_CURRENCY]
+    if in_cur and out_cur and in_cur != out_cur:
+        # the order is reversed
+        if sort_currency(in_cur, out_cur, row[IN_AMOUNT], row[OUT_AMOUNT]) == 1:
+            return [in_cur, out_cur]
+        return [out_cur, in_cur]
+    if in_cur:
+        return [in_cur]
+    if out_cur:
+        return [out_cur]
+    return []
+
+
+class CurrencyLedger:
+    """The rows touching one currency, in table order, with checkpoints of its totals."""
+
+    def __init__(self, cur: str):
+        self.cur = cur
+        self.keys: List[tuple] = []
+        self.ids: List[str] = []
+        # (key of the first row after the checkpoint, totals before that row)
+        self.checkpoints: List[Tuple[tuple, CumCurCompute]] = []
+        self.totals = CumCurCompute(cur)
+
+    def insert(self, key: tuple, tx_id: str) -> None:
+        pos = bisect.bisect_left(self.keys, key)
+        self.keys.insert(pos, key)
+        self.ids.insert(pos, tx_id)
+
+    def remove(self, key: tuple) -> None:
+        pos = bisect.bisect_left(self.keys, key)
+        del self.keys[pos]
+        del self.ids[pos]
+
+
+class PnlEngine:
+    """Per-row, per-currency PNL for the whole ledger, kept up to date incrementally.
+
+    Every currency's totals only depend on the rows touching that currency, so each
+    currency is replayed on its own. While replaying, the totals are checkpointed at
+    date boundaries (about every `checkpoint_every` rows); after an edit only the
+    currencies of the edited rows are replayed, from the last checkpoint before them.
+    Changes are picked up lazily from TransactionDB.change_listeners on the next read.
+    """
+
+    def __init__(self, db: TransactionDB, checkpoint_every: int = cfg.compute_checkpoint_every):
+        self.db = db
+        self.checkpoint_every = checkpoint_every
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.dirty: Optional[Set[str]] = set()  # None: rebuild everything
+        self.rows: Dict[str, tuple] = {}
+        self.children: Dict[str, Set[str]] = {}
+        self.ledgers: Dict[str, CurrencyLedger] = {}
+        # row id -> RowCompute {"curs": [...], "curData": {cur: RowCurCompute}}
+        self.compute: Dict[str, dict] = {}
+        # get_json's body, until the next change
+        self.generation = 0
+        self.json: Optional[bytes] = None
+        db.change_listeners.append(self.mark_dirty)
+
+    def mark_dirty(self, ids: Optional[Set[str]]) -> None:
+        with self.lock:
+            self.generation += 1
+            self.json = None
+            if ids is None or self.dirty is None:
+                self.dirty = None
+            else:
+                self.dirty |= ids
+
+    def sort_key(self, row: tuple) -> tuple:
+        """Position of a row in the table, same order as _assignSortGroup in recomputeRows.ts:
+        parents by (date, id), each followed by its sub-rows by (date, id).
+        A sub-row whose parent is missing (or is itself a sub-row) sorts as a parent."""
+        parent = self.rows.get(row[PARENT_ID]) if row[PARENT_ID] is not None else None
+        if parent is None or parent[PARENT_ID] is not None:
+            return (row[DATE], row[ID], 0, "", "")
+        return (parent[DATE], parent[ID], 1, row[DATE], row[ID])
+
+    def refresh(self) -> None:
+        """Bring the results up to date with the database."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            try:
+                if dirty is None or not self.loaded:
+                    self._rebuild()
+                elif dirty:
+                    self._apply(dirty)
+            except Exception:
+                # start over on the next refresh
+                self.loaded = False
+                raise
+
+    def get_results(self) -> Dict[str, dict]:
+        """RowCompute for every computed row, by row id."""
+        self.refresh()
+        with self.lock:
+            # per-currency results are replaced, never mutated, so a shallow copy is a snapshot
+            return {tx_id: {"curs": compute["curs"], "curData": dict(compute["curData"])}
+                    for tx_id, compute in self.compute.items()}
+
+    def get_totals(self) -> Dict[str, dict]:
+        """Totals per currency at the end of the ledger."""
+        self.refresh()
+        with self.lock:
+            return {cur: ledger.totals.totals() for cur, ledger in self.ledgers.items()}
+
+    def get_json(self) -> bytes:
+        """ComputeResult of get_results and get_totals as json, the same bytes FastAPI
+        would send; encoded once per change to the ledger."""
+        with self.lock:
+            if self.json is not None:
+                return self.json
+            generation = self.generation
+        rows, totals = self.get_results(), self.get_totals()
+        body = json_encode({"rows": rows, "totals": totals}).encode("utf-8")
+        with self.lock:
+            # not if a change came in meanwhile: rows and totals may not match it
+            if generation == self.generation:
+                self.json = body
+        return body
+
+    def _rebuild(self) -> None:
+        with self.db.conn.read() as conn:
+            rows = conn.execute("SELECT * FROM transactions").fetchall()
+        self.rows = {row[ID]: row for row in rows}
+        self.children = {}
+        for row in rows:
+            if row[PARENT_ID] is not None:
+                self.children.setdefault(row[PARENT_ID], set()).add(row[ID])
+
+        self.ledgers = {}
+        self.compute = {}
+        keyed = sorted((self.sort_key(row), row) for row in rows)
+        for key, row in keyed:
+            curs = row_currencies(row)
+            if not curs:
+                continue
+            self.compute[row[ID]] = {"curs": curs, "curData": {}}
+            for cur in curs:
+                if cur not in self.ledgers:
+                    self.ledgers[cur] = CurrencyLedger(cur)
+                # rows come in key order, so appending keeps ledgers sorted
+                self.ledgers[cur].keys.append(key)
+                self.ledgers[cur].ids.append(row[ID])
+
+        for ledger in self.ledgers.values():
+            self._replay(ledger, None)
+        self.loaded = True
+
+    def _apply(self, dirty: Set[str]) -> None:
+        new_rows = {row[ID]: row for row in self.db.get_rows(dirty)}
+        # sub-rows are positioned by their parent, so they move with it
+        affected = set(dirty)
+        for tx_id in dirty:
+            affected |= self.children.get(tx_id, set())
+
+        earliest: Dict[str, tuple] = {}
+
+        def touch(cur: str, key: tuple):
+            if cur not in earliest or key < earliest[cur]:
+                earliest[cur] = key
+
+        # take affected rows out at their old position
+        for tx_id in affected:
+            row = self.rows.get(tx_id)
+            if row is None:
+                continue
+            key = self.sort_key(row)
+            for cur in row_currencies(row):
+                self.ledgers[cur].remove(key)
+                touch(cur, key)
+            self.compute.pop(tx_id, None)
+
+        # update rows and parent links
+        for tx_id in dirty:
+            old = self.rows.pop(tx_id, None)
+            if old is not None and old[PARENT_ID] is not None:
+                siblings = self.children[old[PARENT_ID]]
+                siblings.discard(tx_id)
+                if not siblings:
+                    del self.children[old[PARENT_ID]]
+            new = new_rows.get(tx_id)
+            if new is not None:
+                self.rows[tx_id] = new
+                if new[PARENT_ID] is not None:
+                    self.children.setdefault(
+                        new[PARENT_ID], set()).add(tx_id)
+
+        # put them back at their new position
+        for tx_id in affected:
+            row = self.rows.get(tx_id)
+            if row is None:
+                continue
+            curs = row_currencies(row)
+            if not curs:
+                continue
+            key = self.sort_key(row)
+            self.compute[tx_id] = {"curs": curs, "curData": {}}
+            for cur in curs:
+                if cur not in self.ledgers:
+                    self.ledgers[cur] = CurrencyLedger(cur)
+                self.ledgers[cur].insert(key, tx_id)
+                touch(cur, key)
+
+        for cur, key in earliest.items():
+            ledger = self.ledgers[cur]
+            if not ledger.keys:
+                del self.ledgers[cur]
+                continue
+            self._replay(ledger, key)
+
+    def _replay(self, ledger: CurrencyLedger, from_key: Optional[tuple]) -> None:
+        """Recompute a currency from the last checkpoint at or before `from_key`
+        (from the start if None)."""
+        checkpoints = ledger.checkpoints
+        if from_key is None:
+            keep = 0
+        else:
+            # a checkpoint only depends on the rows before its key
+            keep = bisect.bisect_right([key for key, _ in checkpoints], from_key)
+        del checkpoints[keep:]
+
+        if checkpoints:
+            start_key, saved = checkpoints[-1]
+            cum = saved.copy()
+            start = bisect.bisect_left(ledger.keys, start_key)
+        else:
+            cum = CumCurCompute(ledger.cur)
+            start = 0
+
+        cur = ledger.cur
+        since_checkpoint = 0
+        prev_date = ledger.keys[start - 1][0] if start else None
+        for pos in range(start, len(ledger.keys)):
+            key = ledger.keys[pos]
+            # checkpoint on the first row of a new date
+            if since_checkpoint >= self.checkpoint_every and key[0] != prev_date:
+                checkpoints.append((key, cum.copy()))
+                since_checkpoint = 0
+            tx_id = ledger.ids[pos]
+            self.compute[tx_id]["curData"][cur] = calculate_row_cur(
+                cur, self.rows[tx_id], cum)
+            since_checkpoint += 1
+            prev_date = key[0]
+        ledger.totals = cum
@@ -0,0 +1,72 @@
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Optional
+
+from components.RequestMetrics import active_jobs, request_frames
+
+# Opt-in sampling profiler: while a profile runs, every few ms it looks at what
+# each thread is executing and, if it works for a request, counts its stack under
+# that request's route. Threads work for a request when:
+# - they run one of its database jobs (RequestMetrics.active_jobs)
+# - their stack goes through its RequestMetrics middleware call (the event loop)
+# The result is in the folded format of flamegraph tools: one "route;frame;...;frame count"
+# line per distinct stack, root first.
+
+# plumbing frames (thread pools, event loop, web framework) left out of the stacks
+SKIPPED_FILES = ("/threading.py", "/concurrent/futures/", "/contextlib.py", "/asyncio/",
+                 "/starlette/", "/fastapi/")
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_qualname}"
+
+
+class Profiler:
+    """Runs one profile at a time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def busy(self) -> bool:
+        return self.lock.locked()
+
+    def profile(self, seconds: float, interval: float) -> Optional[str]:
+        """Sample every `interval` seconds for `seconds`; returns the folded stacks,
+        most sampled first, or None if another profile is running."""
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            me = threading.get_ident()
+            samples: Counter = Counter()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                for thread, frame in sys._current_frames().items():
+                    if thread != me:
+                        stack = self._stack(thread, frame)
+                        if stack is not None:
+                            samples[stack] += 1
+                time.sleep(interval)
+            return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+        finally:
+            self.lock.release()
+
+    @staticmethod
+    def _stack(thread: int, frame) -> Optional[str]:
+        """Folded stack of the request `thread` works for, or None if it is idle."""
+        stats = active_jobs.get(thread)
+        names: List[str] = []
+        while frame is not None:
+            if stats is None:
+                stats = request_frames.get(frame)
+                if stats is not None:
+                    break  # reached the middleware: the rest is server plumbing
+            if not any(skipped in frame.f_code.co_filename for skipped in SKIPPED_FILES):
+                names.append(_frame_name(frame))
+            frame = frame.f_back
+        if stats is None:
+            return None
+        names.append(stats.label)
+        return ";".join(reversed(names))
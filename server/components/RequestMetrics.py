@@ -0,0 +1,206 @@
+import bisect
+import contextvars
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from starlette.datastructures import MutableHeaders
+
+# Per-request instrumentation. The middleware puts a RequestStats in a contextvar,
+# which DBExecutor and WriteCoordinator carry over to the database threads, so:
+# - ConnectionManager's connections count the statements and rows of the request
+# - database jobs add the time they waited for a thread and the time they ran
+# Finished requests go into cumulative histograms per route, served by
+# GET /api/metrics in the Prometheus text format.
+
+PREFIX = "diablog_"
+DURATION_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+STATEMENT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100, 1000, 10000]
+ROW_BUCKETS = [0, 1, 10, 100, 1000, 10000, 100000, 1000000]
+
+
+class RequestStats:
+    """What one request did so far."""
+    __slots__ = ("scope", "start", "statements", "rows", "db_seconds", "queue_seconds")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.rows = 0  # read from and written to the database
+        self.db_seconds = 0.0  # running database jobs
+        self.queue_seconds = 0.0  # waiting for a database thread or the writer
+
+    @property
+    def route(self) -> str:
+        # the path template (e.g. /api/transactions/{transaction_id}), known once routed
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or "unmatched"
+
+    @property
+    def label(self) -> str:
+        return f"{self.scope['method']} {self.route}"
+
+    def server_timing(self) -> str:
+        """Server-Timing header value: total, database and queueing time in ms."""
+        return (f'app;dur={1000 * (time.perf_counter() - self.start):.1f}, '
+                f'db;dur={1000 * self.db_seconds:.1f};desc="{self.statements} statements, {self.rows} rows", '
+                f'queue;dur={1000 * self.queue_seconds:.1f}')
+
+
+request_stats: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "request_stats", default=None)
+
+# for Profiler, which attributes the threads' stacks to requests:
+# thread id -> stats of the request whose database job the thread is running
+active_jobs: Dict[int, RequestStats] = {}
+# frame of a request's RequestMetrics call -> its stats
+request_frames: Dict[object, RequestStats] = {}
+
+
+@contextmanager
+def db_job(context: contextvars.Context, submitted: float) -> Iterator[Optional[RequestStats]]:
+    """Account a database job run in `context`, queued since `submitted` (perf_counter):
+    adds its queueing and running time to the request's stats, and marks this thread
+    as working for that request while it runs."""
+    stats = context.get(request_stats)
+    if stats is None:
+        yield None
+        return
+    start = time.perf_counter()
+    stats.queue_seconds += start - submitted
+    thread = threading.get_ident()
+    active_jobs[thread] = stats
+    try:
+        yield stats
+    finally:
+        del active_jobs[thread]
+        stats.db_seconds += time.perf_counter() - start
+
+
+class Histogram:
+    """Cumulative Prometheus histogram of one label set."""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: str) -> Iterator[str]:
+        total = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            total += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {total}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+# name: (help, buckets, value of a finished request)
+HISTOGRAMS = {
+    "request_duration_seconds": ("Time to serve a request, up to its last body chunk",
+                                 DURATION_BUCKETS, lambda stats, seconds: seconds),
+    "request_db_seconds": ("Time a request's database jobs ran",
+                           DURATION_BUCKETS, lambda stats, seconds: stats.db_seconds),
+    "request_queue_seconds": ("Time a request waited for a database thread or the writer",
+                              DURATION_BUCKETS, lambda stats, seconds: stats.queue_seconds),
+    "request_sql_statements": ("SQL statements run for a request",
+                               STATEMENT_BUCKETS, lambda stats, seconds: stats.statements),
+    "request_sql_rows": ("Rows a request read from or wrote to the database",
+                         ROW_BUCKETS, lambda stats, seconds: stats.rows),
+}
+
+
+def _label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _snake(name: str) -> str:
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+class MetricsRegistry:
+    """Histograms and status counts of the finished requests, by (method, route)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms: Dict[Tuple[str, str], Dict[str, Histogram]] = {}
+        self.responses: Dict[Tuple[str, str, int], int] = {}
+
+    def observe(self, stats: RequestStats, status: int) -> None:
+        seconds = time.perf_counter() - stats.start
+        key = (stats.scope["method"], stats.route)
+        with self.lock:
+            histograms = self.histograms.get(key)
+            if histograms is None:
+                histograms = self.histograms[key] = {
+                    name: Histogram(buckets) for name, (_, buckets, _) in HISTOGRAMS.items()}
+            for name, (_, _, value) in HISTOGRAMS.items():
+                histograms[name].observe(value(stats, seconds))
+            self.responses[key + (status,)] = self.responses.get(key + (status,), 0) + 1
+
+    def render(self, gauges: Dict[str, dict]) -> str:
+        """Everything in the Prometheus text format; `gauges` are point-in-time values
+        by section (e.g. the sections of GET /api/status)."""
+        lines = []
+        with self.lock:
+            for name, (help_text, _, _) in HISTOGRAMS.items():
+                lines.append(f"# HELP {PREFIX}{name} {help_text}")
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for (method, route), histograms in sorted(self.histograms.items()):
+                    labels = f'method="{method}",route="{_label_value(route)}"'
+                    lines.extend(histograms[name].lines(PREFIX + name, labels))
+            lines.append(f"# HELP {PREFIX}responses_total Responses by status")
+            lines.append(f"# TYPE {PREFIX}responses_total counter")
+            for (method, route, status), count in sorted(self.responses.items()):
+                lines.append(f'{PREFIX}responses_total{{method="{method}",route="{_label_value(route)}",'
+                             f'status="{status}"}} {count}')
+        for section, values in gauges.items():
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    name = f"{PREFIX}{_snake(section)}_{_snake(key)}"
+                    lines.append(f"# TYPE {name} gauge")
+                    lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class RequestMetrics:
+    """ASGI middleware: times every http request, adds a Server-Timing header and
+    records the request in `registry` once its response is sent."""
+
+    def __init__(self, app, registry: MetricsRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(scope)
+        token = request_stats.set(stats)
+        frame = sys._getframe()
+        request_frames[frame] = stats
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append("Server-Timing", stats.server_timing())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_stats.reset(token)
+            del request_frames[frame]
+            self.registry.observe(stats, status)
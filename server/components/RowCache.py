@@ -0,0 +1,164 @@
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+
+from serverType.TransactionRow import TransactionRow
+
+
+class CachedRow:
+    """One raw database row, decoded/encoded on first use."""
+    __slots__ = ("rowid", "raw", "_model", "_json")
+
+    def __init__(self, rowid: int, raw: tuple):
+        self.rowid = rowid
+        self.raw = raw
+        self._model: Optional[TransactionRow] = None
+        self._json: Optional[bytes] = None
+
+    def model(self, db) -> TransactionRow:
+        if self._model is None:
+            self._model = db.row_to_transaction(self.raw)
+        return self._model
+
+    def json(self, db) -> bytes:
+        if self._json is None:
+            self._json = db.row_to_json(self.raw)
+        return self._json
+
+
+class RowCache:
+    """Decoded TransactionRows (and their json) by id, in front of TransactionDB's reads.
+
+    Rows are evicted by id from TransactionDB.change_listeners once a write commits.
+    After a full load the cache knows every row, so later full reads only fetch
+    the ids changed since. Reads inside a write bypass the cache, since they can
+    see rows that may still roll back.
+    Cached rows are shared between callers: treat them as read-only.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.rows: Dict[str, CachedRow] = {}
+        # every row of the table is in self.rows, except the stale ones
+        self.complete = False
+        self.stale: Set[str] = set()
+        # the whole table in table (rowid) order, and its encoded json
+        self.ordered: Optional[List[CachedRow]] = None
+        self.all_json: Optional[bytes] = None
+        # bumped on every invalidation; a read that raced one is not cached
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        db.change_listeners.append(self.invalidate)
+
+    def invalidate(self, ids: Optional[Set[str]]) -> None:
+        with self.lock:
+            self.generation += 1
+            self.ordered = None
+            self.all_json = None
+            if ids is None:
+                self.rows.clear()
+                self.stale.clear()
+                self.complete = False
+                return
+            for tx_id in ids:
+                self.rows.pop(tx_id, None)
+            if self.complete:
+                self.stale |= ids
+
+    def counters(self) -> dict:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.rows)}
+
+    def _fetch(self, ids: Optional[Iterable[str]]) -> Dict[str, CachedRow]:
+        """Rows for the given ids, or the whole table if None, in table order."""
+        with self.db.conn.read() as conn:
+            if ids is None:
+                rows = conn.execute(
+                    "SELECT rowid, * FROM transactions").fetchall()
+            else:
+                ids = list(ids)
+                rows = []
+                # stay under sqlite's bound parameter limit
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows.extend(conn.execute(
+                        f"SELECT rowid, * FROM transactions WHERE id IN ({placeholders})", chunk).fetchall())
+        return {row[1]: CachedRow(row[0], row[1:]) for row in rows}
+
+    def _get_ordered(self) -> List[CachedRow]:
+        """The whole table in table order, loading only what isn't cached."""
+        if self.db.conn.in_write():
+            return list(self._fetch(None).values())
+
+        with self.lock:
+            if self.ordered is not None:
+                self.hits += len(self.ordered)
+                return self.ordered
+            generation = self.generation
+            complete = self.complete
+            stale = set(self.stale)
+
+        fetched = self._fetch(stale if complete else None)
+
+        with self.lock:
+            if generation == self.generation:
+                if complete:
+                    self.stale -= stale
+                    self.hits += len(self.rows)
+                else:
+                    self.rows.clear()
+                    self.complete = True
+                self.misses += len(fetched)
+                self.rows.update(fetched)
+                self.ordered = sorted(
+                    self.rows.values(), key=lambda row: row.rowid)
+                return self.ordered
+        # a write committed while we were reading; serve it without caching
+        if not complete:
+            return list(fetched.values())
+        return list(self._fetch(None).values())
+
+    def get_all(self) -> List[TransactionRow]:
+        """Every row, in table order."""
+        return [row.model(self.db) for row in self._get_ordered()]
+
+    def get_all_json(self) -> bytes:
+        """Every row as a json array, the same bytes FastAPI sends for List[TransactionRow]."""
+        with self.lock:
+            if self.all_json is not None:
+                self.hits += len(self.ordered or [])
+                return self.all_json
+            generation = self.generation
+        ordered = self._get_ordered()
+        body = b"[" + b",".join(row.json(self.db) for row in ordered) + b"]"
+        with self.lock:
+            if generation == self.generation and not self.db.conn.in_write():
+                self.all_json = body
+        return body
+
+    def get(self, tx_id: str) -> Optional[TransactionRow]:
+        if self.db.conn.in_write():
+            fetched = self._fetch([tx_id])
+            return fetched[tx_id].model(self.db) if fetched else None
+
+        with self.lock:
+            cached = self.rows.get(tx_id)
+            if cached is not None:
+                self.hits += 1
+                return cached.model(self.db)
+            if self.complete and tx_id not in self.stale:
+                # known not to exist
+                self.hits += 1
+                return None
+            generation = self.generation
+
+        fetched = self._fetch([tx_id])
+
+        with self.lock:
+            self.misses += 1
+            if generation == self.generation:
+                self.rows.update(fetched)
+                self.stale.discard(tx_id)
+        return fetched[tx_id].model(self.db) if fetched else None
@@ -0,0 +1,128 @@
+import sqlite3
+from typing import List, Optional
+
+# Search structures over the transactions table, kept in sync by triggers so every
+# write path (single edits, batches, csv imports, undo/redo) maintains them:
+# - tags: one (tag, id) row per tag of a transaction, decoded from the json `tags`
+#   column; tags compare case-insensitively
+# - notes_fts: an FTS5 index over `note`. It is an external content table, so the
+#   notes themselves are only stored in transactions; rows are matched by rowid.
+
+SEARCH_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    tag TEXT NOT NULL COLLATE NOCASE,
+    id TEXT NOT NULL,
+    PRIMARY KEY (tag, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_tags_id ON tags(id);
+CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(
+    note, content='transactions', content_rowid='rowid'
+);
+"""
+
+# tags of row `{r}`; anything that isn't a json list (e.g. NULL) has none.
+# Repeated tags are left to INSERT OR IGNORE
+TAGS_OF = """
+    SELECT j.value, {r}.id FROM {source}json_each(
+        CASE WHEN json_valid({r}.tags) AND json_type({r}.tags) = 'array' THEN {r}.tags ELSE '[]' END) j
+    WHERE j.type = 'text' AND j.value != ''"""
+
+
+def _add(r: str) -> str:
+    return f"""
+    INSERT OR IGNORE INTO tags (tag, id) {TAGS_OF.format(r=r, source="")};"""
+
+
+# an external content index has to be told the exact old values to remove them,
+# so empty notes are never indexed (nor removed)
+def _add_note(r: str) -> str:
+    return f"""
+    INSERT INTO notes_fts (rowid, note) SELECT {r}.rowid, {r}.note
+    WHERE {r}.note IS NOT NULL AND {r}.note != '';"""
+
+
+def _remove_note(r: str) -> str:
+    return f"""
+    INSERT INTO notes_fts (notes_fts, rowid, note) SELECT 'delete', {r}.rowid, {r}.note
+    WHERE {r}.note IS NOT NULL AND {r}.note != '';"""
+
+
+# name: (event, condition, body)
+TRIGGERS = {
+    "search_insert": ("AFTER INSERT", "", _add("NEW") + _add_note("NEW")),
+    "search_delete": ("AFTER DELETE", "", """
+    DELETE FROM tags WHERE id = OLD.id;""" + _remove_note("OLD")),
+    "search_update_tags": ("AFTER UPDATE", "WHEN OLD.tags IS NOT NEW.tags OR OLD.id IS NOT NEW.id", """
+    DELETE FROM tags WHERE id = OLD.id;""" + _add("NEW")),
+    "search_update_note": ("AFTER UPDATE", "WHEN OLD.note IS NOT NEW.note OR OLD.rowid IS NOT NEW.rowid",
+                           _remove_note("OLD") + _add_note("NEW")),
+}
+
+
+def create_search_index(conn: sqlite3.Connection) -> None:
+    """Create the tag table, the notes index and their triggers, filling them if they
+    are new. Must run inside a write, after the transactions table exists."""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='tags'").fetchone()
+    # not executescript: it would commit the surrounding transaction
+    for stmt in SEARCH_SCHEMA.split(";"):
+        if stmt.strip():
+            conn.execute(stmt)
+    for name, (event, condition, body) in TRIGGERS.items():
+        # recreated every time, so databases pick up changes to the trigger bodies
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        conn.execute(f"""
+            CREATE TRIGGER {name} {event} ON transactions {condition}
+            BEGIN {body} END""")
+    if not exists:
+        rebuild_search_index(conn)
+
+
+def rebuild_search_index(conn: sqlite3.Connection) -> None:
+    """Recompute the tag table and the notes index from scratch."""
+    conn.execute("DELETE FROM tags")
+    conn.execute(
+        f"INSERT OR IGNORE INTO tags (tag, id) {TAGS_OF.format(r='t', source='transactions t, ')}")
+    # rebuild: reindex every note of the content table (empty ones are skipped)
+    conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('delete-all')")
+    conn.execute("""
+        INSERT INTO notes_fts (rowid, note) SELECT rowid, note FROM transactions
+        WHERE note IS NOT NULL AND note != ''""")
+
+
+def drop_search_index(conn: sqlite3.Connection) -> None:
+    conn.execute("DROP TABLE IF EXISTS tags")
+    conn.execute("DROP TABLE IF EXISTS notes_fts")
+
+
+def notes_match(text: str) -> str:
+    """FTS5 query matching notes that contain every word of `text`, as a word prefix.
+    Words are quoted, so input is never parsed as FTS5 query syntax."""
+    words = text.split()
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+def search(conn: sqlite3.Connection, text: Optional[str], tags: List[str], limit: int) -> List[str]:
+    """Ids of the rows whose note matches `text` (see notes_match) and that have every tag
+    in `tags`. Ordered by relevance when searching notes, else by (date, id)."""
+    where, params = [], []
+    if text is not None and text.split():
+        where.append("notes_fts MATCH ?")
+        params.append(notes_match(text))
+        source = "notes_fts JOIN transactions t ON t.rowid = notes_fts.rowid"
+        order = "notes_fts.rank, t.date, t.id"
+    elif tags:
+        # start from the rows of the first tag
+        where.append("g.tag = ?")
+        params.append(tags[0])
+        tags = tags[1:]
+        source = "tags g JOIN transactions t ON t.id = g.id"
+        order = "t.date, t.id"
+    for tag in tags:
+        where.append("t.id IN (SELECT id FROM tags WHERE tag = ?)")
+        params.append(tag)
+    if not where:
+        return []
+    return [row[0] for row in conn.execute(
+        f"SELECT t.id FROM {source} WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ?",
+        params + [limit]).fetchall()]
@@ -1,20 +1,43 @@
-from typing import List, Optional
-from fastapi import HTTPException, status, UploadFile
-import traceback
-import datetime
+from typing import TYPE_CHECKING, List, Optional, Tuple
+from fastapi import HTTPException, status, UploadFile, Response
+import os
+import tempfile
+import base64
+import json
 
 import cfg
-from components.TransactionDB import TransactionDB
-from components.History import History
+from components.Log import get_logger
+from components.TransactionDB import TransactionDB, json_encode
+from components.History import History, merge_deltas
 from components.ManageCSV import ManageCSV
+from components.PnlEngine import PnlEngine, ComputeError
+from components.ChangeFeed import ChangeFeed
+from components.DBExecutor import DBExecutor
+from components.WriteCoordinator import WriteCoordinator
 from serverType.TransactionRow import TransactionRow
+from serverType.RowType import RowType
+from serverType.api_types import TransactionUpdate, TransactionPage, TransactionQuery, QueryPlan, SearchResult, CsvImportResult, HistoryDelta, ComputeTotals, PortfolioStats
 from data.demo_tx import demo_tx
 
+if TYPE_CHECKING:
+    # imported where first used: it brings in numpy, which startup doesn't need
+    from components.TransactionTable import TransactionTable
+
+log = get_logger("api")
+
 
 class TransactionAPI:
     def __init__(self):
         self.db = TransactionDB()
         self.history = History(self.db)
+        self.pnl = PnlEngine(self.db)
+        # columnar copy of the table, reloaded when the ledger version moves
+        self.table: Optional["TransactionTable"] = None
+        self.changes = ChangeFeed(self.db)
+        # async callers run the blocking methods below through this
+        self.executor = DBExecutor()
+        # ...and every write through this, which commits them in groups
+        self.writer = WriteCoordinator(self.db.conn)
         # self.tx_list: List[TransactionRow] = []
         self.initialize()
 
@@ -25,40 +48,100 @@ class TransactionAPI:
         # If DB is empty, it will be populated with demo_transactions
         self.db.on_init(demo_tx)
 
+    def warm_up(self) -> None:
+        """Decode and encode the whole table ahead of the first GET /api/transactions,
+        which every client starts with. Startup doesn't wait for this."""
+        self.db.get_all_transactions_json()
+
+    def close(self) -> None:
+        """Finish the queued writes and running jobs, then close the database."""
+        self.writer.shutdown()
+        self.executor.shutdown()
+        self.db.conn.close()
+
     def add_transaction(self, transaction: TransactionRow) -> TransactionRow:
         """Add a new transaction to both in-memory list and database."""
         try:
-            self.history.new_add(transaction)
-            self.db.insert_transaction(transaction)
+            # history entry and change commit together
+            with self.db.conn.write():
+                self.history.new_add(transaction)
+                self.db.insert_transaction(transaction)
             return transaction
         except Exception as e:
-            print(
-                f'Error in add_transaction: {transaction}. Full traceback: {traceback.format_exc()}')
+            log.exception("add_transaction failed", id=transaction.id)
             raise HTTPException(
                 status_code=500, detail=f"Failed to add transaction: {str(e)}")
 
     def update_transaction(self, updated_tx: TransactionRow) -> TransactionRow:
         """Update transaction in both in-memory list and database."""
         try:
-            self.history.new_update(updated_tx)
-            self.db.update_transaction(updated_tx)
+            # history entry and change commit together
+            with self.db.conn.write():
+                self.history.new_update(updated_tx)
+                self.db.update_transaction(updated_tx)
             return updated_tx
         except Exception as e:
-            print(
-                f'Error in update_transaction: {updated_tx}. Full traceback: {traceback.format_exc()}')
+            log.exception("update_transaction failed", id=updated_tx.id)
             raise HTTPException(
                 status_code=500, detail=f"Failed to update transaction: {str(e)}")
 
     def delete_transaction(self, deleted_tx: TransactionRow) -> TransactionRow:
         """Delete transaction from both in-memory list and database."""
         try:
+            # deletes the row and its sub-rows, recorded in the same transaction
             self.history.new_delete(deleted_tx)
-            self.db.delete_transaction(deleted_tx)
             return deleted_tx
         except Exception as e:
             raise HTTPException(
                 status_code=500, detail=f"Failed to delete transaction: {str(e)}")
 
+    def apply_batch(self, updates: List[TransactionUpdate]) -> HistoryDelta:
+        """Apply update/delete/finalize operations in order, all or nothing.
+        They are recorded as a single history entry; returns the delta of the whole batch."""
+        steps = []
+        deltas = []
+        try:
+            with self.db.conn.write():
+                for i, update in enumerate(updates):
+                    tx = update.row
+                    try:
+                        # each step's undo data is read right before it is applied,
+                        # so it sees the earlier steps of the batch
+                        if update.operation == "finalize":
+                            steps.append(self.history.make_add(tx))
+                            self.db.insert_transaction(tx)
+                            deltas.append(HistoryDelta(inserted=[tx]))
+                        elif update.operation == "update":
+                            steps.append(self.history.make_update(tx))
+                            self.db.update_transaction(tx)
+                            deltas.append(HistoryDelta(updated=[tx]))
+                        elif update.operation == "delete":
+                            step = self.history.apply_delete(tx)
+                            steps.append(step)
+                            deltas.append(HistoryDelta(
+                                deleted=[row[0] for row in step.undo_data["rows"]]))
+                    except Exception as e:
+                        raise Exception(
+                            f"operation {i} ({update.operation} {tx.id}): {str(e)}") from e
+                if steps:
+                    self.history.new_batch(steps)
+        except Exception as e:
+            log.exception("apply_batch failed", operations=len(updates))
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed to apply batch, nothing was changed: {str(e)}")
+        return merge_deltas(deltas)
+
+    def move_transaction(self, tx_id: str, parent_id: Optional[str]) -> HistoryDelta:
+        """Move a row and its sub-rows under another parent (or to the top level if None)
+        as one undo step; returns the moved rows."""
+        try:
+            rows = self.history.new_move(tx_id, parent_id)
+        except Exception as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=f"Failed to move transaction: {str(e)}")
+        return HistoryDelta(updated=[self.db.row_to_transaction(row) for row in rows])
+
     def get_transaction(self, tx_id: str) -> Optional[TransactionRow]:
         """Get a transaction by ID from in-memory list."""
         tx = self.db.get_transaction(tx_id)
@@ -73,22 +156,134 @@ class TransactionAPI:
         """Get all transactions from in-memory list."""
         return self.db.get_all_transactions()
 
-    async def ingest_csv(self, file: UploadFile):
-        # save uploaded file
-        print('ingeststep1')
-        new_csv_path = f"{cfg.data_path}temp_upload_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        with open(new_csv_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
-        print('ingeststep2')
+    def get_all_transactions_response(self, if_none_match: Optional[str] = None) -> Response:
+        """All transactions as a ready-made json response, tagged with the ledger version.
+        Same bytes as returning get_all_transactions() with response_model=List[TransactionRow],
+        without validating and re-encoding every row.
+        Answers 304 if the client's If-None-Match already has this version."""
+        # read before the table, so the tag is never newer than the body
+        etag = f'"{self.db.get_version()}"'
+        # no-cache: browsers may keep the body, but must revalidate it every time
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if if_none_match and etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(",")):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(content=self.db.get_all_transactions_json(), media_type="application/json", headers=headers)
+
+    def get_transactions_page(self, limit: int, cursor: Optional[str] = None) -> TransactionPage:
+        """Get one page of transactions; parents always arrive with their sub-rows."""
+        rows, next_key = self.db.get_transactions_page(
+            limit, self._decode_cursor(cursor))
+        return TransactionPage(rows=rows, nextCursor=self._encode_cursor(next_key))
+
+    def query_transactions(self, query: TransactionQuery, limit: int,
+                           cursor: Optional[str] = None) -> TransactionPage:
+        """One page of the rows matching `query`, in (date, id) order."""
+        rows, next_key = self.db.query_transactions(
+            self._resolve_query(query), limit, self._decode_cursor(cursor))
+        return TransactionPage(rows=rows, nextCursor=self._encode_cursor(next_key))
+
+    def explain_query(self, query: TransactionQuery, limit: int, cursor: Optional[str] = None) -> QueryPlan:
+        """The plan and timing of query_transactions for the same arguments."""
+        return QueryPlan(**self.db.explain_query(
+            self._resolve_query(query), limit, self._decode_cursor(cursor)))
+
+    def search(self, text: Optional[str], tags: List[str], limit: int) -> SearchResult:
+        """Rows whose note contains every word of `text` (as a word prefix) and that have every tag."""
+        return SearchResult(ids=self.db.search(text, tags, limit))
+
+    def _resolve_query(self, query: TransactionQuery) -> TransactionQuery:
+        # rowType filters may use names or display values; the database stores names
+        names = []
+        for row_type in query.rowType:
+            if row_type in RowType.__members__:
+                names.append(row_type)
+                continue
+            try:
+                names.append(RowType(row_type).name)
+            except ValueError:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Unknown rowType: {row_type}")
+        return query.model_copy(update={"rowType": names})
+
+    def _decode_cursor(self, cursor: Optional[str]) -> Optional[Tuple[str, str]]:
+        """(date, id) key of a page cursor."""
+        if not cursor:
+            return None
+        try:
+            date, tx_id = json.loads(base64.urlsafe_b64decode(cursor))
+            return (str(date), str(tx_id))
+        except Exception:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid cursor: {cursor}")
+
+    def _encode_cursor(self, key: Optional[Tuple[str, str]]) -> Optional[str]:
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode() if key else None
 
+    def get_compute_response(self) -> Response:
+        """Per-row, per-currency PNL (ComputeResult) as a ready-made json response;
+        only rows changed since the last call are recomputed, and the body is only
+        re-encoded after a change."""
+        try:
+            body = self.pnl.get_json()
+        except ComputeError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed to compute: {str(e)}")
+        return Response(content=body, media_type="application/json")
+
+    def get_totals(self) -> ComputeTotals:
+        """Per-currency totals only, computed column-wise over the whole table; cheaper
+        than get_compute_response when the per-row results aren't needed."""
+        from components.TransactionTable import TransactionTable
+        table = self.table
+        if table is None or table.version != self.db.get_version():
+            table = self.table = TransactionTable.from_db(self.db)
+        try:
+            return ComputeTotals(totals=table.totals())
+        except ComputeError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Failed to compute: {str(e)}")
+
+    def get_stats(self) -> PortfolioStats:
+        """Holdings, borrows and last trade prices per currency."""
+        return PortfolioStats(**self.db.get_stats())
+
+    async def ingest_csv(self, file: UploadFile, duplicates: str = "keep") -> dict:
+        # save uploaded file, under a unique name: uploads can overlap
+        fd, new_csv_path = tempfile.mkstemp(dir=cfg.data_path, prefix="temp_upload_", suffix=".csv")
+        try:
+            with os.fdopen(fd, "wb") as buffer:
+                # copy in chunks rather than reading the whole upload into memory
+                while chunk := await file.read(1024 * 1024):
+                    buffer.write(chunk)
+            log.debug("saved upload", path=new_csv_path, filename=file.filename)
+            return await self.writer.run(self.import_csv, new_csv_path, duplicates)
+        finally:
+            # history journals the imported rows, not the file
+            os.remove(new_csv_path)
+
+    def import_csv(self, csv_path: str, duplicates: str = "keep") -> dict:
+        """Replace the table with a csv file, as one undoable step.
+        Likely duplicates are reported, or skipped with duplicates="skip"."""
         csv_plugin = ManageCSV(self.db)
-        backup_db_path = csv_plugin.populate_from_csv(
-            new_csv_path, clear_existing=True)
-        print('ingeststep3')
-        self.history.new_csv_rewrite(backup_db_path, new_csv_path)
+        with self.db.conn.write():
+            diff = csv_plugin.populate_from_csv(
+                csv_path, clear_existing=True, duplicates=duplicates)
+            self.history.new_csv_rewrite(diff)
+
+        return diff
 
-        return backup_db_path
+    def import_response(self, diff: dict) -> Response:
+        """CsvImportResult as json for a diff of import_csv, with the whole table
+        spliced in from the row cache"""
+        head = json_encode(CsvImportResult(
+            duplicates=diff["duplicates"], skipped=diff["skipped"], table=[]
+        ).model_dump(mode="json", exclude={"table"})).encode("utf-8")
+        table = self.db.get_all_transactions_json()
+        return Response(content=head[:-1] + b',"table":' + table + b"}", media_type="application/json")
 
     def get_undo_redo(self):
         undo, redo = self.history.get_actions()
@@ -97,29 +292,52 @@ class TransactionAPI:
             "redo": redo
         }
 
-    def undo(self) -> bool:
-        # for now, return entire table after these transactions
-        # if needed later can make more efficient
+    async def get_changes(self, since: int, timeout: float) -> Response:
+        """Rows changed after ledger version `since`, as {version, undo, redo, **delta}.
+        Waits up to `timeout` seconds for a change if there is none yet (long-poll).
+        Clients that are too far behind get the whole table instead."""
+        await self.changes.wait(since, timeout)
+        return await self.executor.run(self._changes_response, since)
 
-        self.history.undo()
-        undo, redo = self.history.get_actions()
-        table = self.db.get_all_transactions()
-        return {
-            "undo": undo,
-            "redo": redo,
-            "table": table
-        }
+    def _changes_response(self, since: int) -> Response:
+        version, reset, rows, deleted = self.db.get_changes(since)
+        if reset:
+            delta = HistoryDelta(tableChanged=True)
+        else:
+            delta = HistoryDelta(
+                updated=[self.db.row_to_transaction(row) for row in rows], deleted=deleted)
+        return self.history_response(delta, {"version": version})
 
-    def redo(self) -> bool:
-        self.history.redo()
+    def history_response(self, delta: HistoryDelta, extra: Optional[dict] = None) -> Response:
+        """{**extra, undo, redo, **delta} as json, with the whole table spliced in from the
+        row cache when the operation rewrote it"""
         undo, redo = self.history.get_actions()
-        table = self.db.get_all_transactions()
-        print('redo transactions:', table)
-        return {
+        head = json_encode({
+            **(extra or {}),
             "undo": undo,
             "redo": redo,
-            "table": table
-        }
+            **delta.model_dump(mode="json", exclude={"table"}),
+        }).encode("utf-8")
+        if delta.tableChanged:
+            table = self.db.get_all_transactions_json()
+        else:
+            table = json_encode(delta.model_dump(
+                mode="json", include={"table"})["table"]).encode("utf-8")
+        return Response(content=head[:-1] + b',"table":' + table + b"}", media_type="application/json")
+
+    def undo(self) -> HistoryDelta:
+        # only the rows touched by the undo are sent back (see history_response),
+        # csv rewrites included
+        return self.history.undo()
+
+    def redo(self) -> HistoryDelta:
+        return self.history.redo()
+
+    async def write_and_respond(self, fn, *args) -> Response:
+        """Run a history-changing write through the writer, then build its
+        {undo, redo, **delta} response on a reader once it has committed."""
+        delta = await self.writer.run(fn, *args)
+        return await self.executor.run(self.history_response, delta)
 
 
 # FastAPI route handlers in main
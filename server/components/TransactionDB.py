@@ -1,58 +1,219 @@
 import sqlite3
-from typing import List, Optional, Tuple
-from dataclasses import asdict
-import os
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional, Set, Tuple
 import json
+import time
 
 from serverType.TransactionRow import TransactionRow
 from serverType.RowType import RowType
-from utils.txId import newTxId
+from serverType.api_types import TransactionQuery
+from components.ConnectionManager import ConnectionManager
+from components import Holdings
+from components import SearchIndex
+from components.RowCache import RowCache
+from components.Log import get_logger
+
+log = get_logger("db")
 
 # Every TransactionRow schema change:
 # Update the functions
-# - init_db
+# - TABLE_SCHEMA
 # - row_to_transaction
+# - row_to_json
 # - insert_transaction
 # - insert_batch
 # - update_transaction
-# Can go to repop_csv to regenerate, after updating:
+# Can go to repop_csv to regenerate (it recreates the table), after updating:
 # - ManageCSV.dict_to_row
 # - ManageCSV.row_to_dict
 # To fill with demo transactions, update:
 # - delete data/transactions.db to clear db
 # - update server/data/demo_tx.py with new fields
 
+# column order here is the order of every raw database row tuple
+TABLE_SCHEMA = """(
+    id TEXT PRIMARY KEY,
+    isSubRow BOOLEAN NOT NULL,
+    parentId TEXT,
+    date TEXT,
+    rowType TEXT NOT NULL,
+    inAmount REAL,
+    inCurrency TEXT,
+    outAmount REAL,
+    outCurrency TEXT,
+    feeAmount REAL,
+    feeCurrency TEXT,
+    usdValue REAL,
+    network TEXT,
+    tags TEXT,
+    note TEXT
+)"""
+COLUMNS = [line.split()[0] for line in TABLE_SCHEMA.strip("()\n").split(",\n")]
+
+# query_transactions filters on each of these columns through its own index, on
+# (column, date, id): an equality filter plus a date range is one index range,
+# already in result order
+QUERY_INDEXES = {
+    "idx_in_currency": "inCurrency",
+    "idx_out_currency": "outCurrency",
+    "idx_network": "network",
+    "idx_row_type": "rowType",
+    "idx_sub_row": "isSubRow",
+}
+
+ROW_TYPE_VALUES = {row_type.name: row_type.value for row_type in RowType}
+# same settings as starlette's JSONResponse, so row_to_json matches FastAPI byte for byte
+json_encode = json.JSONEncoder(
+    ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode
+
+
+def _float(value):
+    # pydantic turns ints into floats for float fields
+    return float(value) if isinstance(value, int) else value
+
 
 class TransactionDB:
     def __init__(self, db_path: str = "data/transactions.db"):
         self.db_path = db_path
+        self.conn = ConnectionManager(db_path)
+        # called with the set of changed ids (None: whole table) after each commit
+        self.change_listeners: List[Callable[[Optional[Set[str]]], None]] = []
+        # decoded rows by id, evicted on commit through change_listeners
+        self.cache = RowCache(self)
         self.init_db()
 
+    def notify_changed(self, ids: Optional[Iterable[str]]) -> None:
+        """Record a change to the ledger: bumps the ledger version, logs the changed ids
+        for get_changes, and tells change_listeners once the current write commits.
+        Every method writing to the transactions table must call this."""
+        changed = None if ids is None else set(ids)
+        if changed is not None and not changed:
+            return
+        with self.conn.write() as conn:
+            version = self.get_version() + 1
+            self.set_meta("ledger_version", version)
+            if changed is None:
+                # clients older than this must reload the whole table
+                conn.execute("DELETE FROM changelog")
+                self.set_meta("ledger_reset_version", version)
+            else:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO changelog (id, version) VALUES (?, ?)",
+                    [(tx_id, version) for tx_id in changed])
+
+        def notify():
+            # each listener on its own: one failing must not leave the others stale
+            for listener in self.change_listeners:
+                try:
+                    listener(changed)
+                except Exception:
+                    log.exception("change listener failed", listener=repr(listener))
+        self.conn.after_commit(notify)
+
+    def get_version(self) -> int:
+        """Ledger version; increases with every committed change to the transactions table."""
+        return self.get_meta("ledger_version", 0)
+
+    def get_columns(self, columns: List[str]) -> Tuple[int, List[tuple]]:
+        """The given columns of every row, in table (rowid) order, with the ledger
+        version they were read at."""
+        with self.conn.snapshot() as conn:
+            version = self._meta(conn, "ledger_version", 0)
+            rows = conn.execute(
+                f"SELECT {', '.join(columns)} FROM transactions").fetchall()
+        return version, rows
+
+    def get_changes(self, since: int) -> Tuple[int, bool, List[tuple], List[str]]:
+        """Changes after ledger version `since`, read from one snapshot.
+        Returns (version, reset, changed rows, deleted ids); on reset (the table was
+        recreated since), the caller must reload everything and the rows are empty."""
+        with self.conn.snapshot() as conn:
+            version = self._meta(conn, "ledger_version", 0)
+            if since < self._meta(conn, "ledger_reset_version", 0):
+                return version, True, [], []
+            ids = [row[0] for row in conn.execute(
+                "SELECT id FROM changelog WHERE version>?", (since,)).fetchall()]
+            rows = []
+            # stay under sqlite's bound parameter limit
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(conn.execute(
+                    f"SELECT * FROM transactions WHERE id IN ({placeholders})", chunk).fetchall())
+        found = {row[0] for row in rows}
+        return version, False, rows, [tx_id for tx_id in ids if tx_id not in found]
+
     def init_db(self):
         """Initialize the database with the transactions table."""
-        with sqlite3.connect(self.db_path) as conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id TEXT PRIMARY KEY,
-                    isSubRow BOOLEAN NOT NULL,
-                    parentId TEXT,
-                    date TEXT,
-                    rowType TEXT NOT NULL,
-                    inAmount REAL,
-                    inCurrency TEXT,
-                    outAmount REAL,
-                    outCurrency TEXT,
-                    feeAmount REAL,
-                    feeCurrency TEXT,
-                    usdValue REAL,
-                    network TEXT,
-                    tags TEXT,
-                    note TEXT
-                )
-            """)
-            # Create index for faster lookups
+        with self.conn.write() as conn:
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS transactions {TABLE_SCHEMA}")
+            # rows are ordered by (date, id) everywhere (pages, latest prices in Holdings);
+            # replaces the old date-only idx_date, which still needed a sort for the id
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_date_id ON transactions(date, id)")
+            conn.execute("DROP INDEX IF EXISTS idx_date")
+            for name, column in QUERY_INDEXES.items():
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS {name} ON transactions({column}, date, id)")
+            # partial price indexes, superseded by idx_in_currency/idx_out_currency
+            conn.execute("DROP INDEX IF EXISTS idx_price_in")
+            conn.execute("DROP INDEX IF EXISTS idx_price_out")
+            # sub-rows are always looked up by their parent
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_parent ON transactions(parentId)")
+            # small key/value store for server state (e.g. history position)
             conn.execute(
-                "CREATE INDEX IF NOT EXISTS idx_date ON transactions(date)")
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+            # last ledger version each row changed at, see notify_changed
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS changelog (id TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_changelog_version ON changelog(version)")
+            # portfolio totals, maintained by triggers on every write
+            Holdings.create_holdings(conn)
+            # tag table and full-text index over notes, also maintained by triggers
+            SearchIndex.create_search_index(conn)
+
+    def get_meta(self, key: str, default=None):
+        with self.conn.read() as conn:
+            return self._meta(conn, key, default)
+
+    def _meta(self, conn: sqlite3.Connection, key: str, default=None):
+        row = conn.execute(
+            "SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key: str, value) -> None:
+        with self.conn.write() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def recreate_table(self):
+        """Drop and recreate the transactions table, e.g. after a schema change.
+        All rows are lost."""
+        with self.conn.write() as conn:
+            conn.execute("DROP TABLE IF EXISTS transactions")
+            conn.execute("DROP TABLE IF EXISTS holdings")
+            conn.execute("DROP TABLE IF EXISTS last_prices")
+            SearchIndex.drop_search_index(conn)
+            self.init_db()
+            self.notify_changed(None)
+
+    def get_stats(self) -> dict:
+        """Portfolio totals per currency, read from the materialized holdings tables."""
+        with self.conn.read() as conn:
+            return Holdings.get_stats(conn)
+
+    def rebuild_stats(self) -> None:
+        """Recompute the holdings tables from the transactions table."""
+        with self.conn.write() as conn:
+            Holdings.rebuild_holdings(conn)
+
+    def search(self, text: Optional[str], tags: List[str], limit: int) -> List[str]:
+        """Ids of the rows whose note contains the words of `text` and that have every tag in `tags`."""
+        with self.conn.read() as conn:
+            return SearchIndex.search(conn, text, tags, limit)
 
     def row_to_transaction(self, row: tuple) -> TransactionRow:
         """Convert a database row to a TransactionRow object."""
@@ -74,9 +235,39 @@ class TransactionDB:
             note=row[14],
         )
 
+    def row_to_json(self, row: tuple) -> bytes:
+        """Encode a database row exactly as FastAPI encodes the matching TransactionRow,
+        without building the model. Keys follow the field order of TransactionRow."""
+        return json_encode({
+            "id": row[0],
+            "parentId": row[2],
+            "isSubRow": bool(row[1]),
+            "date": row[3],
+            "rowType": ROW_TYPE_VALUES[row[4]],
+            "inAmount": _float(row[5]),
+            "inCurrency": row[6],
+            "outAmount": _float(row[7]),
+            "outCurrency": row[8],
+            "feeAmount": _float(row[9]),
+            "feeCurrency": row[10],
+            "usdValue": _float(row[11]),
+            "network": row[12],
+            "tags": json.loads(row[13]) if row[13] else [],
+            "note": row[14],
+        }).encode("utf-8")
+
+    def transaction_to_row(self, tx: TransactionRow) -> tuple:
+        """Convert a TransactionRow object to a database row."""
+        return (
+            tx.id, tx.isSubRow, tx.parentId, tx.date, tx.rowType.name,
+            tx.inAmount, tx.inCurrency, tx.outAmount, tx.outCurrency,
+            tx.feeAmount, tx.feeCurrency, tx.usdValue, tx.network, json.dumps(
+                tx.tags), tx.note,
+        )
+
     def insert_transaction(self, tx: TransactionRow) -> None:
         """Insert a new transaction."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.conn.write() as conn:
             # check if id exists; raise error if it does
             cursor = conn.execute(
                 "SELECT COUNT(*) FROM transactions WHERE id=?", (tx.id,))
@@ -87,27 +278,65 @@ class TransactionDB:
             conn.execute("""
                 INSERT INTO transactions VALUES 
                 (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """, (
-                tx.id, tx.isSubRow, tx.parentId, tx.date, tx.rowType.name,
-                tx.inAmount, tx.inCurrency, tx.outAmount, tx.outCurrency,
-                tx.feeAmount, tx.feeCurrency, tx.usdValue, tx.network, json.dumps(
-                    tx.tags), tx.note,
-            ))
+            """, self.transaction_to_row(tx))
+            self.notify_changed([tx.id])
 
     def insert_batch(self, txs: List[TransactionRow]) -> None:
         """Insert a new transaction."""
-        with sqlite3.connect(self.db_path) as conn:
-            # insert transaction
-            conn.executemany("""
-                INSERT INTO transactions VALUES 
-                (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-            """, [(tx.id, tx.isSubRow, tx.parentId, tx.date, tx.rowType.name,
-                   tx.inAmount, tx.inCurrency, tx.outAmount, tx.outCurrency,
-                   tx.feeAmount, tx.feeCurrency, tx.usdValue, tx.network, json.dumps(tx.tags), tx.note,) for tx in txs])
+        self.insert_rows([self.transaction_to_row(tx) for tx in txs])
+
+    # Bulk writes to transactions are single statements. Its triggers make every
+    # statement keep a statement journal, and inside a savepoint (a nested write())
+    # that journal is only released with the savepoint: an executemany of n rows
+    # there costs O(n^2). Rows go through temp.write_stage, ids through json_each.
+
+    @contextmanager
+    def _staged(self, conn: sqlite3.Connection, rows: List[tuple]) -> Iterator[None]:
+        """Hold raw database rows in temp.write_stage for the duration of the block."""
+        conn.execute(f"CREATE TEMP TABLE IF NOT EXISTS write_stage {TABLE_SCHEMA}")
+        try:
+            conn.executemany(
+                "INSERT INTO temp.write_stage VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+            yield
+        finally:
+            conn.execute("DELETE FROM temp.write_stage")
+
+    def insert_rows(self, rows: List[tuple], table: str = "transactions") -> None:
+        """Insert raw database rows (column order as in TABLE_SCHEMA), in order.
+        Fails on duplicate ids; callers wrap it in a write() to batch many calls."""
+        with self.conn.write() as conn:
+            if table != "transactions":
+                # no triggers there
+                conn.executemany(
+                    f"INSERT INTO {table} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+                return
+            with self._staged(conn, rows):
+                conn.execute(
+                    "INSERT INTO transactions SELECT * FROM temp.write_stage ORDER BY rowid")
+            self.notify_changed(row[0] for row in rows)
+
+    def update_rows(self, rows: List[tuple]) -> None:
+        """Overwrite existing rows with raw database rows, matched by id."""
+        columns = ", ".join(COLUMNS[1:])
+        with self.conn.write() as conn:
+            with self._staged(conn, rows):
+                conn.execute(f"""
+                    UPDATE transactions SET ({columns}) =
+                        (SELECT {columns} FROM temp.write_stage s WHERE s.id = transactions.id)
+                    WHERE id IN (SELECT id FROM temp.write_stage)""")
+            self.notify_changed(row[0] for row in rows)
+
+    def delete_ids(self, ids: List[str]) -> None:
+        """Delete rows by id only; sub-rows are not touched."""
+        with self.conn.write() as conn:
+            conn.execute(
+                "DELETE FROM transactions WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(ids)),))
+            self.notify_changed(ids)
 
     def update_transaction(self, tx: TransactionRow) -> bool:
         """Update an existing transaction."""
-        with sqlite3.connect(self.db_path) as conn:
+        with self.conn.write() as conn:
             cursor = conn.execute("""
                 UPDATE transactions 
                 SET parentId=?, date=?, rowType=?, inAmount=?, inCurrency=?,
@@ -121,65 +350,212 @@ class TransactionDB:
                     tx.tags), tx.note,
                 tx.isSubRow, tx.id
             ))
+            self.notify_changed([tx.id])
             return cursor.rowcount > 0
 
     def delete_transaction(self, tx: TransactionRow) -> bool:
         """Delete a transaction."""
-        with sqlite3.connect(self.db_path) as conn:
-            # cursor = conn.execute(
-            #     "DELETE FROM transactions WHERE id=?", (tx.id,))
-            # delete where id is equal to tx.id or parentId is equal to tx.id
-            cursor = conn.execute(
-                "DELETE FROM transactions WHERE id=? OR parentId=?", (tx.id, tx.id))
-            return True
+        return self.delete_transaction_by_id(tx.id)
 
     def delete_transaction_by_id(self, tx_id: str) -> bool:
-        """Delete a transaction."""
-        with sqlite3.connect(self.db_path) as conn:
-            # cursor = conn.execute(
-            #     "DELETE FROM transactions WHERE id=?", (tx.id,))
-            # delete where id is equal to tx.id or parentId is equal to tx.id
-            cursor = conn.execute(
-                "DELETE FROM transactions WHERE id=? OR parentId=?", (tx_id, tx_id))
-            return True
+        """Delete a transaction and its sub-rows."""
+        return bool(self.delete_subtree(tx_id))
+
+    # Sub-rows only go one level deep: a row's subtree is itself plus the rows
+    # whose parentId is its id. `id=? OR parentId=?` is answered from the primary
+    # key and idx_parent (a multi-index OR), never by scanning the table.
+
+    def delete_subtree(self, tx_id: str) -> List[tuple]:
+        """Delete a transaction and its sub-rows in a single statement.
+        Returns the deleted rows (raw database rows, in table order), e.g. for history."""
+        with self.conn.write() as conn:
+            rows = conn.execute(
+                "DELETE FROM transactions WHERE id=? OR parentId=? RETURNING rowid, *", (tx_id, tx_id)).fetchall()
+            rows.sort()
+            self.notify_changed(row[1] for row in rows)
+            return [row[1:] for row in rows]
+
+    def move_subtree(self, tx_id: str, parent_id: Optional[str]) -> List[tuple]:
+        """Make a transaction a sub-row of `parent_id`, or a top-level row if None.
+        Its own sub-rows follow it to the new parent (they can't be nested under a
+        sub-row), or stay under it when it becomes top-level.
+        Returns the changed rows as they were before the move; empty if tx_id doesn't exist."""
+        with self.conn.write() as conn:
+            rows = self.get_self_and_children_rows(tx_id)
+            if not rows:
+                return []
+            if parent_id is None:
+                rows = [row for row in rows if row[0] == tx_id]
+                conn.execute(
+                    "UPDATE transactions SET parentId=NULL, isSubRow=0 WHERE id=?", (tx_id,))
+            else:
+                parent = self.get_row(parent_id)
+                if parent is None:
+                    raise ValueError(f"Parent {parent_id} not found")
+                if any(row[0] == parent_id for row in rows):
+                    raise ValueError(f"Cannot move {tx_id} under itself or its sub-rows")
+                if parent[2] is not None:
+                    raise ValueError(f"Parent {parent_id} is a sub-row")
+                conn.execute(
+                    "UPDATE transactions SET parentId=?, isSubRow=1 WHERE id=? OR parentId=?",
+                    (parent_id, tx_id, tx_id))
+            self.notify_changed(row[0] for row in rows)
+            return rows
 
     def get_self_and_children(self, tx_id: str) -> List[TransactionRow]:
         """Get a transaction and all its children."""
-        with sqlite3.connect(self.db_path) as conn:
+        return [self.row_to_transaction(row) for row in self.get_self_and_children_rows(tx_id)]
+
+    def get_self_and_children_rows(self, tx_id: str) -> List[tuple]:
+        """Get a transaction and all its children, as raw database rows in table order."""
+        with self.conn.read() as conn:
             cursor = conn.execute(
-                "SELECT * FROM transactions WHERE id=? OR parentId=?", (tx_id, tx_id))
-            return [self.row_to_transaction(row) for row in cursor.fetchall()]
+                "SELECT * FROM transactions WHERE id=? OR parentId=? ORDER BY rowid", (tx_id, tx_id))
+            return cursor.fetchall()
 
     def get_all_transactions(self) -> List[TransactionRow]:
         """Get all transactions."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("SELECT * FROM transactions")
-            return [self.row_to_transaction(row) for row in cursor.fetchall()]
+        return self.cache.get_all()
+
+    def get_all_transactions_json(self) -> bytes:
+        """Get all transactions, already encoded as a json array."""
+        return self.cache.get_all_json()
+
+    def get_transactions_page(self, limit: int, after: Optional[Tuple[str, str]] = None) -> Tuple[List[TransactionRow], Optional[Tuple[str, str]]]:
+        """Get up to `limit` top-level rows ordered by (date, id), each followed by its sub-rows.
+        `after` is the (date, id) key of the last top-level row of the previous page.
+        Returns the rows and the key to pass for the next page (None on the last page)."""
+        with self.conn.read() as conn:
+            # keyset seek on idx_date_id, so every page costs the same as the first
+            if after is None:
+                cursor = conn.execute("""
+                    SELECT * FROM transactions WHERE isSubRow=0
+                    ORDER BY date, id LIMIT ?
+                """, (limit,))
+            else:
+                cursor = conn.execute("""
+                    SELECT * FROM transactions WHERE isSubRow=0 AND (date, id) > (?, ?)
+                    ORDER BY date, id LIMIT ?
+                """, (after[0], after[1], limit))
+            parents = cursor.fetchall()
+            if not parents:
+                return [], None
+
+            children = {}
+            parent_ids = [row[0] for row in parents]
+            placeholders = ",".join("?" * len(parent_ids))
+            cursor = conn.execute(
+                f"SELECT * FROM transactions WHERE isSubRow=1 AND parentId IN ({placeholders}) ORDER BY date, id",
+                parent_ids)
+            for row in cursor.fetchall():
+                children.setdefault(row[2], []).append(row)
+
+        txs = []
+        for row in parents:
+            txs.append(self.row_to_transaction(row))
+            txs.extend(self.row_to_transaction(child)
+                       for child in children.get(row[0], []))
+        next_key = (parents[-1][3], parents[-1][0]) if len(
+            parents) == limit else None
+        return txs, next_key
+
+    def _query_sql(self, query: TransactionQuery, limit: int,
+                   after: Optional[Tuple[str, str]] = None) -> Tuple[str, list]:
+        """SELECT for query_transactions; rowType values must be row type names."""
+        where = []
+        params: list = []
+        if query.dateFrom is not None:
+            where.append("date >= ?")
+            params.append(query.dateFrom)
+        if query.dateTo is not None:
+            where.append("date <= ?")
+            params.append(query.dateTo)
+        for column in ("inCurrency", "outCurrency", "network", "rowType"):
+            values = getattr(query, column)
+            if values:
+                where.append(f"{column} IN ({','.join('?' * len(values))})")
+                params.extend(values)
+        if query.isSubRow is not None:
+            where.append("isSubRow = ?")
+            params.append(int(query.isSubRow))
+        if after is not None:
+            where.append("(date, id) > (?, ?)")
+            params.extend(after)
+        sql = "SELECT * FROM transactions"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        return sql + " ORDER BY date, id LIMIT ?", params + [limit]
+
+    def query_transactions(self, query: TransactionQuery, limit: int,
+                           after: Optional[Tuple[str, str]] = None) -> Tuple[List[TransactionRow], Optional[Tuple[str, str]]]:
+        """Up to `limit` rows matching every filter of `query`, ordered by (date, id).
+        Rows are matched one by one: sub-rows don't come with their parent.
+        `after` and the returned key work as in get_transactions_page."""
+        sql, params = self._query_sql(query, limit, after)
+        with self.conn.read() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        next_key = (rows[-1][3], rows[-1][0]) if len(rows) == limit else None
+        return [self.row_to_transaction(row) for row in rows], next_key
+
+    def explain_query(self, query: TransactionQuery, limit: int,
+                      after: Optional[Tuple[str, str]] = None) -> dict:
+        """The plan sqlite uses for query_transactions, and the time to fetch its rows."""
+        sql, params = self._query_sql(query, limit, after)
+        with self.conn.read() as conn:
+            plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+            start = time.perf_counter()
+            rows = len(conn.execute(sql, params).fetchall())
+            ms = 1000 * (time.perf_counter() - start)
+        indexes = [detail.split(" INDEX ")[1].split()[0]
+                   for detail in plan if " INDEX " in detail]
+        return {
+            "sql": sql,
+            "params": params,
+            "plan": plan,
+            "indexes": indexes,
+            # SCAN walks a whole table or index; SEARCH seeks a range of it
+            "fullScan": any(detail.startswith("SCAN transactions") for detail in plan),
+            "rows": rows,
+            "ms": ms,
+        }
+
+    def get_rows(self, ids: Iterable[str]) -> List[tuple]:
+        """Get raw database rows for the given ids; missing ids are skipped."""
+        ids = list(ids)
+        rows = []
+        with self.conn.read() as conn:
+            # stay under sqlite's bound parameter limit
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows.extend(conn.execute(
+                    f"SELECT * FROM transactions WHERE id IN ({placeholders})", chunk).fetchall())
+        return rows
 
     def get_transaction(self, tx_id: str) -> Optional[TransactionRow]:
         """Get a transaction by ID."""
-        with sqlite3.connect(self.db_path) as conn:
+        return self.cache.get(tx_id)
+
+    def get_row(self, tx_id: str) -> Optional[tuple]:
+        """Get a transaction by ID, as a raw database row."""
+        with self.conn.read() as conn:
             cursor = conn.execute(
                 "SELECT * FROM transactions WHERE id=?", (tx_id,))
-            row = cursor.fetchone()
-            return self.row_to_transaction(row) if row else None
-
-    def on_init(self, demo_transactions: List[TransactionRow]) -> List[TransactionRow]:
-        """Initialize the database with demo data if empty."""
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.execute("SELECT COUNT(*) FROM transactions")
-            if cursor.fetchone()[0] == 0:
-                # Database is empty, insert demo data
-                for tx in demo_transactions:
-                    print(f'Inserting {tx}')
-                    self.insert_transaction(tx)
-                print('Created new db with demo data')
-                return demo_transactions
-            else:
-                tx = self.get_all_transactions()
-                print(f'Loaded {len(tx)} transactions from db')
-                return tx
+            return cursor.fetchone()
 
-    def restore_from_dbfile(self, dbfile: str) -> None:
-        """Restore database from a backup file."""
-        os.replace(dbfile, self.db_path)
+    def on_init(self, demo_transactions: Callable[[], List[TransactionRow]]) -> int:
+        """Fill the database with demo_transactions() if it is empty; returns the number of rows.
+        Only counts the rows: they are read (and decoded) when first asked for."""
+        with self.conn.read() as conn:
+            count = conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+        if count:
+            log.info("loaded db", rows=count)
+            return count
+        # Database is empty, insert demo data
+        demo = demo_transactions()
+        with self.conn.write():
+            for tx in demo:
+                log.debug("inserting demo row", id=tx.id)
+                self.insert_transaction(tx)
+        log.info("created new db with demo data", rows=len(demo))
+        return len(demo)
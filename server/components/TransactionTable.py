@@ -0,0 +1,372 @@
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from serverType.RowType import RowType
+from components.PnlEngine import ComputeError, SKIPPED_ROW_TYPES, finite
+from utils import currencies
+
+# Columnar, read-only copy of the transactions table for whole-ledger computations.
+# A TransactionRow costs several hundred bytes and every computation over a list of
+# them is a python loop; here each column is one numpy array (strings as codes into a
+# list of distinct values), and totals are grouped sums over those arrays.
+# totals() gives the same numbers as PnlEngine.get_totals() and holdings() the same as
+# Holdings.get_stats(); keep them in sync with calculate_row_cur and Holdings.IN_SIDE/OUT_SIDE.
+
+# columns read from the database, in this order
+COLUMNS = ["id", "parentId", "date", "rowType", "isSubRow", "inAmount", "inCurrency",
+           "outAmount", "outCurrency", "usdValue", "network"]
+
+# a row parent: no parentId, or a parentId that isn't in the table
+NO_PARENT, MISSING_PARENT = -1, -2
+# event sides
+IN, OUT = 0, 1
+
+STRINGS = np.dtypes.StringDType()
+
+
+def _codes(values: Iterable, n: int, missing: Optional[str] = None) -> Tuple[np.ndarray, List[str]]:
+    """Codes into the list of distinct values, in first-seen order. Empty values (None or
+    '') get code -1, unless `missing` is given, which stands in for them."""
+    index: Dict[str, int] = {}
+    if missing is None:
+        codes = np.fromiter(
+            (index.setdefault(v, len(index)) if v else -1 for v in values), np.int32, n)
+    else:
+        codes = np.fromiter(
+            (index.setdefault(v or missing, len(index)) for v in values), np.int32, n)
+    return codes, list(index)
+
+
+def _floats(values: Iterable) -> np.ndarray:
+    # NULL becomes NaN; sqlite never stores NaN itself, so NaN always means NULL
+    return np.array(values, dtype=np.float64)
+
+
+def _sums(groups: np.ndarray, weights: np.ndarray, size: int) -> np.ndarray:
+    """Sum of weights per group. bincount adds in array order, so a group
+    sums exactly like a python loop over its elements."""
+    return np.bincount(groups, weights, minlength=size)[:size]
+
+
+def _last_of_groups(groups: np.ndarray) -> np.ndarray:
+    """Positions of the last element of each run of equal, sorted group codes."""
+    return np.flatnonzero(np.append(groups[1:] != groups[:-1], True))
+
+
+def _linear_recurrence(alpha: np.ndarray, beta: np.ndarray) -> np.ndarray:
+    """x[k] = alpha[k] * x[k-1] + beta[k] with x[-1] = 0, as a parallel prefix scan:
+    log2(n) vectorized passes instead of a python loop over n elements."""
+    a, x = alpha.copy(), beta.copy()
+    shift = 1
+    while shift < len(x):
+        # compose each element with the one `shift` before it (right sides use the old values)
+        x[shift:] = a[shift:] * x[:-shift] + x[shift:]
+        a[shift:] = a[shift:] * a[:-shift]
+        shift *= 2
+    return x
+
+
+class TransactionTable:
+    """The columns needed for PNL and holdings, one numpy array each, in database order.
+
+    Amounts and usdValue are float64 (NaN for NULL). Currencies, networks and row types
+    are int32 codes into self.currencies, self.networks and self.row_types; empty
+    currencies are -1 and a NULL network is ''. Dates are codes into the sorted
+    self.dates, so comparing codes compares dates.
+    """
+
+    def __init__(self, rows: Sequence[tuple], version: int = 0):
+        """Build from raw rows holding COLUMNS, in that order."""
+        n = len(rows)
+        self.version = version  # ledger version the rows were read at
+        columns = list(zip(*rows)) if n else [()] * len(COLUMNS)
+        (ids, parent_ids, dates, row_types, is_sub_row, in_amount, in_currency,
+         out_amount, out_currency, usd_value, network) = columns
+
+        self.ids = np.array(ids, dtype=STRINGS)
+        position = {tx_id: i for i, tx_id in enumerate(ids)}
+        self.parent = np.fromiter(
+            (NO_PARENT if p is None else position.get(p, MISSING_PARENT) for p in parent_ids),
+            np.int32, n)
+        self.dates, self.date = np.unique(
+            np.array([d if d is not None else "" for d in dates], dtype=STRINGS), return_inverse=True)
+        self.date = self.date.astype(np.int32)
+        self.row_type, self.row_types = _codes(row_types, n)
+        self.is_sub_row = np.array(is_sub_row, dtype=bool)
+        self.in_amount = _floats(in_amount)
+        self.out_amount = _floats(out_amount)
+        self.usd_value = _floats(usd_value)
+
+        # one code list for both sides, so a currency has the same code on either
+        self.in_currency, self.currencies = _codes(in_currency + out_currency, 2 * n)
+        self.in_currency, self.out_currency = self.in_currency[:n], self.in_currency[n:]
+        self.network, self.networks = _codes(network, n, missing="")
+
+    @classmethod
+    def from_db(cls, db) -> "TransactionTable":
+        """The whole table, as of now."""
+        version, rows = db.get_columns(COLUMNS)
+        return cls(rows, version)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _types(self, *row_types: RowType) -> np.ndarray:
+        """Mask of the rows of any of the given types."""
+        codes = [self.row_types.index(t.name) for t in row_types if t.name in self.row_types]
+        return np.isin(self.row_type, codes)
+
+    def _id_rank(self) -> np.ndarray:
+        """Position of each row's id in id order."""
+        rank = np.empty(len(self), np.int64)
+        rank[np.argsort(self.ids, kind="stable")] = np.arange(len(self))
+        return rank
+
+    def order(self) -> np.ndarray:
+        """Row positions in table order, see PnlEngine.sort_key: parents by (date, id),
+        each followed by its sub-rows by (date, id)."""
+        id_rank = self._id_rank()
+        parent = np.where(self.parent >= 0, self.parent, 0)
+        # a sub-row of a missing parent, or of a sub-row, sorts as a parent
+        nested = (self.parent >= 0) & (self.parent[parent] == NO_PARENT)
+        # lexsort: last key first
+        return np.lexsort((
+            np.where(nested, id_rank, 0),
+            np.where(nested, self.date, 0),
+            nested,
+            np.where(nested, id_rank[parent], id_rank),
+            np.where(nested, self.date[parent], self.date),
+        ))
+
+    def totals(self) -> Dict[str, dict]:
+        """Totals per currency at the end of the ledger, as PnlEngine.get_totals().
+        Raises ComputeError for the rows calculate_row_cur rejects."""
+        ev = self._events()
+        n_cur = len(self.currencies)
+        cur, amount, value = ev["cur"], ev["amount"], ev["value"]
+        stable = np.isin(np.arange(n_cur), [self.currencies.index(c)
+                         for c in currencies.stable if c in self.currencies])
+
+        bought = _sums(cur, np.where(ev["buy"], amount, 0), n_cur)
+        sold = _sums(cur, np.where(ev["sell"], amount, 0), n_cur)
+        spent = _sums(cur, np.where(ev["buy"] & ~stable[cur], value, 0), n_cur)
+        bridged = _sums(cur, ev["bridged"], n_cur)
+        realized = _sums(cur, ev["stable_pnl"], n_cur)
+        borrowed = self._loans(ev, n_cur)
+
+        # the buys and sells of non-stable currencies; the last one sets the last price
+        priced = np.flatnonzero((ev["buy"] | ev["sell"]) & ~stable[cur])
+        last = priced[_last_of_groups(cur[priced])] if len(priced) else priced
+        last_price = np.zeros(n_cur)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            last_price[cur[last]] = value[last] / amount[last]
+
+        # realized PNL is the only running (not summed) quantity, replayed per currency
+        groups = cur[priced]
+        for events in np.split(priced, np.flatnonzero(groups[1:] != groups[:-1]) + 1):
+            if len(events):
+                realized[cur[events[0]]] += self._realized_pnl(
+                    ev["buy"][events], amount[events], value[events])
+
+        result = {}
+        for code in np.unique(cur):
+            code = int(code)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                avg_price = 1.0 if stable[code] else (
+                    0.0 if bought[code] == 0 else spent[code] / bought[code])
+            net = bought[code] - sold[code] + bridged[code]
+            result[self.currencies[code]] = {
+                "avgPrice": finite(float(avg_price)),
+                "cumPnl": finite(float(realized[code])),
+                "cumAmount": finite(float(bought[code] - sold[code] + borrowed[code] + bridged[code])),
+                "netAmount": finite(float(net)),
+                "amountBorrowed": finite(float(borrowed[code])),
+                "lastPrice": finite(float(1.0 if stable[code] else last_price[code])),
+            }
+        return result
+
+    @staticmethod
+    def _realized_pnl(buy: np.ndarray, amount: np.ndarray, value: np.ndarray) -> float:
+        """CumCurCompute.handleBuy/handleSell over one currency's events: the rolling
+        bought amount is a running sum, the rolling spent value a linear recurrence."""
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            # rollingBought, after each event; a running sum adds in order like the loop does
+            held = np.cumsum(np.where(buy, amount, -amount))
+            # a buy adds its value; a sell scales what was spent by the share still held
+            scale = np.where(buy, 1.0, held / (held + amount))
+            spent = _linear_recurrence(scale, np.where(buy, value, 0.0))
+            held_before = np.insert(held[:-1], 0, 0.0)
+            spent_before = np.insert(spent[:-1], 0, 0.0)
+            pnl = (value / amount - spent_before / held_before) * amount
+            return float(np.cumsum(pnl[~buy])[-1]) if (~buy).any() else 0.0
+
+    def _loans(self, ev: dict, n_cur: int) -> np.ndarray:
+        """Total borrowed per currency. CumCurCompute keeps loans per network and sums
+        them in order of first use, so this does too (same float rounding)."""
+        loans = np.flatnonzero(ev["loan"] != 0)
+        if not len(loans):
+            return np.zeros(n_cur)
+        n_net = max(len(self.networks), 1)
+        pair = ev["cur"][loans].astype(np.int64) * n_net + self.network[ev["row"][loans]]
+        per_pair = _sums(pair, ev["loan"][loans], n_cur * n_net)
+        _, first_use = np.unique(pair, return_index=True)
+        used = pair[np.sort(first_use)]
+        return _sums(used // n_net, per_pair[used], n_cur)
+
+    def _events(self) -> dict:
+        """What each (row, currency) of the ledger does to that currency's totals, in
+        calculate_row_cur's terms, ordered by currency and then table order.
+        Events that only buy or sell for $0 (rewards, losses, gains) have value 0."""
+        rank = np.empty(len(self), np.int64)
+        rank[self.order()] = np.arange(len(self))
+        skipped = np.isin(self.row_type, [self.row_types.index(t) for t in SKIPPED_ROW_TYPES
+                                          if t in self.row_types])
+        same = (self.in_currency >= 0) & (self.in_currency == self.out_currency)
+        # row_currencies: the in side, and the out side if it's another currency
+        in_rows = np.flatnonzero(~skipped & (self.in_currency >= 0))
+        out_rows = np.flatnonzero(~skipped & (self.out_currency >= 0) & ~same)
+        row = np.concatenate([in_rows, out_rows])
+        side = np.concatenate([np.full(len(in_rows), IN), np.full(len(out_rows), OUT)])
+        cur = np.concatenate([self.in_currency[in_rows], self.out_currency[out_rows]])
+        pos = rank[row]
+        by_currency = np.lexsort((pos, cur))
+        row, side, cur, pos = row[by_currency], side[by_currency], cur[by_currency], pos[by_currency]
+
+        is_in = side == IN
+        same = same[row]
+        in_amount = np.nan_to_num(self.in_amount[row], nan=0.0)
+        out_amount = np.nan_to_num(self.out_amount[row], nan=0.0)
+        usd = np.nan_to_num(self.usd_value[row], nan=0.0)
+        stable = np.isin(cur, [self.currencies.index(c)
+                               for c in currencies.stable if c in self.currencies])
+
+        def kind(*row_types: RowType) -> np.ndarray:
+            return ~same & self._types(*row_types)[row]
+
+        bridge_in, bridge_out = kind(RowType.BRIDGEIN), kind(RowType.BRIDGEOUT)
+        reward, loss = kind(RowType.REWARD), kind(RowType.LOSS, RowType.subINTEREST)
+        borrow = kind(RowType.BORROW)
+        repay = kind(RowType.REPAY, RowType.subPRINCIPLE)
+        trade = kind(RowType.TRADE, RowType.subREBUY)
+        priced_trade = trade & (usd != 0)
+        gain = same & (in_amount - out_amount > 0)
+        lost = same & (in_amount - out_amount < 0)
+
+        # handleBuy / handleSell amounts, as passed by calculate_row_cur
+        buy = gain | (reward & is_in) | (priced_trade & is_in)
+        sell = lost | (loss & ~is_in) | (priced_trade & ~is_in)
+        amount = np.select(
+            [same, is_in], [np.abs(in_amount - out_amount), in_amount], out_amount)
+        value = np.where(priced_trade, usd, 0.0)
+
+        self._check(row, cur, pos, amount, [
+            (bridge_in & ~is_in, "inCurrency"), (bridge_out & is_in, "outCurrency"),
+            (reward & ~is_in, "inCurrency"), (loss & is_in, "outCurrency"),
+            (borrow & ~is_in, "inCurrency"),
+        ], [
+            (bridge_out & ~is_in, "handleBridgeOut"),
+            (buy & ~stable & ~same, "handleBuy"), (sell & ~same, "handleSell"),
+            (borrow & is_in, "handleBorrow"), (repay & ~is_in & (out_amount != 0), "handleRepay"),
+        ], ~same & ~(bridge_in | bridge_out | reward | loss | borrow | repay | trade))
+
+        return {
+            "row": row, "cur": cur, "pos": pos, "buy": buy, "sell": sell,
+            "amount": amount, "value": value,
+            "bridged": np.select([bridge_in & is_in, bridge_out & ~is_in], [in_amount, -out_amount], 0.0),
+            "loan": np.select([borrow & is_in, repay & ~is_in], [in_amount, -out_amount], 0.0),
+            # gains and losses of stables are pnl at $1
+            "stable_pnl": np.where(same & stable, in_amount - out_amount, 0.0),
+        }
+
+    def _check(self, row: np.ndarray, cur: np.ndarray, pos: np.ndarray, amount: np.ndarray,
+               wrong_side: List[Tuple[np.ndarray, str]],
+               negative: List[Tuple[np.ndarray, str]],
+               unknown_type: np.ndarray) -> None:
+        """Raise the ComputeError calculate_row_cur would, for the first bad row in table order."""
+        errors = []
+
+        def first(mask: np.ndarray) -> List[int]:
+            found = np.flatnonzero(mask)
+            return [found[np.argmin(pos[found])]] if len(found) else []
+
+        for mask, expected in wrong_side:
+            actual = self.in_currency if expected == "inCurrency" else self.out_currency
+            for i in first(mask):
+                errors.append((pos[i], f"{expected} {self.currencies[actual[row[i]]]} "
+                                       f"not {self.currencies[cur[i]]} in row {self.ids[row[i]]}"))
+        for mask, handler in negative:
+            for i in first(mask & (amount < 0)):
+                errors.append((pos[i], f"{handler}: amount must be positive"))
+        for i in first(unknown_type):
+            errors.append((pos[i], f"rowType {self.row_types[self.row_type[row[i]]]} "
+                                   f"not TRADE in row {self.ids[row[i]]}"))
+        if errors:
+            raise ComputeError(min(errors)[1])
+
+    def holdings(self) -> Dict[str, dict]:
+        """netOwned, netBorrowed, lastTradePrices and byNetwork, as Holdings.get_stats()."""
+        valid = ~np.isin(self.row_type, [self.row_types.index(t) for t in SKIPPED_ROW_TYPES
+                                         if t in self.row_types])
+        in_amount = np.nan_to_num(self.in_amount, nan=0.0)
+        out_amount = np.nan_to_num(self.out_amount, nan=0.0)
+        usd = np.nan_to_num(self.usd_value, nan=0.0)
+        same = self.in_currency == self.out_currency
+        priced_trade = self._types(RowType.TRADE, RowType.subREBUY) & (usd != 0)
+
+        # IN_SIDE / OUT_SIDE
+        in_rows = valid & (self.in_currency >= 0)
+        in_owned = np.select([
+            same,
+            self._types(RowType.BRIDGEIN, RowType.REWARD),
+            priced_trade,
+        ], [in_amount - out_amount, in_amount, in_amount], 0.0)
+        in_borrowed = np.where(~same & self._types(RowType.BORROW), in_amount, 0.0)
+        out_rows = valid & (self.out_currency >= 0) & ~same
+        out_owned = np.where(
+            self._types(RowType.BRIDGEOUT, RowType.LOSS, RowType.subINTEREST) | priced_trade,
+            -out_amount, 0.0)
+        out_borrowed = np.where(self._types(RowType.REPAY, RowType.subPRINCIPLE), -out_amount, 0.0)
+
+        n_net = max(len(self.networks), 1)
+        size = len(self.currencies) * n_net
+        pair = np.concatenate([
+            self.in_currency[in_rows].astype(np.int64) * n_net + self.network[in_rows],
+            self.out_currency[out_rows].astype(np.int64) * n_net + self.network[out_rows]])
+        owned = _sums(pair, np.concatenate([in_owned[in_rows], out_owned[out_rows]]), size)
+        borrowed = _sums(pair, np.concatenate([in_borrowed[in_rows], out_borrowed[out_rows]]), size)
+
+        net_owned: Dict[str, float] = {}
+        net_borrowed: Dict[str, float] = {}
+        by_network: Dict[str, Dict[str, dict]] = {}
+        for p in np.unique(pair):
+            cur, network = self.currencies[p // n_net], self.networks[p % n_net]
+            net_owned[cur] = net_owned.get(cur, 0) + float(owned[p])
+            net_borrowed[cur] = net_borrowed.get(cur, 0) + float(borrowed[p])
+            by_network.setdefault(cur, {})[network] = {
+                "owned": float(owned[p]), "borrowed": float(borrowed[p])}
+
+        # PRICE_SIDES: the latest top-level row with a price, the out side winning ties
+        top = ~self.is_sub_row & (usd != 0)
+        sides = [np.flatnonzero(top & (self.in_currency >= 0) & (in_amount != 0)),
+                 np.flatnonzero(top & (self.out_currency >= 0) & (out_amount != 0))]
+        rows = np.concatenate(sides)
+        side = np.concatenate([np.full(len(sides[0]), IN), np.full(len(sides[1]), OUT)])
+        cur = np.concatenate([self.in_currency[sides[0]], self.out_currency[sides[1]]])
+        id_rank = self._id_rank()
+        latest = np.lexsort((side, id_rank[rows], self.date[rows], cur))
+        latest = latest[_last_of_groups(cur[latest])] if len(latest) else latest
+        last_trade_prices = {}
+        for i in latest:
+            name = self.currencies[cur[i]]
+            # prices of stables are not shown
+            if name not in currencies.stable:
+                amount = in_amount[rows[i]] if side[i] == IN else out_amount[rows[i]]
+                last_trade_prices[name] = float(usd[rows[i]] / amount)
+
+        return {
+            "netOwned": net_owned,
+            "netBorrowed": net_borrowed,
+            "lastTradePrices": last_trade_prices,
+            "byNetwork": by_network,
+        }
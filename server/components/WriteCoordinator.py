@@ -0,0 +1,139 @@
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+
+import cfg
+from components.ConnectionManager import ConnectionManager
+from components.RequestMetrics import db_job
+
+
+class _Job:
+    __slots__ = ("fn", "args", "kwargs", "context", "future", "submitted")
+
+    def __init__(self, fn: Callable[..., Any], args: tuple, kwargs: dict):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        # keep contextvars (e.g. request ids) visible inside the job
+        self.context = contextvars.copy_context()
+        self.future: Future = Future()
+        self.submitted = time.perf_counter()
+
+
+class WriteCoordinator:
+    """Runs every mutation on one writer thread, in submission order.
+
+    Jobs queued within cfg.write_group_window_ms of each other are committed
+    together in one transaction (group commit). Each job runs in its own savepoint,
+    so a job that raises only rolls back its own changes and gets its own error;
+    the others still commit. Results are handed out once the group has committed,
+    and if the commit itself fails every job in the group gets that error.
+
+    Since jobs execute one after the other on the same connection, anything they
+    number or order (history seq, ledger version) follows the commit order.
+    """
+
+    def __init__(self, conn: ConnectionManager,
+                 window_ms: float = cfg.write_group_window_ms,
+                 max_group: int = cfg.write_group_max):
+        self.conn = conn
+        self.window = window_ms / 1000
+        self.max_group = max_group
+        self.queue: "queue.Queue[Optional[_Job]]" = queue.Queue()
+        self.lock = threading.Lock()
+        self.groups = 0
+        self.jobs = 0
+        self.failed = 0
+        self.largest_group = 0
+        self.thread = threading.Thread(
+            target=self._loop, name="db-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Queue fn(*args, **kwargs); the future resolves once its group has committed."""
+        job = _Job(fn, args, kwargs)
+        self.queue.put(job)
+        return job.future
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Like submit(), awaited: returns (or raises) the job's own result."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _loop(self) -> None:
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            group = [job]
+            stop = False
+            deadline = time.monotonic() + self.window
+            while len(group) < self.max_group:
+                try:
+                    # whatever is already queued joins without waiting
+                    job = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                group.append(job)
+            self._commit(group)
+            if stop:
+                return
+
+    def _commit(self, group: List[_Job]) -> None:
+        # (job, ok, result or exception), for the jobs that weren't cancelled
+        outcomes = []
+        try:
+            with self.conn.write():
+                for job in group:
+                    if not job.future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with db_job(job.context, job.submitted), self.conn.write():
+                            result = job.context.run(job.fn, *job.args, **job.kwargs)
+                        outcomes.append((job, True, result))
+                    except Exception as e:
+                        outcomes.append((job, False, e))
+        except BaseException as e:
+            for job in group:
+                if job.future.running():
+                    job.future.set_exception(e)
+            with self.lock:
+                self.groups += 1
+                self.jobs += len(group)
+                self.failed += len(group)
+            if not isinstance(e, Exception):
+                raise
+            return
+
+        for job, ok, value in outcomes:
+            if ok:
+                job.future.set_result(value)
+            else:
+                job.future.set_exception(value)
+        with self.lock:
+            self.groups += 1
+            self.jobs += len(group)
+            self.failed += sum(1 for _, ok, _ in outcomes if not ok)
+            self.largest_group = max(self.largest_group, len(group))
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                "queueDepth": self.queue.qsize(),
+                "groups": self.groups,
+                "jobs": self.jobs,
+                "failed": self.failed,
+                "avgGroupSize": self.jobs / self.groups if self.groups else 0.0,
+                "largestGroup": self.largest_group,
+            }
+
+    def shutdown(self) -> None:
+        """Finish the queued jobs, then stop the writer thread."""
+        self.queue.put(None)
+        self.thread.join()
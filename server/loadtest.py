@@ -0,0 +1,433 @@
+"""
+Many clients at once against the app, served by uvicorn on loopback:
+    python loadtest.py [--mix mixed] [--clients 16] [--duration 30] [--rows 10000]
+                       [--warmup 3] [--think-ms 0] [--seed 1] [--out results.json]
+Starts main:app in its own process with a fresh database in a temporary directory,
+loads a generated ledger (bench/ledger.py) through the csv upload, then runs --clients
+concurrent clients, each sending requests back to back, picked at random by the
+weights of the mix. --mix is one of MIXES or weights like "get=5,update=2,undo=1".
+
+Reports throughput and p50/p95/p99 latency per endpoint, rejected requests (4xx,
+e.g. deleting a row an upload or undo removed) and errors (5xx, timeouts, broken
+connections), and lock contention from GET /api/status: waits for a pooled reader
+or the writer, SQLITE_BUSY errors, executor and writer queues. Offline, one machine.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from bench.ledger import generate_ledger, CURRENCIES, TAGS, WORDS
+from components.TransactionDB import TransactionDB
+from components.ManageCSV import ManageCSV
+
+SERVER = os.path.dirname(os.path.abspath(__file__))
+HOST = "127.0.0.1"
+
+# request weights of each preset mix, by operation (see Client)
+MIXES = {
+    "read": {"list": 1, "page": 10, "query": 10, "get": 20, "search": 5, "totals": 3,
+             "stats": 5, "changes": 10, "undo-redo": 5},
+    "write": {"finalize": 10, "update": 20, "delete": 6, "batch": 3, "move": 2,
+              "undo": 3, "redo": 2, "get": 5},
+    "mixed": {"page": 10, "query": 5, "get": 20, "search": 3, "totals": 2, "stats": 3,
+              "changes": 10, "undo-redo": 3, "finalize": 5, "update": 8, "delete": 3,
+              "batch": 1, "move": 1, "undo": 2, "redo": 1, "download": 1},
+    "import": {"upload": 1, "download": 2, "page": 10, "get": 10, "update": 5, "changes": 5},
+}
+# how often the server's status is sampled for queue depths
+STATUS_EVERY = 0.25
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    if mix in MIXES:
+        return MIXES[mix]
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in Client.OPERATIONS:
+            raise SystemExit(f"unknown operation {name.strip()!r}, one of {', '.join(Client.OPERATIONS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))]
+
+
+def fresh_trades():
+    """Endless new trades for finalize, dated after the ledger so their ids never collide."""
+    seed = 1000
+    while True:
+        seed += 1
+        yield from (row for row in generate_ledger(1000, seed=seed, start="2030-01-01", days=365)
+                    if row[4] == "TRADE")
+
+
+class Shared:
+    """What the clients know about the ledger, to build valid requests."""
+
+    def __init__(self, rows: List[dict], csv_bytes: bytes):
+        self.rows = {row["id"]: row for row in rows}
+        parents = {row["parentId"] for row in rows if row["parentId"]}
+        self.leaves = [row["id"] for row in rows if not row["parentId"] and row["id"] not in parents]
+        self.parents = sorted(parents)
+        self.children = [row["id"] for row in rows if row["parentId"]]
+        self.csv_bytes = csv_bytes
+        # rows added by finalize, which delete picks from
+        self.created: List[dict] = []
+        self.fresh = fresh_trades()
+        self.version = 0
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Dict[str, int]] = {}
+        self.recording = False
+
+    def record(self, label: str, seconds: float, status: str) -> None:
+        if not self.recording:
+            return
+        self.latencies.setdefault(label, []).append(seconds)
+        counts = self.statuses.setdefault(label, {})
+        counts[status] = counts.get(status, 0) + 1
+
+    def report(self, duration: float) -> Dict[str, dict]:
+        endpoints = {}
+        for label in sorted(self.latencies):
+            values = sorted(self.latencies[label])
+            statuses = self.statuses[label]
+            rejected = sum(n for status, n in statuses.items() if status.startswith("4"))
+            errors = sum(n for status, n in statuses.items() if status[0] not in "234")
+            endpoints[label] = {
+                "count": len(values),
+                "rps": len(values) / duration,
+                "p50_ms": 1000 * percentile(values, 50),
+                "p95_ms": 1000 * percentile(values, 95),
+                "p99_ms": 1000 * percentile(values, 99),
+                "max_ms": 1000 * values[-1],
+                "rejected": rejected,
+                "errors": errors,
+                "error_rate": errors / len(values),
+                "statuses": statuses,
+            }
+        return endpoints
+
+
+class Client:
+    """One simulated tab or script, sending one request at a time."""
+
+    OPERATIONS = {
+        # name: endpoint label in the report
+        "list": "GET /api/transactions",
+        "page": "GET /api/transactions?limit",
+        "query": "GET /api/transactions/query",
+        "get": "GET /api/transactions/{id}",
+        "search": "GET /api/search",
+        "totals": "GET /api/compute/totals",
+        "compute": "GET /api/compute",
+        "stats": "GET /api/stats",
+        "changes": "GET /api/changes",
+        "undo-redo": "GET /api/undo-redo",
+        "finalize": "POST /api/transactions (finalize)",
+        "update": "POST /api/transactions (update)",
+        "delete": "POST /api/transactions (delete)",
+        "batch": "POST /api/transactions/batch",
+        "move": "POST /api/transactions/{id}/move",
+        "undo": "POST /api/undo",
+        "redo": "POST /api/redo",
+        "upload": "POST /api/upload-csv",
+        "download": "GET /api/download-csv",
+    }
+
+    def __init__(self, http: httpx.AsyncClient, shared: Shared, stats: Stats, rng: random.Random):
+        self.http = http
+        self.shared = shared
+        self.stats = stats
+        self.rng = rng
+
+    async def run(self, mix: Dict[str, float], until: float, think: float) -> None:
+        names = list(mix)
+        weights = list(mix.values())
+        while time.monotonic() < until:
+            name = self.rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = str((await getattr(self, "op_" + name.replace("-", "_"))()).status_code)
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            self.stats.record(self.OPERATIONS[name], time.perf_counter() - start, status)
+            if think:
+                await asyncio.sleep(think)
+
+    def _any(self, ids: List[str]) -> str:
+        return ids[self.rng.randrange(len(ids))]
+
+    def _edited(self) -> dict:
+        row = self.shared.rows[self._any(self.shared.leaves)]
+        return {**row, "note": " ".join(self.rng.choices(WORDS, k=3))}
+
+    async def op_list(self):
+        return await self.http.get("/api/transactions")
+
+    async def op_page(self):
+        return await self.http.get("/api/transactions", params={"limit": 500})
+
+    async def op_query(self):
+        return await self.http.get("/api/transactions/query", params={
+            "inCurrency": self.rng.choice(CURRENCIES[:8]), "limit": 500})
+
+    async def op_get(self):
+        return await self.http.get(f"/api/transactions/{self._any(self.shared.leaves)}")
+
+    async def op_search(self):
+        if self.rng.random() < 0.5:
+            return await self.http.get("/api/search", params={"q": self.rng.choice(WORDS)})
+        return await self.http.get("/api/search", params={"tag": self.rng.choice(TAGS)})
+
+    async def op_totals(self):
+        return await self.http.get("/api/compute/totals")
+
+    async def op_compute(self):
+        return await self.http.get("/api/compute")
+
+    async def op_stats(self):
+        return await self.http.get("/api/stats")
+
+    async def op_changes(self):
+        # a poll: whatever changed since the last version any client saw
+        response = await self.http.get("/api/changes", params={"since": self.shared.version, "timeout": 0})
+        if response.status_code == 200:
+            self.shared.version = max(self.shared.version, response.json()["version"])
+        return response
+
+    async def op_undo_redo(self):
+        return await self.http.get("/api/undo-redo")
+
+    async def op_finalize(self):
+        row = next(self.shared.fresh)
+        tx = {"id": row[0], "isSubRow": False, "parentId": None, "date": row[3], "rowType": "Trade",
+              "inAmount": row[5], "inCurrency": row[6], "outAmount": row[7], "outCurrency": row[8],
+              "feeAmount": row[9], "feeCurrency": row[10], "usdValue": row[11], "network": row[12],
+              "tags": json.loads(row[13]), "note": row[14]}
+        response = await self.http.post("/api/transactions", json={"operation": "finalize", "row": tx})
+        if response.status_code == 200:
+            self.shared.created.append(tx)
+        return response
+
+    async def op_update(self):
+        return await self.http.post("/api/transactions", json={"operation": "update", "row": self._edited()})
+
+    async def op_delete(self):
+        if not self.shared.created:
+            return await self.op_finalize()
+        tx = self.shared.created.pop(self.rng.randrange(len(self.shared.created)))
+        return await self.http.post("/api/transactions", json={"operation": "delete", "row": tx})
+
+    async def op_batch(self):
+        operations = [{"operation": "update", "row": self._edited()} for _ in range(20)]
+        return await self.http.post("/api/transactions/batch", json={"operations": operations})
+
+    async def op_move(self):
+        return await self.http.post(f"/api/transactions/{self._any(self.shared.children)}/move",
+                                    json={"parentId": self._any(self.shared.parents)})
+
+    async def op_undo(self):
+        return await self.http.post("/api/undo")
+
+    async def op_redo(self):
+        return await self.http.post("/api/redo")
+
+    async def op_upload(self):
+        return await self.http.post("/api/upload-csv", files={"file": ("ledger.csv", self.shared.csv_bytes)})
+
+    async def op_download(self):
+        async with self.http.stream("GET", "/api/download-csv") as response:
+            async for _ in response.aiter_bytes():
+                pass
+        return response
+
+
+def ledger_csv(rows: int, workdir: str) -> bytes:
+    """A generated ledger as an uploadable csv, written through ManageCSV."""
+    db = TransactionDB(os.path.join(workdir, "seed.db"))
+    db.insert_rows(generate_ledger(rows))
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        csv_bytes = b"".join(ManageCSV(db).iter_csv())
+    db.conn.close()
+    return csv_bytes
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def serve(workdir: str, port: int):
+    """Run main:app under uvicorn, with the working directory (and so data/) in `workdir`."""
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    log = open(os.path.join(workdir, "server.log"), "w")
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", SERVER, "--host", HOST,
+         "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        yield proc
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log.close()
+
+
+async def wait_ready(http: httpx.AsyncClient, proc: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with {proc.returncode}, see its log")
+        try:
+            if (await http.get("/api/status")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise SystemExit("server did not start in time")
+
+
+async def sample_status(http: httpx.AsyncClient, peaks: dict, until: float) -> None:
+    """Track the deepest executor and writer queues while the clients run."""
+    while time.monotonic() < until:
+        try:
+            status = (await http.get("/api/status")).json()
+            peaks["executorQueue"] = max(peaks["executorQueue"], status["dbExecutor"]["queueDepth"])
+            peaks["writerQueue"] = max(peaks["writerQueue"], status["dbWriter"]["queueDepth"])
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(STATUS_EVERY)
+
+
+def contention(before: dict, after: dict, peaks: dict) -> dict:
+    """Lock and queue contention over the measured period, from two GET /api/status."""
+    conns_before, conns = before["dbConnections"], after["dbConnections"]
+    writer_before, writer = before["dbWriter"], after["dbWriter"]
+    groups = writer["groups"] - writer_before["groups"]
+    return {
+        **{key: value - conns_before[key] for key, value in conns.items() if not key.endswith("Max")},
+        # maxima are since the server started, which includes the seeding
+        "readerWaitMsMax": conns["readerWaitMsMax"],
+        "writerWaitMsMax": conns["writerWaitMsMax"],
+        "executorWaitMsMax": after["dbExecutor"]["waitMsMax"],
+        "executorQueuePeak": peaks["executorQueue"],
+        "writerQueuePeak": peaks["writerQueue"],
+        "writeGroups": groups,
+        "writesPerGroup": (writer["jobs"] - writer_before["jobs"]) / groups if groups else 0.0,
+        "writesFailed": writer["failed"] - writer_before["failed"],
+    }
+
+
+async def run(args, mix: Dict[str, float], workdir: str) -> dict:
+    csv_bytes = ledger_csv(args.rows, workdir)
+    port = free_port()
+    with serve(workdir, port) as proc:
+        limits = httpx.Limits(max_connections=args.clients + 1)
+        async with httpx.AsyncClient(base_url=f"http://{HOST}:{port}", limits=limits,
+                                     timeout=args.timeout) as http:
+            await wait_ready(http, proc)
+            response = await http.post("/api/upload-csv", files={"file": ("ledger.csv", csv_bytes)})
+            response.raise_for_status()
+            shared = Shared(response.json()["table"], csv_bytes)
+            stats = Stats()
+            rng = random.Random(args.seed)
+            clients = [Client(http, shared, stats, random.Random(rng.random())) for _ in range(args.clients)]
+
+            start = time.monotonic()
+            until = start + args.warmup + args.duration
+            tasks = [asyncio.create_task(client.run(mix, until, args.think_ms / 1000)) for client in clients]
+            await asyncio.sleep(args.warmup)
+            before = (await http.get("/api/status")).json()
+            stats.recording = True
+            measured = time.monotonic()
+            peaks = {"executorQueue": 0, "writerQueue": 0}
+            sampler = asyncio.create_task(sample_status(http, peaks, until))
+            await asyncio.gather(*tasks)
+            duration = time.monotonic() - measured
+            await sampler
+            after = (await http.get("/api/status")).json()
+
+    endpoints = stats.report(duration)
+    count = sum(e["count"] for e in endpoints.values())
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "mix": mix,
+        "clients": args.clients,
+        "rows": args.rows,
+        "duration_s": duration,
+        "requests": count,
+        "rps": count / duration,
+        "errors": sum(e["errors"] for e in endpoints.values()),
+        "rejected": sum(e["rejected"] for e in endpoints.values()),
+        "endpoints": endpoints,
+        "contention": contention(before, after, peaks),
+        "server_log": os.path.join(workdir, "server.log"),
+    }
+
+
+def print_report(result: dict) -> None:
+    print(f"{result['requests']} requests in {result['duration_s']:.1f}s from {result['clients']} clients "
+          f"on {result['rows']} rows: {result['rps']:.1f} req/s, "
+          f"{result['errors']} errors, {result['rejected']} rejected")
+    print(f"{'endpoint':36} {'count':>7} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'max ms':>8} {'4xx':>5} {'errors':>6}")
+    for label, e in result["endpoints"].items():
+        print(f"{label:36} {e['count']:7} {e['rps']:7.1f} {e['p50_ms']:8.1f} {e['p95_ms']:8.1f} "
+              f"{e['p99_ms']:8.1f} {e['max_ms']:8.1f} {e['rejected']:5} {e['errors']:6}")
+    print("contention: " + ", ".join(
+        f"{key} {value:.1f}" if isinstance(value, float) else f"{key} {value}"
+        for key, value in result["contention"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load against the app under uvicorn")
+    parser.add_argument("--mix", default="mixed",
+                        help=f"one of {', '.join(MIXES)}, or weights like get=5,update=2")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument("--rows", type=int, default=10_000, help="size of the generated ledger")
+    parser.add_argument("--think-ms", type=float, default=0, help="pause of each client between requests")
+    parser.add_argument("--timeout", type=float, default=60, help="request timeout, in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="also write the results here as json")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    result = asyncio.run(run(args, mix, workdir))
+    print_report(result)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
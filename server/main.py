@@ -1,33 +1,107 @@
-from fastapi import FastAPI, HTTPException, status, BackgroundTasks, UploadFile
-from fastapi.responses import FileResponse
+import time
+# start of the import, for the import-to-ready time (see lifespan)
+import_started = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, status, BackgroundTasks, UploadFile, Query, Header
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel, Field, ConfigDict
 from typing import List, Optional, Union, Literal
-import traceback
 import datetime
 import os
+import asyncio
+import contextlib
 
 import cfg
+from components.Log import setup_logging, get_logger
 from serverType.TransactionRow import TransactionRow
 from components.TransactionAPI import TransactionAPI
 from components.ManageCSV import ManageCSV
+from components.RequestMetrics import RequestMetrics, MetricsRegistry
+from components.Profiler import Profiler
 
 from serverType.RowType import RowType
 from serverType.TransactionRow import TransactionRow
-from serverType.api_types import TransactionUpdate
+from serverType.api_types import TransactionUpdate, TransactionBatch, TransactionMove, TransactionPage, TransactionQuery, QueryPlan, SearchResult, CsvImportResult, ComputeResult, ComputeTotals, PortfolioStats
 from cleanup_data import find_old_files
 
-app = FastAPI()
+setup_logging()
+log = get_logger("api")
 api = TransactionAPI()
-find_old_files(cfg.data_path, 1, True)
+startup_ms: Optional[float] = None
+
+
+def _background(name: str, coro) -> asyncio.Task:
+    def done(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f"{name} failed", exc_info=task.exception())
+    task = asyncio.create_task(coro, name=name)
+    task.add_done_callback(done)
+    return task
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Startup only opens the database and counts its rows (see TransactionAPI), so requests
+    are served right away; cleaning up old uploads and warming the caches run in the background"""
+    global startup_ms
+    startup_ms = 1000 * (time.perf_counter() - import_started)
+    log.info("ready", startupMs=round(startup_ms, 1))
+    tasks = [
+        _background("cleanup", asyncio.to_thread(find_old_files, cfg.data_path, 1, True)),
+        _background("warm-up", run_db(api.warm_up)),
+    ]
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    api.close()
+
+
+app = FastAPI(lifespan=lifespan)
+# per-request timing and SQL counts: Server-Timing headers, GET /api/metrics
+metrics = MetricsRegistry()
+app.add_middleware(RequestMetrics, registry=metrics)
+profiler = Profiler()
+# database work runs on api.executor's threads, never on the event loop,
+# and writes on api.writer's single thread
+run_db = api.executor.run
+run_write = api.writer.run
 
 
-@app.get("/api/transactions", response_model=List[TransactionRow])
-async def get_transactions():
-    """Get all transactions"""
+@app.get("/api/transactions", response_model=Union[List[TransactionRow], TransactionPage])
+async def get_transactions(limit: Optional[int] = Query(default=None, ge=1, le=5000), cursor: Optional[str] = None,
+                           if_none_match: Optional[str] = Header(default=None)):
+    """Get all transactions, or one page of them if `limit` is given"""
     try:
-        return api.get_all_transactions()
+        if limit is not None:
+            return await run_db(api.get_transactions_page, limit, cursor)
+        return await run_db(api.get_all_transactions_response, if_none_match)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f'Error in get_transactions: {e} {traceback.format_exc()}')
+        log.exception("get_transactions failed")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/transactions/query", response_model=Union[TransactionPage, QueryPlan])
+async def query_transactions(dateFrom: Optional[str] = None, dateTo: Optional[str] = None,
+                             inCurrency: List[str] = Query(default=[]), outCurrency: List[str] = Query(default=[]),
+                             network: List[str] = Query(default=[]), rowType: List[str] = Query(default=[]),
+                             isSubRow: Optional[bool] = None,
+                             limit: int = Query(default=1000, ge=1, le=5000), cursor: Optional[str] = None,
+                             explain: bool = False):
+    """Transactions matching every given filter (see TransactionQuery), one page at a time
+    in (date, id) order. With `explain`, the sqlite query plan and timing instead of the rows."""
+    filters = TransactionQuery(dateFrom=dateFrom, dateTo=dateTo, inCurrency=inCurrency, outCurrency=outCurrency,
+                               network=network, rowType=rowType, isSubRow=isSubRow)
+    try:
+        if explain:
+            return await run_db(api.explain_query, filters, limit, cursor)
+        return await run_db(api.query_transactions, filters, limit, cursor)
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.exception("query_transactions failed")
         raise HTTPException(status_code=400, detail=str(e))
 
 
@@ -36,84 +110,194 @@ async def update_transaction(payload: TransactionUpdate):
     """Update, delete, or finalize a transaction"""
     try:
         if payload.operation == "delete":
-            return api.delete_transaction(payload.row)
+            return await run_write(api.delete_transaction, payload.row)
 
         elif payload.operation == "update":
-            return api.update_transaction(payload.row)
+            return await run_write(api.update_transaction, payload.row)
 
         elif payload.operation == "finalize":
-            return api.add_transaction(payload.row)
+            return await run_write(api.add_transaction, payload.row)
 
     except Exception as e:
-        print(
-            f'Error in update_transaction: {payload}. Full traceback: {traceback.format_exc()}')
+        log.exception("update_transaction failed", operation=payload.operation, id=payload.row.id)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
 
 
+@app.post("/api/transactions/batch")
+async def update_transactions(payload: TransactionBatch):
+    """Update, delete, or finalize many transactions at once, as a single undo step"""
+    try:
+        return await api.write_and_respond(api.apply_batch, payload.operations)
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.exception("update_transactions failed", operations=len(payload.operations))
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/api/transactions/{transaction_id}/move")
+async def move_transaction(transaction_id: str, payload: TransactionMove):
+    """Reparent a transaction with its sub-rows, as a single undo step"""
+    try:
+        return await api.write_and_respond(api.move_transaction, transaction_id, payload.parentId)
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.exception("move_transaction failed", id=transaction_id, parentId=payload.parentId)
+        raise HTTPException(status_code=400, detail=str(e))
+
+
 @app.get("/api/transactions/{transaction_id}", response_model=TransactionRow)
 async def get_transaction(transaction_id: str):
     """Get a specific transaction by ID"""
-    return api.get_transaction(transaction_id)
+    return await run_db(api.get_transaction, transaction_id)
 
 
-@app.get("/api/download-csv")
-async def download_csv():
+@app.get("/api/changes")
+async def get_changes(since: int = Query(ge=0), timeout: float = Query(default=cfg.changes_poll_timeout, ge=0, le=cfg.changes_poll_timeout)):
+    """Long-poll: rows changed after ledger version `since`, once there are any"""
     try:
-        # Generate CSV file
-        csv_plugin = ManageCSV(api.db)
-        export_path = f"{cfg.data_path}temp_export_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        csv_plugin.save_to_csv(export_path)
-
-        # Return file and clean up after sending
-        return FileResponse(
-            path=export_path,
-            filename="transactions.csv",
-            media_type="text/csv",
-        )
+        return await api.get_changes(since, timeout)
+    except Exception as e:
+        log.exception("get_changes failed")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/search", response_model=SearchResult)
+async def search(q: Optional[str] = None, tag: List[str] = Query(default=[]),
+                 limit: int = Query(default=1000, ge=1, le=10000)):
+    """Ids of the transactions whose note mentions every word of `q` and that have every `tag`"""
+    try:
+        return await run_db(api.search, q, tag, limit)
+    except Exception as e:
+        log.exception("search failed")
+        raise HTTPException(status_code=400, detail=str(e))
+
 
+@app.get("/api/compute", response_model=ComputeResult)
+async def get_compute():
+    """Full PNL compute of every row, same results as the client's runTableCompute"""
+    try:
+        return await run_db(api.get_compute_response)
+    except HTTPException:
+        raise
+    except Exception as e:
+        log.exception("get_compute failed")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/compute/totals", response_model=ComputeTotals)
+async def get_compute_totals():
+    """Totals per currency at the end of the ledger, without the per-row results"""
+    try:
+        return await run_db(api.get_totals)
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f'Error in download_csv: {e} {traceback.format_exc()}')
+        log.exception("get_compute_totals failed")
         raise HTTPException(status_code=400, detail=str(e))
 
 
-@app.post("/api/upload-csv")
-async def upload_csv(file: UploadFile):
+@app.get("/api/stats", response_model=PortfolioStats)
+async def get_stats():
+    """Net owned/borrowed amounts and last trade prices per currency"""
     try:
-        await api.ingest_csv(file)
+        return await run_db(api.get_stats)
+    except Exception as e:
+        log.exception("get_stats failed")
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/api/status")
+async def get_status():
+    """Server health: database thread pool and writer load, connection lock
+    contention, row cache counters"""
+    return {
+        "ledgerVersion": api.changes.version,
+        "startupMs": startup_ms,
+        "dbExecutor": api.executor.metrics(),
+        "dbWriter": api.writer.metrics(),
+        "dbConnections": api.db.conn.metrics(),
+        "rowCache": api.db.cache.counters(),
+    }
+
+
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Request duration, database time, queueing, SQL statement and row histograms
+    by route, plus the /api/status counters, in the Prometheus text format"""
+    status_sections = await get_status()
+    gauges = {key: value for key, value in status_sections.items() if isinstance(value, dict)}
+    gauges["ledger"] = {"version": status_sections["ledgerVersion"]}
+    gauges["startup"] = {"ms": status_sections["startupMs"]}
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
 
-        return api.get_all_transactions()
+@app.get("/api/metrics/profile", response_class=PlainTextResponse)
+async def get_profile(seconds: float = Query(default=10, gt=0, le=cfg.profile_max_seconds),
+                      interval_ms: float = Query(default=cfg.profile_interval_ms, ge=1, le=1000)):
+    """Sample the stacks of the threads serving requests for `seconds`, then return
+    them folded by route (one "route;frame;...;frame count" line per stack, for flame graphs)"""
+    if profiler.busy():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    folded = await asyncio.to_thread(profiler.profile, seconds, interval_ms / 1000)
+    if folded is None:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    return PlainTextResponse(folded)
 
+
+@app.get("/api/download-csv")
+async def download_csv():
+    # Stream the CSV straight from the database, no temp file
+    # (starlette iterates sync generators on its own threads, off the event loop).
+    # Errors happen while streaming, after the status is sent: iter_csv logs them
+    csv_plugin = ManageCSV(api.db)
+    return StreamingResponse(
+        csv_plugin.iter_csv(),
+        media_type="text/csv",
+        headers={
+            "Content-Disposition": 'attachment; filename="transactions.csv"'},
+    )
+
+
+@app.post("/api/upload-csv", response_model=CsvImportResult)
+async def upload_csv(file: UploadFile, duplicates: Literal["keep", "skip"] = "keep"):
+    """Replace the table with a csv file. Rows that look like an earlier row under another
+    id (same date, type, amounts, currencies and network) are reported, and left out
+    with duplicates=skip"""
+    try:
+        diff = await api.ingest_csv(file, duplicates)
+        return await run_db(api.import_response, diff)
     except Exception as e:
-        # if os.path.exists(temp_path):
-        #     os.remove(temp_path)
+        log.exception("upload_csv failed")
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/api/undo")
 async def undo():
     try:
-        return api.undo()
+        return await api.write_and_respond(api.undo)
     except Exception as e:
-        print(f'Error in undo: {e} {traceback.format_exc()}')
+        log.exception("undo failed")
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/api/redo")
 async def redo():
     try:
-        return api.redo()
+        return await api.write_and_respond(api.redo)
     except Exception as e:
-        print(f'Error in redo: {e} {traceback.format_exc()}')
+        log.exception("redo failed")
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/api/undo-redo")
 async def get_undo_redo():
     try:
-        return api.get_undo_redo()
+        return await run_db(api.get_undo_redo)
     except Exception as e:
-        print(f'Error in get_undo_redo: {e} {traceback.format_exc()}')
+        log.exception("get_undo_redo failed")
         raise HTTPException(status_code=400, detail=str(e))
@@ -25,4 +25,6 @@ csv_plugin = ManageCSV(db)
 # csv_plugin.save_to_csv(fname)
 
 # Import from CSV (clearing existing data)
+# table is recreated so schema changes are picked up
+db.recreate_table()
 csv_plugin.populate_from_csv(fname, clear_existing=True)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Literal
+from typing import Dict, List, Literal, Optional, Union
 
 from serverType.TransactionRow import TransactionRow
 
@@ -7,3 +7,120 @@ from serverType.TransactionRow import TransactionRow
 class TransactionUpdate(BaseModel):
     operation: Literal["update", "delete", "finalize"]
     row: TransactionRow
+
+
+class TransactionBatch(BaseModel):
+    """Operations applied in order, in one transaction and one undo step."""
+    operations: List[TransactionUpdate]
+
+
+class TransactionMove(BaseModel):
+    """New parent of a row (and its sub-rows); None makes it a top-level row."""
+    parentId: Optional[str] = None
+
+
+class TransactionPage(BaseModel):
+    rows: List[TransactionRow]
+    # pass back as `cursor` to get the next page; None on the last page
+    nextCursor: Optional[str] = None
+
+
+class TransactionQuery(BaseModel):
+    """Filters of GET /api/transactions/query. A row must match every given filter,
+    and any one value of a list filter (e.g. rowType=BORROW&rowType=REPAY)."""
+    dateFrom: Optional[str] = None  # inclusive
+    dateTo: Optional[str] = None  # inclusive
+    inCurrency: List[str] = []
+    outCurrency: List[str] = []
+    network: List[str] = []
+    # row type names (BORROW) or display values (Borrow)
+    rowType: List[str] = []
+    isSubRow: Optional[bool] = None
+
+
+class QueryPlan(BaseModel):
+    """How sqlite runs a query, from the explain mode of GET /api/transactions/query."""
+    sql: str
+    params: List[Union[str, int]]
+    # EXPLAIN QUERY PLAN details, outermost first
+    plan: List[str]
+    indexes: List[str]
+    # true if a step reads the whole transactions table (or a whole index) instead of seeking
+    fullScan: bool
+    # rows returned, and the time it took to fetch them all
+    rows: int
+    ms: float
+
+
+class SearchResult(BaseModel):
+    """Ids of the rows matching GET /api/search, best match first when searching notes."""
+    ids: List[str]
+
+
+class HistoryDelta(BaseModel):
+    """Rows changed by one undo/redo step."""
+    inserted: List[TransactionRow] = []
+    updated: List[TransactionRow] = []
+    deleted: List[str] = []
+    # whole table, only sent when the client must reload it (see get_changes)
+    table: Optional[List[TransactionRow]] = None
+    # set instead of `table`; history_response sends the (cached) table json
+    tableChanged: bool = Field(default=False, exclude=True)
+
+
+class DuplicateMatch(BaseModel):
+    """A csv row that looks like an earlier one under another id."""
+    id: str
+    duplicateOf: str
+
+
+class CsvImportResult(BaseModel):
+    """Response of POST /api/upload-csv."""
+    duplicates: List[DuplicateMatch]
+    # ids left out (duplicates=skip): the duplicates and their sub-rows
+    skipped: List[str]
+    table: List[TransactionRow]
+
+
+class RowCurCompute(BaseModel):
+    """Compute results of one currency of a row, see CurComputeTypes.ts.
+    NaN/Infinity (e.g. a price with a 0 amount) are sent as null."""
+    price: Optional[float]
+    avgPrice: Optional[float]
+    pnl: Optional[float]
+    cumPnl: Optional[float]
+    cumAmount: Optional[float]
+    netAmount: Optional[float]
+    amountInNetwork: Optional[float]
+    amountBorrowed: Optional[float]
+
+
+class RowCompute(BaseModel):
+    curs: List[str]
+    curData: Dict[str, RowCurCompute]
+
+
+class ComputeResult(BaseModel):
+    """Full PNL compute of the whole ledger, keyed by row id."""
+    rows: Dict[str, RowCompute]
+    # running totals per currency at the end of the ledger
+    totals: Dict[str, Dict[str, Optional[float]]]
+
+
+class ComputeTotals(BaseModel):
+    """Totals per currency at the end of the ledger, as in ComputeResult."""
+    totals: Dict[str, Dict[str, Optional[float]]]
+
+
+class HoldingAmounts(BaseModel):
+    owned: float
+    borrowed: float
+
+
+class PortfolioStats(BaseModel):
+    """Same totals as postcomputeStats.ts, over the whole ledger."""
+    netOwned: Dict[str, float]
+    netBorrowed: Dict[str, float]
+    lastTradePrices: Dict[str, float]
+    # currency -> network -> amounts
+    byNetwork: Dict[str, Dict[str, HoldingAmounts]]
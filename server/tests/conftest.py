@@ -0,0 +1,63 @@
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+import cfg
+from bench.ledger import generate_ledger
+from components.TransactionAPI import TransactionAPI
+from components.TransactionDB import TransactionDB
+
+# Run from the server directory: python -m pytest
+
+
+@pytest.fixture
+def db(tmp_path):
+    """An empty database in a temporary directory."""
+    db = TransactionDB(os.path.join(tmp_path, "transactions.db"))
+    yield db
+    db.conn.close()
+
+
+@pytest.fixture
+def ledger_db(db):
+    """A database holding a small generated ledger (bench/ledger.py)."""
+    db.insert_rows(generate_ledger(600, seed=3))
+    return db
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """main, imported once; the TransactionAPI it opens on import is closed right away,
+    each test gets its own (see client)."""
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("import"))
+    try:
+        os.mkdir(cfg.data_path)
+        import main
+        main.api.close()
+    finally:
+        os.chdir(cwd)
+    return main
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    """A TransactionAPI with its own data directory, holding a small generated
+    ledger instead of the demo rows, and no history."""
+    monkeypatch.chdir(tmp_path)
+    os.mkdir(cfg.data_path)
+    api = TransactionAPI()
+    api.db.recreate_table()
+    api.db.insert_rows(generate_ledger(300, seed=3))
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def client(app_module, api, monkeypatch):
+    """The app, serving `api`."""
+    monkeypatch.setattr(app_module, "api", api)
+    monkeypatch.setattr(app_module, "run_db", api.executor.run)
+    monkeypatch.setattr(app_module, "run_write", api.writer.run)
+    return TestClient(app_module.app)
@@ -0,0 +1,41 @@
+import random
+
+from components.TransactionDB import TransactionDB, COLUMNS
+
+ID, PARENT_ID, DATE = COLUMNS.index("id"), COLUMNS.index("parentId"), COLUMNS.index("date")
+IN_AMOUNT, OUT_AMOUNT = COLUMNS.index("inAmount"), COLUMNS.index("outAmount")
+
+
+def db_ids(db: TransactionDB) -> list:
+    with db.conn.read() as conn:
+        return [row[0] for row in conn.execute("SELECT id FROM transactions").fetchall()]
+
+
+def random_edit(db: TransactionDB, rng: random.Random, new_rows: list) -> None:
+    """One random change to the ledger: rescale some amounts, move a row to another
+    date, delete a subtree, or insert the next entry popped from `new_rows`
+    (raw rows in reverse order, e.g. generate_ledger(...)[::-1])."""
+    rows = db.get_rows(db_ids(db))
+    kind = rng.choice(["amounts", "date", "delete", "insert"])
+    if kind == "amounts":
+        edited = []
+        for row in rng.sample(rows, 5):
+            row = list(row)
+            for column in (IN_AMOUNT, OUT_AMOUNT):
+                if row[column]:
+                    row[column] *= rng.uniform(0.5, 2)
+            edited.append(tuple(row))
+        db.update_rows(edited)
+    elif kind == "date":
+        row = list(rng.choice(rows))
+        row[DATE] = rng.choice(rows)[DATE]
+        db.update_rows([tuple(row)])
+    elif kind == "delete":
+        parents = [row for row in rows if row[PARENT_ID] is None]
+        db.delete_subtree(rng.choice(parents)[ID])
+    else:
+        entry = [new_rows.pop()]
+        # keep its sub-rows with it
+        while new_rows and new_rows[-1][PARENT_ID] is not None:
+            entry.append(new_rows.pop())
+        db.insert_rows(entry)
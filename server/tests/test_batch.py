@@ -0,0 +1,47 @@
+def table(client) -> dict:
+    # by id: undone deletes come back at the end of the table
+    return {row["id"]: row for row in client.get("/api/transactions").json()}
+
+
+def top_level_rows(client) -> list:
+    return [row for row in client.get("/api/transactions").json() if row["parentId"] is None]
+
+
+def test_failing_operation_leaves_the_table_unchanged(client, api):
+    before, version = table(client), api.db.get_version()
+    first, second = top_level_rows(client)[:2]
+    response = client.post("/api/transactions/batch", json={"operations": [
+        {"operation": "update", "row": {**first, "note": "edited"}},
+        {"operation": "delete", "row": second},
+        # its id is taken
+        {"operation": "finalize", "row": first},
+    ]})
+    assert response.status_code == 400
+    assert "operation 2 (finalize" in response.json()["detail"]
+    assert table(client) == before
+    assert api.db.get_version() == version
+    assert client.get("/api/undo-redo").json() == {"undo": "", "redo": ""}
+
+
+def test_batch_undoes_and_redoes_as_one_step(client):
+    before = table(client)
+    first, second, third = top_level_rows(client)[:3]
+    new_row = {**third, "id": "t-batch-new", "note": "added"}
+    response = client.post("/api/transactions/batch", json={"operations": [
+        {"operation": "update", "row": {**first, "note": "edited"}},
+        {"operation": "delete", "row": second},
+        {"operation": "finalize", "row": new_row},
+    ]})
+    assert response.status_code == 200
+    delta = response.json()
+    assert [row["id"] for row in delta["updated"]] == [first["id"]]
+    assert [row["id"] for row in delta["inserted"]] == ["t-batch-new"]
+    assert second["id"] in delta["deleted"]
+    assert delta["undo"] == "apply 3 changes"
+    after = table(client)
+
+    assert client.post("/api/undo").status_code == 200
+    assert table(client) == before
+    assert client.get("/api/undo-redo").json() == {"undo": "", "redo": "apply 3 changes"}
+    assert client.post("/api/redo").status_code == 200
+    assert table(client) == after
@@ -0,0 +1,65 @@
+def changes(client, since: int) -> dict:
+    response = client.get("/api/changes", params={"since": since, "timeout": 0})
+    assert response.status_code == 200
+    return response.json()
+
+
+def first_row(client) -> dict:
+    return client.get("/api/transactions").json()[0]
+
+
+def test_etag_answers_304_until_the_ledger_changes(client, api):
+    response = client.get("/api/transactions")
+    etag = response.headers["ETag"]
+    assert etag == f'"{api.db.get_version()}"'
+
+    for if_none_match in (etag, f"W/{etag}", f'"0", {etag}'):
+        cached = client.get("/api/transactions", headers={"If-None-Match": if_none_match})
+        assert cached.status_code == 304, if_none_match
+        assert cached.content == b""
+        assert cached.headers["ETag"] == etag
+    assert client.get("/api/transactions", headers={"If-None-Match": '"0"'}).status_code == 200
+
+    row = response.json()[0]
+    assert client.post("/api/transactions", json={"operation": "update", "row": {**row, "note": "edited"}}).status_code == 200
+    response = client.get("/api/transactions", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.json()[0]["note"] == "edited"
+
+
+def test_changes_since_a_version(client, api):
+    version = api.db.get_version()
+    assert changes(client, version) == {
+        "version": version, "undo": "", "redo": "",
+        "inserted": [], "updated": [], "deleted": [], "table": None}
+
+    row = first_row(client)
+    client.post("/api/transactions", json={"operation": "update", "row": {**row, "note": "edited"}})
+    delta = changes(client, version)
+    assert delta["version"] == version + 1
+    assert delta["updated"] == [{**row, "note": "edited"}]
+    assert delta["table"] is None
+
+    client.post("/api/undo")
+    delta = changes(client, version + 1)
+    assert delta["version"] == version + 2 and delta["updated"] == [row]
+
+
+def test_clients_from_before_a_reset_get_the_whole_table(client, api):
+    # the api fixture recreated the table after creating the database
+    version = api.db.get_version()
+    reset = api.db.get_meta("ledger_reset_version")
+    assert 0 < reset < version
+
+    delta = changes(client, reset - 1)
+    assert delta["version"] == version
+    assert delta["updated"] == [] and delta["deleted"] == []
+    assert delta["table"] == client.get("/api/transactions").json()
+    # from the reset on, changes are rows again
+    assert changes(client, reset)["table"] is None
+
+    api.db.recreate_table()
+    delta = changes(client, version)
+    assert delta["version"] == version + 1
+    assert delta["table"] == []
@@ -0,0 +1,118 @@
+import csv
+import io
+
+import pytest
+
+from components.ManageCSV import ManageCSV
+from components.TransactionDB import COLUMNS
+
+
+def table(client) -> dict:
+    # by id: undone deletes come back at the end of the table
+    return {row["id"]: row for row in client.get("/api/transactions").json()}
+
+
+def download(client) -> list:
+    return list(csv.DictReader(io.StringIO(client.get("/api/download-csv").text)))
+
+
+def to_csv(rows: list) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode()
+
+
+def upload(client, data: bytes, **params):
+    return client.post("/api/upload-csv", params=params, files={"file": ("transactions.csv", data, "text/csv")})
+
+
+def edited_csv(rows: list):
+    """The csv with one row removed, one changed and one added; and their ids."""
+    parents = {row["parentId"] for row in rows}
+    removed, changed = [row for row in rows if not row["parentId"] and row["id"] not in parents][:2]
+    added = {**changed, "id": "t-csv-new"}
+    rows = [{**row, "note": "changed in the csv"} if row is changed else row
+            for row in rows if row is not removed] + [added]
+    return to_csv(rows), removed["id"], changed["id"], added["id"]
+
+
+def test_csv_import_undo_and_redo(client):
+    # the generated ledger's empty notes come back from a csv as None
+    rows = download(client)
+    assert upload(client, to_csv(rows)).status_code == 200
+    before = table(client)
+    data, removed, changed, added = edited_csv(rows)
+    response = upload(client, data)
+    assert response.status_code == 200
+    imported = table(client)
+    assert removed not in imported and added in imported
+    assert imported[changed]["note"] == "changed in the csv"
+    assert client.get("/api/undo-redo").json() == {"undo": "load from csv", "redo": ""}
+
+    undone = client.post("/api/undo")
+    assert undone.status_code == 200
+    delta = undone.json()
+    assert [row["id"] for row in delta["inserted"]] == [removed]
+    assert delta["updated"] == [before[changed]]
+    assert delta["deleted"] == [added]
+    assert table(client) == before
+
+    redone = client.post("/api/redo")
+    assert redone.status_code == 200
+    delta = redone.json()
+    assert [row["id"] for row in delta["inserted"]] == [added]
+    assert delta["updated"] == [imported[changed]]
+    assert delta["deleted"] == [removed]
+    assert delta["table"] is None
+    assert table(client) == imported
+
+
+def test_malformed_line_rolls_back_the_import(client, api, tmp_path):
+    rows = download(client)
+    assert upload(client, to_csv(rows)).status_code == 200
+    before, version = table(client), api.db.get_version()
+    actions = client.get("/api/undo-redo").json()
+    # the bad row comes after several chunks were staged
+    edited = [{**row, "note": "not imported"} for row in rows]
+    edited[250]["inAmount"] = "many"
+    path = tmp_path / "malformed.csv"
+    path.write_bytes(to_csv(edited))
+
+    with pytest.raises(Exception, match="line 252"):
+        ManageCSV(api.db).populate_from_csv(str(path), chunk_size=50)
+    response = upload(client, to_csv(edited))
+    assert response.status_code == 400
+    assert "line 252" in response.json()["detail"]
+
+    assert table(client) == before
+    assert api.db.get_version() == version
+    assert client.get("/api/undo-redo").json() == actions
+
+
+def old_save_to_csv(csv_plugin: ManageCSV) -> bytes:
+    """The csv export as it was written before iter_csv: TransactionRows through row_to_dict."""
+    headers = csv_plugin.get_csv_headers()
+    buffer = io.StringIO(newline="")
+    writer = csv.DictWriter(buffer, fieldnames=headers)
+    writer.writeheader()
+    for tx in csv_plugin.db.get_all_transactions():
+        writer.writerow(csv_plugin.row_to_dict(headers, tx))
+    return buffer.getvalue().encode()
+
+
+def test_iter_csv_matches_the_old_export(ledger_db, tmp_path):
+    rows = ledger_db.get_rows([tx.id for tx in ledger_db.get_all_transactions()[:3]])
+    awkward = [dict(zip(COLUMNS, row)) for row in rows]
+    awkward[0].update(id="t-quoted", note='commas, "quotes"\nand a newline', tags='["a b", "c"]')
+    awkward[1].update(id="t-unicode", note="café ✓", inAmount=2, feeAmount="auto", usdValue=None)
+    awkward[2].update(id="t-empty", note=None, tags=None, parentId=None, isSubRow=False)
+    ledger_db.insert_rows([tuple(row.values()) for row in awkward])
+    csv_plugin = ManageCSV(ledger_db)
+
+    want = old_save_to_csv(csv_plugin)
+    assert b"".join(csv_plugin.iter_csv(chunk_size=7)) == want
+    path = tmp_path / "transactions.csv"
+    csv_plugin.save_to_csv(path)
+    assert path.read_bytes() == want
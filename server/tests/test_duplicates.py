@@ -0,0 +1,66 @@
+from bench.ledger import generate_ledger
+from components.Duplicates import DuplicateDetector, fingerprint
+from components.ManageCSV import ManageCSV
+from components.TransactionDB import COLUMNS
+from ledger_edits import ID, PARENT_ID, db_ids
+
+IN_AMOUNT, IN_CURRENCY, OUT_CURRENCY, NETWORK = (
+    COLUMNS.index(name) for name in ("inAmount", "inCurrency", "outCurrency", "network"))
+
+
+def edited(row: tuple, **values) -> tuple:
+    row = list(row)
+    for name, value in values.items():
+        row[COLUMNS.index(name)] = value
+    return tuple(row)
+
+
+def trade():
+    return next(row for row in generate_ledger(50, seed=9)
+                if row[PARENT_ID] is None and row[IN_AMOUNT] and row[IN_CURRENCY] and row[OUT_CURRENCY])
+
+
+def test_fingerprint_normalizes_exports():
+    row = trade()
+    assert fingerprint(edited(row, id="t-copy")) == fingerprint(row)
+    assert fingerprint(edited(row, inAmount=row[IN_AMOUNT] + 1e-10)) == fingerprint(row)
+    assert fingerprint(edited(row, inAmount=str(row[IN_AMOUNT]))) == fingerprint(row)
+    assert fingerprint(edited(row, inCurrency=f" {row[IN_CURRENCY].lower()} ")) == fingerprint(row)
+    assert fingerprint(edited(row, outCurrency=row[OUT_CURRENCY].lower())) == fingerprint(row)
+    assert fingerprint(edited(row, network=row[NETWORK].upper())) == fingerprint(row)
+
+    assert fingerprint(edited(row, inAmount=row[IN_AMOUNT] + 1e-6)) != fingerprint(row)
+    assert fingerprint(edited(row, date="1999-01-01")) != fingerprint(row)
+    assert fingerprint(edited(row, network="elsewhere")) != fingerprint(row)
+
+
+def test_detector_matches_top_level_rows_only():
+    row = trade()
+    detector = DuplicateDetector([row])
+    assert detector.check(edited(row, id="t-copy", network=row[NETWORK].lower())) == row[ID]
+    assert detector.check(edited(row, id="t-sub", parentId=row[ID])) is None
+    assert detector.matches == [{"id": "t-copy", "duplicateOf": row[ID]}]
+
+
+def test_skipped_duplicates_take_their_sub_rows(db, tmp_path):
+    rows = generate_ledger(300, seed=3)
+    parent = next(row[PARENT_ID] for row in rows if row[PARENT_ID] is not None)
+    entry = [row for row in rows if parent in (row[ID], row[PARENT_ID])]
+    # the same entry exported again under other ids
+    copies = [edited(row, id=f"{row[ID]}-copy", parentId=row[PARENT_ID] and f"{row[PARENT_ID]}-copy")
+              for row in entry]
+    db.insert_rows(rows + copies)
+    path = tmp_path / "transactions.csv"
+    csv_plugin = ManageCSV(db)
+    csv_plugin.save_to_csv(path)
+    copy_ids = [row[ID] for row in copies]
+
+    diff = csv_plugin.populate_from_csv(path, clear_existing=True, duplicates="keep")
+    assert {"id": f"{parent}-copy", "duplicateOf": parent} in diff["duplicates"]
+    assert diff["skipped"] == []
+    assert set(copy_ids) <= set(db_ids(db))
+
+    diff = csv_plugin.populate_from_csv(path, clear_existing=True, duplicates="skip")
+    assert set(copy_ids) <= set(diff["skipped"])
+    assert not set(copy_ids) & set(db_ids(db))
+    assert {row[ID] for row in entry} <= set(db_ids(db))
@@ -0,0 +1,74 @@
+import pytest
+
+
+def rows_by_id(client) -> dict:
+    return {row["id"]: row for row in client.get("/api/transactions").json()}
+
+
+def family(rows: dict):
+    """A parent with sub-rows, one of its sub-rows, and a top-level row without any."""
+    children = {}
+    for row in rows.values():
+        if row["parentId"] is not None:
+            children.setdefault(row["parentId"], []).append(row["id"])
+    parent = next(iter(children))
+    single = next(tx_id for tx_id, row in rows.items()
+                  if row["parentId"] is None and tx_id not in children)
+    return parent, children[parent][0], single
+
+
+def move(client, tx_id: str, parent_id):
+    return client.post(f"/api/transactions/{tx_id}/move", json={"parentId": parent_id})
+
+
+def test_delete_subtree_of_missing_id(api):
+    version = api.db.get_version()
+    assert api.db.delete_subtree("t-missing") == []
+    assert api.db.get_version() == version
+
+
+def test_delete_missing_row_is_rejected(client):
+    row = next(iter(rows_by_id(client).values()))
+    response = client.post("/api/transactions", json={"operation": "delete", "row": {**row, "id": "t-missing"}})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("target", ["missing", "itself", "descendant", "sub-row", "missing parent"])
+def test_invalid_moves_are_rejected(client, target):
+    before = rows_by_id(client)
+    parent, child, single = family(before)
+    tx_id, parent_id = {
+        "missing": ("t-missing", single),
+        "itself": (parent, parent),
+        "descendant": (parent, child),
+        "sub-row": (single, child),
+        "missing parent": (single, "t-missing"),
+    }[target]
+    assert move(client, tx_id, parent_id).status_code == 400
+    assert rows_by_id(client) == before
+
+
+def test_move_with_sub_rows_and_undo(client):
+    before = rows_by_id(client)
+    parent, child, single = family(before)
+    subtree = {tx_id for tx_id, row in before.items() if tx_id == parent or row["parentId"] == parent}
+
+    response = move(client, parent, single)
+    assert response.status_code == 200
+    assert {row["id"] for row in response.json()["updated"]} == subtree
+    after = rows_by_id(client)
+    for tx_id in subtree:
+        assert after[tx_id]["parentId"] == single
+        assert after[tx_id]["isSubRow"]
+
+    undone = client.post("/api/undo")
+    assert undone.status_code == 200
+    assert {row["id"] for row in undone.json()["updated"]} == subtree
+    assert rows_by_id(client) == before
+
+    # to the top level: its sub-rows stay under it
+    assert move(client, child, None).status_code == 200
+    after = rows_by_id(client)
+    assert after[child]["parentId"] is None and not after[child]["isSubRow"]
+    assert client.post("/api/undo").status_code == 200
+    assert rows_by_id(client) == before
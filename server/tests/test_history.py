@@ -0,0 +1,60 @@
+import pytest
+
+from components.History import History
+from components.TransactionDB import TransactionDB
+
+
+def table(db) -> dict:
+    with db.conn.read() as conn:
+        return {row[0]: row for row in conn.execute("SELECT * FROM transactions").fetchall()}
+
+
+def edit_notes(db, history, count: int) -> None:
+    for i, row in enumerate(list(table(db).values())[:count]):
+        tx = db.row_to_transaction(row).model_copy(update={"note": f"edit {i}"})
+        with db.conn.write():
+            history.new_update(tx)
+            db.update_transaction(tx)
+
+
+def test_journal_survives_reopening(ledger_db):
+    before = table(ledger_db)
+    history = History(ledger_db)
+    edit_notes(ledger_db, history, 2)
+    parent = next(row for row in before.values() if row[2] is not None)[2]
+    history.new_delete(ledger_db.get_transaction(parent))
+    edited = table(ledger_db)
+    ledger_db.conn.close()
+
+    db = TransactionDB(ledger_db.db_path)
+    try:
+        history = History(db)
+        assert table(db) == edited
+        assert history.get_actions()[1] == ""
+        assert history.get_actions()[0].startswith("delete ")
+        for _ in range(3):
+            history.undo()
+        assert not history.can_undo()
+        assert table(db) == before
+        assert history.get_actions() == ("", "update 1 transaction")
+        for _ in range(3):
+            history.redo()
+        assert table(db) == edited
+    finally:
+        db.conn.close()
+
+
+def test_journal_is_compacted_at_the_limit(ledger_db):
+    history = History(ledger_db, max_operations=3)
+    edit_notes(ledger_db, history, 5)
+    with ledger_db.conn.read() as conn:
+        seqs = [row[0] for row in conn.execute("SELECT seq FROM history ORDER BY seq").fetchall()]
+    assert seqs == [3, 4, 5]
+
+    for _ in range(3):
+        history.undo()
+    with pytest.raises(Exception, match="No operations to undo"):
+        history.undo()
+    # the two oldest edits can no longer be undone
+    notes = [row[14] for row in table(ledger_db).values()]
+    assert sorted(note for note in notes if note and note.startswith("edit ")) == ["edit 0", "edit 1"]
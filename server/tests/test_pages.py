@@ -0,0 +1,42 @@
+import pytest
+
+
+def walk_pages(client, limit: int) -> list:
+    pages, cursor = [], None
+    while True:
+        params = {"limit": limit} if cursor is None else {"limit": limit, "cursor": cursor}
+        response = client.get("/api/transactions", params=params)
+        assert response.status_code == 200
+        page = response.json()
+        pages.append(page["rows"])
+        cursor = page["nextCursor"]
+        if cursor is None:
+            return pages
+
+
+@pytest.mark.parametrize("limit", [1, 7, 50, 5000])
+def test_pages_return_each_top_level_row_once_in_order(client, limit):
+    table = client.get("/api/transactions").json()
+    pages = walk_pages(client, limit)
+    top_level = [row for page in pages for row in page if row["parentId"] is None]
+    assert all(len([row for row in page if row["parentId"] is None]) <= limit for page in pages)
+    assert [row["id"] for row in top_level] == [
+        row["id"] for row in sorted((row for row in table if row["parentId"] is None),
+                                    key=lambda row: (row["date"], row["id"]))]
+    assert sorted(row["id"] for page in pages for row in page) == sorted(row["id"] for row in table)
+
+
+def test_sub_rows_arrive_with_their_parent(client):
+    for page in walk_pages(client, 7):
+        parents = {row["id"] for row in page if row["parentId"] is None}
+        for row in page:
+            if row["parentId"] is not None:
+                assert row["parentId"] in parents
+
+
+# not base64, not json, not a (date, id) pair
+@pytest.mark.parametrize("cursor", ["not-a-cursor", "bm90IGpzb24=", "WyJvbmUiXQ=="])
+def test_malformed_cursor_is_rejected(client, cursor):
+    response = client.get("/api/transactions", params={"limit": 10, "cursor": cursor})
+    assert response.status_code == 400
+    assert "Invalid cursor" in response.json()["detail"]
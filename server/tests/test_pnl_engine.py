@@ -0,0 +1,36 @@
+import random
+
+import pytest
+
+from bench.ledger import generate_ledger
+from components.PnlEngine import PnlEngine
+from ledger_edits import db_ids, random_edit
+
+
+def full_recompute(db):
+    engine = PnlEngine(db)
+    return engine.get_results(), engine.get_totals()
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_incremental_matches_full_recompute(ledger_db, seed):
+    rng = random.Random(seed)
+    # rows of another ledger over the same dates, inserted in between the existing ones
+    new_rows = generate_ledger(200, seed=100 + seed)[::-1]
+    # small checkpoints, so edits replay from checkpoints in the middle of currencies
+    engine = PnlEngine(ledger_db, checkpoint_every=7)
+    engine.get_results()
+    for _ in range(30):
+        for _ in range(rng.randint(1, 3)):
+            random_edit(ledger_db, rng, new_rows)
+        rows, totals = full_recompute(ledger_db)
+        assert engine.get_results() == rows
+        assert engine.get_totals() == totals
+
+
+def test_json_follows_edits(ledger_db):
+    engine = PnlEngine(ledger_db)
+    body = engine.get_json()
+    assert engine.get_json() is body
+    ledger_db.delete_subtree(db_ids(ledger_db)[0])
+    assert engine.get_json() != body
@@ -0,0 +1,31 @@
+import pytest
+
+from serverType.api_types import TransactionQuery
+
+FILTERS = {
+    "dateFrom": {"dateFrom": "2023-06-01"},
+    "dateTo": {"dateTo": "2022-03-01"},
+    "date range": {"dateFrom": "2022-03-01", "dateTo": "2022-04-01"},
+    "inCurrency": {"inCurrency": ["ETH"]},
+    "outCurrency": {"outCurrency": ["USDC", "ETH"]},
+    "network": {"network": ["Arbitrum"]},
+    "rowType": {"rowType": ["BORROW", "REPAY"]},
+    "isSubRow": {"isSubRow": True},
+    "top level": {"isSubRow": False},
+    "combined": {"inCurrency": ["ETH"], "rowType": ["TRADE"], "dateFrom": "2022-02-01"},
+}
+
+
+@pytest.mark.parametrize("name", FILTERS)
+@pytest.mark.parametrize("after", [None, ("2022-03-01", "t")])
+def test_filters_use_an_index(ledger_db, name, after):
+    plan = ledger_db.explain_query(TransactionQuery(**FILTERS[name]), 100, after)
+    assert not plan["fullScan"], plan["plan"]
+    assert plan["indexes"]
+
+
+def test_explain_route(client):
+    response = client.get("/api/transactions/query", params={"rowType": "BORROW", "explain": "true"})
+    assert response.status_code == 200
+    assert response.json()["fullScan"] is False
+    assert response.json()["indexes"] == ["idx_row_type"]
@@ -0,0 +1,43 @@
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from components.TransactionDB import COLUMNS
+from serverType.api_types import CsvImportResult, HistoryDelta
+
+
+def encoded(content) -> bytes:
+    """What FastAPI would send for `content`."""
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def add_awkward_row(api) -> None:
+    # non-ascii text, an int amount (sent as a float), and empty columns
+    row = list(api.db.get_rows([api.db.get_all_transactions()[0].id])[0])
+    for name, value in (("id", "t-awkward"), ("note", 'café "ü" ✓\n'), ("inAmount", 2), ("feeAmount", None)):
+        row[COLUMNS.index(name)] = value
+    api.db.insert_rows([tuple(row)])
+
+
+def test_table_response_matches_fastapi(api):
+    add_awkward_row(api)
+    assert api.get_all_transactions_response().body == encoded(api.get_all_transactions())
+
+
+def test_import_response_matches_fastapi(api):
+    add_awkward_row(api)
+    diff = {"duplicates": [{"id": "t-2", "duplicateOf": "t-1"}], "skipped": ["t-2", "t-3"]}
+    want = CsvImportResult(table=api.get_all_transactions(), **diff)
+    assert api.import_response(diff).body == encoded(want)
+
+
+def test_history_response_matches_fastapi(api):
+    add_awkward_row(api)
+    table = api.get_all_transactions()
+    undo, redo = api.history.get_actions()
+    delta = HistoryDelta(inserted=table[:2], updated=table[-2:], deleted=["t-1"])
+    assert api.history_response(delta, {"version": 7}).body == encoded(
+        {"version": 7, "undo": undo, "redo": redo, **jsonable_encoder(delta)})
+
+    want = HistoryDelta(table=table)
+    assert api.history_response(HistoryDelta(tableChanged=True)).body == encoded(
+        {"undo": undo, "redo": redo, **jsonable_encoder(want)})
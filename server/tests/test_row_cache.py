@@ -0,0 +1,52 @@
+import pytest
+
+from components.TransactionDB import COLUMNS
+
+NOTE = COLUMNS.index("note")
+
+
+def with_note(db, tx_id: str, note: str) -> tuple:
+    row = list(db.get_row(tx_id))
+    row[NOTE] = note
+    return tuple(row)
+
+
+def test_write_evicts_the_row(ledger_db):
+    cache = ledger_db.cache
+    first, second = (tx.id for tx in ledger_db.get_all_transactions()[:2])
+    body = ledger_db.get_all_transactions_json()
+    assert cache.complete and cache.ordered is not None
+    assert ledger_db.get_transaction(first).note != "edited"
+    generation = cache.generation
+
+    ledger_db.update_rows([with_note(ledger_db, first, "edited")])
+    assert cache.generation == generation + 1
+    assert first not in cache.rows and cache.stale == {first}
+    assert second in cache.rows
+    assert cache.ordered is None and cache.all_json is None
+
+    assert ledger_db.get_transaction(first).note == "edited"
+    assert first in cache.rows and not cache.stale
+    assert ledger_db.get_all_transactions()[0].note == "edited"
+    assert ledger_db.get_all_transactions_json() != body
+    assert b'"note":"edited"' in ledger_db.get_all_transactions_json()
+
+
+def test_rolled_back_write_keeps_the_cache(ledger_db):
+    cache = ledger_db.cache
+    tx = ledger_db.get_all_transactions()[0]
+    body = ledger_db.get_all_transactions_json()
+    generation, ordered = cache.generation, cache.ordered
+
+    with pytest.raises(ValueError):
+        with ledger_db.conn.write():
+            ledger_db.update_rows([with_note(ledger_db, tx.id, "rolled back")])
+            # reads inside the write see it, past the cache
+            assert ledger_db.get_transaction(tx.id).note == "rolled back"
+            raise ValueError("roll back")
+
+    assert cache.generation == generation and not cache.stale
+    assert cache.ordered is ordered and cache.all_json is body
+    assert ledger_db.get_transaction(tx.id) is cache.rows[tx.id].model(ledger_db)
+    assert ledger_db.get_transaction(tx.id).note == tx.note
+    assert ledger_db.get_all_transactions_json() is body
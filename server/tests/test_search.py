@@ -0,0 +1,82 @@
+import csv
+import json
+import random
+
+from bench.ledger import TAGS, WORDS
+from components.ManageCSV import ManageCSV
+from components.TransactionDB import COLUMNS
+from ledger_edits import ID, PARENT_ID, db_ids
+
+TAGS_COL, NOTE = COLUMNS.index("tags"), COLUMNS.index("note")
+
+
+def table(db) -> dict:
+    with db.conn.read() as conn:
+        return {row[ID]: row for row in conn.execute("SELECT * FROM transactions").fetchall()}
+
+
+def assert_index_in_sync(db) -> None:
+    """tags and notes_fts hold exactly what rebuilding them from transactions would."""
+    rows = table(db)
+    with db.conn.write() as conn:
+        # not against the content table (rank 1): empty notes are left out on purpose
+        conn.execute("INSERT INTO notes_fts (notes_fts) VALUES ('integrity-check')")
+        indexed = {row[0] for row in conn.execute("SELECT id FROM notes_fts_docsize").fetchall()}
+        noted = {row[0] for row in conn.execute("SELECT rowid FROM transactions WHERE note != ''").fetchall()}
+        tags = set(conn.execute("SELECT lower(tag), id FROM tags").fetchall())
+    assert indexed == noted
+    assert tags == {(tag, tx_id) for tx_id, row in rows.items() for tag in json.loads(row[TAGS_COL] or "[]")}
+    for word in WORDS:
+        want = {tx_id for tx_id, row in rows.items()
+                if any(token.startswith(word) for token in (row[NOTE] or "").lower().split())}
+        assert set(db.search(word, [], len(rows) + 1)) == want, word
+    for tag in TAGS:
+        # tags compare case-insensitively
+        want = {tx_id for row_tag, tx_id in tags if row_tag == tag}
+        assert set(db.search(None, [tag.upper()], len(rows) + 1)) == want, tag
+
+
+def retag(rng: random.Random, row: tuple) -> tuple:
+    row = list(row)
+    row[TAGS_COL] = json.dumps(rng.sample(TAGS, rng.randint(0, 2)))
+    row[NOTE] = rng.choice([None, "", " ".join(rng.choices(WORDS, k=3))])
+    return tuple(row)
+
+
+def test_index_follows_edits_and_deletes(ledger_db):
+    rng = random.Random(5)
+    assert_index_in_sync(ledger_db)
+    for _ in range(5):
+        rows = list(table(ledger_db).values())
+        ledger_db.update_rows([retag(rng, row) for row in rng.sample(rows, 20)])
+        assert_index_in_sync(ledger_db)
+        ledger_db.delete_ids([row[ID] for row in rng.sample(rows, 5) if row[PARENT_ID] is None])
+        assert_index_in_sync(ledger_db)
+        parents = sorted({row[PARENT_ID] for row in table(ledger_db).values() if row[PARENT_ID]})
+        assert ledger_db.delete_subtree(rng.choice(parents))
+        assert_index_in_sync(ledger_db)
+
+
+def test_index_follows_csv_import(ledger_db, tmp_path):
+    rng = random.Random(6)
+    csv_plugin = ManageCSV(ledger_db)
+    path = tmp_path / "transactions.csv"
+    csv_plugin.save_to_csv(path)
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    for row in rng.sample(rows, 50):
+        row["note"] = " ".join(rng.choices(WORDS, k=2))
+        row["tags"] = ", ".join(rng.sample(TAGS, 2))
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows[100:])
+    csv_plugin.populate_from_csv(path, clear_existing=True)
+    assert len(db_ids(ledger_db)) == len(rows) - 100
+    assert_index_in_sync(ledger_db)
+
+    old_rows = list(table(ledger_db).values())
+    ledger_db.recreate_table()
+    assert_index_in_sync(ledger_db)
+    ledger_db.insert_rows(old_rows)
+    assert_index_in_sync(ledger_db)
@@ -0,0 +1,35 @@
+import random
+
+import pytest
+
+from bench.ledger import generate_ledger
+from components.PnlEngine import PnlEngine
+from components.TransactionTable import TransactionTable
+from ledger_edits import random_edit
+
+
+def assert_totals_close(got: dict, want: dict) -> None:
+    # the table sums in another order than the engine's replay, so floats may differ a bit
+    assert got.keys() == want.keys()
+    for cur, totals in want.items():
+        for key, value in totals.items():
+            if value is None:
+                assert got[cur][key] is None, (cur, key)
+            else:
+                assert got[cur][key] == pytest.approx(value, rel=1e-9, abs=1e-6), (cur, key)
+
+
+def test_totals_match_engine(ledger_db):
+    rng = random.Random(4)
+    new_rows = generate_ledger(100, seed=104)[::-1]
+    engine = PnlEngine(ledger_db)
+    assert_totals_close(TransactionTable.from_db(ledger_db).totals(), engine.get_totals())
+    for _ in range(10):
+        random_edit(ledger_db, rng, new_rows)
+        assert_totals_close(TransactionTable.from_db(ledger_db).totals(), engine.get_totals())
+
+
+def test_from_db_reads_the_current_version(ledger_db):
+    table = TransactionTable.from_db(ledger_db)
+    assert len(table) == 600
+    assert table.version == ledger_db.get_version()
@@ -0,0 +1,50 @@
+import pytest
+
+from bench.ledger import generate_ledger
+from components.WriteCoordinator import WriteCoordinator
+
+
+def fail_after(db, rows):
+    db.insert_rows(rows)
+    raise ValueError("job failed")
+
+
+def test_failing_job_leaves_its_group_committed(db):
+    first, failed, last = (generate_ledger(3, seed=seed) for seed in (1, 2, 3))
+    # a long window, so all three jobs commit in one group
+    writer = WriteCoordinator(db.conn, window_ms=500)
+    try:
+        futures = [writer.submit(db.insert_rows, first),
+                   writer.submit(fail_after, db, failed),
+                   writer.submit(db.insert_rows, last)]
+        assert futures[0].result(timeout=10) is None
+        with pytest.raises(ValueError, match="job failed"):
+            futures[1].result(timeout=10)
+        assert futures[2].result(timeout=10) is None
+    finally:
+        writer.shutdown()
+
+    assert writer.metrics()["groups"] == 1
+    assert writer.metrics()["failed"] == 1
+    with db.conn.read() as conn:
+        ids = {row[0] for row in conn.execute("SELECT id FROM transactions").fetchall()}
+    assert ids == {row[0] for row in first + last}
+
+
+def test_jobs_run_in_submission_order(db):
+    order = []
+
+    def job(i):
+        db.set_meta("last_job", i)
+        order.append(i)
+    writer = WriteCoordinator(db.conn, window_ms=50, max_group=4)
+    try:
+        futures = [writer.submit(job, i) for i in range(10)]
+        for future in futures:
+            future.result(timeout=10)
+    finally:
+        writer.shutdown()
+    assert order == list(range(10))
+    assert db.get_meta("last_job") == 9
+    metrics = writer.metrics()
+    assert metrics["jobs"] == 10 and metrics["largestGroup"] <= 4
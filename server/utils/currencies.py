@@ -0,0 +1,3 @@
+# keep in sync with client/src/utils/currencies.ts
+# order stables in sort order
+stable = ["USD", "USDC", "USDT"]